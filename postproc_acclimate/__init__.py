@@ -1,9 +1,20 @@
 """
 Acclimate post-processing
 """
-from ._version import get_versions
-__version__: str = get_versions()["version"]
-del get_versions
 
-from . import _version
-__version__ = _version.get_versions()['version']
+
+def __getattr__(name):
+    """
+    Look up __version__ on first access: the static version of the installed package, or versioneer's version
+    (which may run git) for a source tree that is not installed.
+    """
+    if name != "__version__":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    from importlib import metadata
+    try:
+        version = metadata.version(__name__)
+    except metadata.PackageNotFoundError:
+        from ._version import get_versions
+        version = get_versions()["version"]
+    globals()["__version__"] = version
+    return version
@@ -1,8 +1,11 @@
 """"Methods for calculation of summary metrics on xarray ensemble data.
 
 This script provides functions to aggregate xarray data by specified dimensions using dictionaries of keys. The main functions implemented are:
-1. `aggregate_by_dimension_dict`: Aggregates data by a given dimension using a dictionary of keys. This function selects data based on the provided dictionary, sums the data along the specified dimension, and assigns new coordinates based on the dictionary keys.
+1. `aggregate_by_dimension_dict`: Aggregates data by a given dimension using a dictionary of keys. This function selects data based on the provided dictionary, sums the data along the specified dimension, and assigns new coordinates based on the dictionary keys. With `method="matrix"`, all keys are aggregated at once by a matrix product with a membership matrix (`membership_matrix`), optionally weighted. The registered groups of `definitions`, given by name (e.g. `"WORLD_REGIONS"`), are compiled once per coordinate into index arrays and membership matrices (`definitions.compile_groups`).
 2. `get_baseline_and_aggregates`: Aggregates data and provides aggregated baseline data. This function first retrieves baseline data for a specified date, then aggregates both the baseline data and the original data using the provided dictionary and dimension.
+3. `get_baseline_deviation`: Aggregates, baseline and the relative/absolute deviation from the baseline in one graph, optionally written straight to NetCDF files in a single computation.
+4. `chunked_quantile`: Quantiles along a (time) dimension of dask-backed data with bounded memory per task, exact by rechunking that dimension into blocks of the other dimensions, or approximate with a given relative error from logarithmic histograms merged in a single pass over the chunks.
+5. `ragged_reduce` and `ragged_quantile`: Statistics and quantiles over the time steps of each member of a ragged ensemble (see `ensemble_data_combination.build_ragged_ensemble`), whose members have different lengths without padding. Aggregates and baseline deviations work on ragged ensembles as they are.
 
 
 For more advanced operations and native methods in xarray, refer to the following documentation:
@@ -12,23 +15,51 @@ For more advanced operations and native methods in xarray, refer to the followin
 
 
 """
+import dask
+import dask.array as da
+import numpy as np
 import xarray as xr
 import postproc_acclimate.data_transform as datatransform
+from postproc_acclimate import definitions, helpers
+from postproc_acclimate.caching import cached
     
-def aggregate_by_dimension_dict(data,dimension,dict,new_dimension_name=None):
+@cached
+def aggregate_by_dimension_dict(data,dimension,dict,new_dimension_name=None,method="select",weights=None,statistic="sum"):
     """
     Aggregate data by a given dimension using a dictionary of keys.
 
+    With method="select" (default), every key is selected and summed separately and the results are
+    concatenated, which reads the input once per key. With method="matrix", a membership matrix (keys x
+    dimension values, see membership_matrix) is built and all keys are aggregated in one xr.dot pass over
+    the data, which is much cheaper for many (overlapping) groups such as definitions.WORLD_REGIONS. Only
+    the matrix method supports weights and statistics other than "sum". Missing values count as zero in
+    sums and are left out of means, as with xarray's sum and mean.
+
+    Groups given by their name in definitions.GROUP_REGISTRY (e.g. "WORLD_REGIONS") are aggregated with their
+    compiled index arrays and membership matrix (see definitions.compile_groups), which are cached per
+    coordinate. Their members that are not in the coordinate are left out with a warning when compiling,
+    while dicts, including the registered dicts themselves, raise a KeyError for such members.
+
     Parameters
     ----------
     data : xarray.DataArray or xarray.Dataset
         The data to be aggregated.
     dimension : str
         The name of the dimension to aggregate.
-    dict : dict
+    dict : dict or str
         A dictionary where keys are the new dimension values and values are lists of the original dimension values to be aggregated.
+        For coded coordinates (see helpers.encode_agent_coordinate), the values are labels and translated to codes.
+        Alternatively, the name of groups in definitions.GROUP_REGISTRY, e.g. "world_bank_income_groups".
     new_dimension_name : str, optional
         The name of the new dimension after aggregation. If None, defaults to '{dimension}_aggregate'.
+    method : {"select", "matrix"}, optional
+        How to aggregate, see above. Default is "select".
+    weights : xarray.DataArray, optional
+        Weights along the dimension (possibly with further dimensions broadcast against the data), only
+        used with method="matrix". Default is None, i.e. all weights are one.
+    statistic : {"sum", "mean", "share"}, optional
+        With method="matrix": the (weighted) sum per key, the weighted mean per key, or the share of the
+        (weighted) sum per key in the (weighted) sum over all values of the dimension. Default is "sum".
 
     Returns
     -------
@@ -37,11 +68,110 @@ def aggregate_by_dimension_dict(data,dimension,dict,new_dimension_name=None):
     """
     if new_dimension_name is None:
         new_dimension_name = dimension+"_aggregate"
+    compiled = None
+    if isinstance(dict, str):
+        labels = helpers.decode_coordinates(data[dimension])[dimension].values
+        compiled = definitions.compile_groups(dict, labels)
+        dict = definitions.GROUP_REGISTRY[dict]
+    elif helpers.coordinate_code_table(data, dimension) is not None:
+        dict = {key: helpers.code_labels(data, dimension, members) for key, members in dict.items()}
+    if method == "matrix":
+        return _aggregate_by_membership_matrix(data, dimension, dict, new_dimension_name, weights, statistic,
+                                               compiled)
+    if method != "select":
+        raise ValueError(f"Unknown aggregation method {method!r}, expected 'select' or 'matrix'")
+    if weights is not None or statistic != "sum":
+        raise ValueError("weights and statistics other than 'sum' require method='matrix'")
     aggregated_data = []
     for key in dict.keys():
-        aggregated_data.append(data.sel({dimension:dict[key]}).sum(dim=dimension).assign_coords({new_dimension_name:key}))
+        selected = data.sel({dimension:dict[key]}) if compiled is None else data.isel({dimension:compiled.indices[key]})
+        aggregated_data.append(selected.sum(dim=dimension).assign_coords({new_dimension_name:key}))
     return xr.concat(aggregated_data,dim=new_dimension_name)
 
+def membership_matrix(dimension_values,dimension,dict,new_dimension_name,dtype=np.int8):
+    """
+    Build the membership matrix of a dictionary of keys over the values of a dimension.
+
+    Parameters
+    ----------
+    dimension_values : array-like
+        The values of the dimension to aggregate, e.g. data[dimension].values.
+    dimension : str
+        The name of the dimension to aggregate.
+    dict : dict
+        A dictionary where keys are the new dimension values and values are lists of the original dimension values to be aggregated.
+    new_dimension_name : str
+        The name of the new dimension.
+    dtype : numpy.dtype, optional
+        The data type of the matrix, default is numpy.int8.
+
+    Returns
+    -------
+    xarray.DataArray
+        Matrix over (new_dimension_name, dimension) which is 1 where a dimension value belongs to a key and
+        0 elsewhere.
+
+    Raises
+    ------
+    KeyError
+        If a value in the dictionary is not a value of the dimension (as data.sel would).
+    """
+    dimension_values = np.asarray(dimension_values)
+    positions = {value: i for i, value in enumerate(dimension_values.tolist())}
+    matrix = np.zeros((len(dict), len(dimension_values)), dtype=dtype)
+    for row, members in enumerate(dict.values()):
+        members = [members] if np.isscalar(members) else members
+        missing = [member for member in members if member not in positions]
+        if missing:
+            raise KeyError(f"{missing} not found in dimension {dimension!r}")
+        matrix[row, [positions[member] for member in members]] = 1
+    return xr.DataArray(matrix, dims=(new_dimension_name, dimension),
+                        coords={new_dimension_name: list(dict.keys()), dimension: dimension_values})
+
+def _aggregate_by_membership_matrix(data,dimension,dict,new_dimension_name,weights,statistic,compiled=None):
+    """
+    Aggregate all keys of dict in one matrix product, see aggregate_by_dimension_dict.
+
+    With compiled groups (see definitions.compile_groups), their cached membership matrix is used.
+    """
+    if statistic not in ("sum", "mean", "share"):
+        raise ValueError(f"Unknown statistic {statistic!r}, expected 'sum', 'mean' or 'share'")
+    if compiled is None:
+        matrix = membership_matrix(data[dimension].values, dimension, dict, new_dimension_name)
+    else:
+        matrix = xr.DataArray(compiled.matrix, dims=(new_dimension_name, dimension),
+                              coords={new_dimension_name: compiled.keys, dimension: data[dimension].values})
+    if statistic == "share":
+        # one additional row with all values of the dimension gives the total in the same pass
+        total = xr.DataArray(np.ones((1, matrix.sizes[dimension]), dtype=matrix.dtype), dims=matrix.dims,
+                             coords={new_dimension_name: ["__total__"], dimension: matrix[dimension].values})
+        matrix = xr.concat([matrix, total], dim=new_dimension_name)
+    if weights is not None and set(weights.dims) <= {dimension}:
+        # weights only along the dimension can be folded into the (small) matrix
+        matrix = matrix * weights
+        weights = None
+
+    def aggregate(variable):
+        if dimension not in variable.dims:
+            # as xr.concat in the select method, broadcast along the new dimension
+            return variable.expand_dims({new_dimension_name: list(dict.keys())})
+        weighted = variable.fillna(0) if variable.dtype.kind in "fc" else variable
+        if weights is not None:
+            weighted = weighted * weights
+        result = xr.dot(weighted, matrix, dim=dimension)
+        if statistic == "mean":
+            present = variable.notnull()
+            result = result / xr.dot(present if weights is None else present * weights, matrix, dim=dimension)
+        elif statistic == "share":
+            result = result.drop_sel({new_dimension_name: "__total__"}) / result.sel({new_dimension_name: "__total__"}, drop=True)
+        return result.transpose(new_dimension_name, ...)
+
+    data = data.drop_vars([name for name, coord in data.coords.items()
+                           if dimension in coord.dims and name != dimension])
+    if isinstance(data, xr.Dataset):
+        return data.map(aggregate, keep_attrs=True)
+    return aggregate(data)
+
 def get_baseline_and_aggregates(data,baseline_date,dimension,dict,new_dimension_name=None, baseline_dimension_name="time"):
     """
     Aggregate and provide aggregated baseline.
@@ -73,3 +203,409 @@ def get_baseline_and_aggregates(data,baseline_date,dimension,dict,new_dimension_
     return baseline_aggregate, aggregates
 
 
+
+def get_baseline_deviation(data,baseline_date,dimension,dict,new_dimension_name=None, baseline_dimension_name="time",
+                           deviations=("relative", "absolute"), method="select", output_paths=None, **compute_kwargs):
+    """
+    Aggregate, provide the aggregated baseline and the deviation from it in one graph.
+
+    All results are derived from the same lazy aggregates, so computing them together (as done here when
+    output_paths is given, or with a single dask.compute of the returned results) reads the input once
+    instead of writing aggregates and baseline to NetCDF and re-reading them for the deviation.
+
+    Parameters
+    ----------
+    data : xarray.Dataset or xarray.DataArray
+        Data to aggregate.
+    baseline_date : str or datetime-like
+        Baseline date.
+    dimension : str
+        Dimension to aggregate on.
+    dict : dict
+        Dictionary with key-value pairs of dimension values to aggregate.
+    new_dimension_name : str, optional
+        Name of the new dimension, default is dimension+"_aggregate".
+    baseline_dimension_name : str, optional
+        Name of the baseline dimension, default is "time".
+    deviations : sequence of {"relative", "absolute"}, optional
+        Which deviations to compute: (aggregates - baseline) / baseline and aggregates - baseline.
+        Default is both.
+    method : {"select", "matrix"}, optional
+        Aggregation method, see aggregate_by_dimension_dict. Default is "select".
+    output_paths : dict, optional
+        Mapping of result names (see Returns) to NetCDF file paths. If given, these results are written
+        in one dask.compute and the function returns after writing. Default is None, i.e. nothing is written
+        and all results stay lazy.
+    **compute_kwargs
+        Keyword arguments passed to dask.compute when writing, e.g. num_workers.
+
+    Returns
+    -------
+    dict
+        The results "aggregates", "baseline_aggregates" and, as requested in deviations,
+        "relative_deviation" and "absolute_deviation". For a ragged ensemble (see
+        ensemble_data_combination.build_ragged_ensemble), the baseline aggregates are given per member.
+    """
+    unknown = set(deviations) - {"relative", "absolute"}
+    if unknown:
+        raise ValueError(f"Unknown deviations {sorted(unknown)}, expected 'relative' and/or 'absolute'")
+
+    aggregates = aggregate_by_dimension_dict(data,dimension,dict,new_dimension_name,method=method)
+    baseline_aggregate = datatransform.get_baseline_data(aggregates,baseline_date,dimension=baseline_dimension_name)
+    results = {"aggregates": aggregates, "baseline_aggregates": baseline_aggregate}
+    # ragged ensembles have one baseline per member, repeated along the samples of the member
+    baseline = (datatransform.broadcast_to_ragged(baseline_aggregate, aggregates)
+                if datatransform.is_ragged(aggregates, baseline_dimension_name) else baseline_aggregate)
+    if "absolute" in deviations or "relative" in deviations:
+        absolute_deviation = aggregates - baseline
+    if "relative" in deviations:
+        results["relative_deviation"] = absolute_deviation / baseline
+    if "absolute" in deviations:
+        results["absolute_deviation"] = absolute_deviation
+
+    if output_paths:
+        unknown = set(output_paths) - set(results)
+        if unknown:
+            raise KeyError(f"No results {sorted(unknown)} to write, available are {list(results)}")
+        dask.compute(*[results[name].to_netcdf(path, compute=False) for name, path in output_paths.items()],
+                     **compute_kwargs)
+    return results
+
+@cached
+def chunked_quantile(data,q,dim="time",method="exact",relative_error=0.01,bins=1024,split_every=8):
+    """
+    Compute quantiles along a dimension of chunked data with memory bounded per task.
+
+    With method="exact", dim is rechunked into a single chunk, with the other dimensions split (dask's 'auto'
+    chunks) so that the blocks stay within dask's array.chunk-size, and xarray's quantile is applied to every
+    block. Each task thus holds the whole dim for one block of the other dimensions. Reading the data with the
+    chunks planned for the operation ("quantile", [dim]) (see chunking.plan_chunks) makes the rechunk a no-op.
+
+    With method="approximate", dim is not rechunked and the data is read in a single pass. The values of every
+    chunk are counted per element in a logarithmic histogram of either sign (bins of relative width
+    2 * relative_error as in DDSketch, plus the zeros and infinite values), the histograms are merged
+    split_every at a time in a tree reduction, and the quantiles are read from the merged histogram. Every
+    chunk is released once it is counted, so memory is bounded by a few histograms of 2 * bins counts per
+    element, however long dim is. The error of a quantile is at most relative_error times the magnitude of
+    the order statistics it is interpolated from, for values down to ((1 + relative_error) / (1 -
+    relative_error))**-bins times the largest magnitude of their sign and element (about 1e-9 for the
+    defaults); smaller magnitudes are counted in the lowest bin.
+
+    Missing values are ignored. Data that is not backed by dask is passed to xarray's quantile.
+
+    Parameters
+    ----------
+    data : xarray.DataArray or xarray.Dataset
+        The data, typically chunked along dim.
+    q : float or sequence of float
+        Quantiles to compute, between 0 and 1.
+    dim : str, optional
+        The dimension to compute the quantiles along, default is "time".
+    method : {"exact", "approximate"}, optional
+        See above, default is "exact".
+    relative_error : float, optional
+        Maximal error relative to the magnitude of the values for method="approximate", default is 0.01.
+    bins : int, optional
+        Number of histogram bins per sign and element for method="approximate", default is 1024.
+    split_every : int, optional
+        Number of histograms merged per task for method="approximate", default is 8.
+
+    Returns
+    -------
+    xarray.DataArray or xarray.Dataset
+        The lazy quantiles, with a leading 'quantile' dimension if q is a sequence, as returned by xarray's
+        quantile.
+    """
+    if method not in ("exact", "approximate"):
+        raise ValueError(f"Unknown quantile method {method!r}, expected 'exact' or 'approximate'")
+    if not data.chunks:
+        return data.quantile(q, dim=dim)
+    if method == "exact":
+        if len(data.chunksizes[dim]) > 1:
+            data = data.chunk({dim: -1, **{other: "auto" for other in data.dims if other != dim}})
+        return data.quantile(q, dim=dim)
+    if isinstance(data, xr.Dataset):
+        return data.map(lambda variable: chunked_quantile.__wrapped__(variable, q, dim, method, relative_error, bins,
+                                                                      split_every)
+                        if dim in variable.dims else variable)
+    quantiles = np.atleast_1d(np.asarray(q, dtype=float))
+    if np.any((quantiles < 0) | (quantiles > 1)):
+        raise ValueError("Quantiles must be in the range [0, 1]")
+    if not 0 < relative_error < 1:
+        raise ValueError("relative_error must be between 0 and 1")
+
+    data = data.transpose(..., dim)
+    result = _sketch_quantile(data.data, quantiles, np.log((1 + relative_error) / (1 - relative_error)), bins,
+                              max(2, split_every))
+    coords = {name: coord for name, coord in data.coords.items() if dim not in coord.dims}
+    result = xr.DataArray(da.moveaxis(result, -1, 0), dims=("quantile",) + data.dims[:-1], coords=coords)
+    # set after construction, xarray takes the name of the dask array otherwise
+    result.name = data.name
+    result = result.assign_coords(quantile=quantiles)
+    return result.isel(quantile=0) if np.ndim(q) == 0 else result
+
+def ragged_reduce(data,statistic="mean",dim="time",member_dim="member"):
+    """
+    Reduce each member of a ragged ensemble over its own time steps.
+
+    The samples are rechunked so that every chunk holds whole members, and each chunk is reduced in one task
+    over the offsets of its members (with np.add.reduceat, np.fmin.reduceat or np.fmax.reduceat), so the
+    graph has one task per chunk however many members there are. Missing values are skipped as with xarray's
+    reductions, and var and std have ddof=0.
+
+    Parameters
+    ----------
+    data : xarray.DataArray or xarray.Dataset
+        Ragged ensemble data, see ensemble_data_combination.build_ragged_ensemble.
+    statistic : {"sum", "mean", "min", "max", "std", "var", "count"}, optional
+        The statistic to compute, default is "mean".
+    dim : str, optional
+        The ragged dimension, a coordinate along the sample dimension. Default is "time".
+    member_dim : str, optional
+        The member dimension, default is "member".
+
+    Returns
+    -------
+    xarray.DataArray or xarray.Dataset
+        The statistic along member_dim, with the coordinates of the members if data has them.
+    """
+    if statistic not in ("sum", "mean", "min", "max", "std", "var", "count"):
+        raise ValueError(f"Unknown statistic {statistic!r}")
+    return _ragged_apply(data, _ragged_reduce_block, dim, member_dim, statistic=statistic)
+
+
+def ragged_quantile(data,q,dim="time",member_dim="member"):
+    """
+    Compute quantiles over the time steps of each member of a ragged ensemble.
+
+    The samples are rechunked so that every chunk holds whole members, and in one task per chunk the members
+    are sorted within their segments (padded with NaN to the longest member of the chunk only), so memory per
+    task is bounded by the chunk and the graph does not grow with the number of members. The quantiles are
+    those of xarray's quantile (linear method, skipping missing values). The result stays lazy.
+
+    Parameters
+    ----------
+    data : xarray.DataArray or xarray.Dataset
+        Ragged ensemble data, see ensemble_data_combination.build_ragged_ensemble.
+    q : float or sequence of float
+        Quantiles to compute, between 0 and 1.
+    dim : str, optional
+        The ragged dimension, a coordinate along the sample dimension. Default is "time".
+    member_dim : str, optional
+        The member dimension, default is "member".
+
+    Returns
+    -------
+    xarray.DataArray or xarray.Dataset
+        The quantiles along member_dim, with a leading 'quantile' dimension if q is a sequence, and with the
+        coordinates of the members if data has them.
+    """
+    quantiles = np.atleast_1d(np.asarray(q, dtype=float))
+    if np.any((quantiles < 0) | (quantiles > 1)):
+        raise ValueError("Quantiles must be in the range [0, 1]")
+    result = _ragged_apply(data, _ragged_quantile_block, dim, member_dim, quantiles=quantiles)
+    result = result.transpose("quantile", ...).assign_coords(quantile=quantiles)
+    return result.isel(quantile=0) if np.ndim(q) == 0 else result
+
+
+def _ragged_apply(data, block_function, dim, member_dim, **kwargs):
+    """
+    Apply block_function to the member segments of every variable of a ragged ensemble along the samples.
+
+    block_function gets a block with the samples along the last axis and the offsets of the members within it,
+    and returns the block with the members along that axis, followed by one axis of quantiles if ``quantiles``
+    is given.
+    """
+    obs_dim = data[dim].dims[0]
+    starts = np.flatnonzero(data["step"].values == 0)
+    samples = data.drop_vars([name for name, coord in data.coords.items()
+                              if member_dim in coord.dims or obs_dim in coord.dims])
+
+    def apply(variable):
+        variable = variable.transpose(..., obs_dim)
+        result = _ragged_blocks(variable.data, starts, block_function, **kwargs)
+        dims = variable.dims[:-1] + (member_dim,) + (("quantile",) if "quantiles" in kwargs else ())
+        return xr.DataArray(result, dims=dims, coords=variable.coords, name=variable.name)
+
+    if isinstance(samples, xr.Dataset):
+        result = samples.map(lambda variable: apply(variable) if obs_dim in variable.dims else variable)
+    else:
+        result = apply(samples)
+    member_coords = {name: coord for name, coord in data.coords.items() if coord.dims == (member_dim,)}
+    return result.assign_coords(member_coords)
+
+def _ragged_blocks(values, starts, block_function, **kwargs):
+    """
+    Apply block_function in one blockwise pass over chunks of values holding whole members, see _ragged_apply.
+    """
+    if not isinstance(values, da.Array):
+        return block_function(values, starts, **kwargs)
+    # whole members per chunk, up to the largest chunk along the samples unless a single member is longer
+    lengths = np.diff(np.append(starts, values.shape[-1]))
+    target = max(values.chunks[-1])
+    sample_chunks, member_chunks = [], []
+    for length in lengths.tolist():
+        if member_chunks and sample_chunks[-1] + length <= target:
+            sample_chunks[-1] += length
+            member_chunks[-1] += 1
+        else:
+            sample_chunks.append(length)
+            member_chunks.append(1)
+    values = values.rechunk(values.chunks[:-1] + (tuple(sample_chunks),))
+    # the offsets of the members relative to the start of their chunk
+    chunk_starts = np.repeat(np.cumsum([0] + sample_chunks[:-1]), member_chunks)
+    offsets = da.from_array(starts - chunk_starts, chunks=(tuple(member_chunks),))
+    index = "".join(chr(ord("A") + i) for i in range(values.ndim - 1))
+    quantiles = kwargs.get("quantiles")
+    output_index = index + "o" + ("q" if quantiles is not None else "")
+    # the result type of a single member, as dask cannot infer it from empty blocks without members
+    dtype = block_function(np.zeros(1, dtype=values.dtype), np.zeros(1, dtype=np.intp), **kwargs).dtype
+    return da.blockwise(block_function, output_index, values, index + "o", offsets, "o",
+                        new_axes={"q": len(quantiles)} if quantiles is not None else None,
+                        adjust_chunks={"o": tuple(member_chunks)}, align_arrays=False, concatenate=True,
+                        dtype=dtype, meta=np.empty((0,) * len(output_index), dtype=dtype), **kwargs)
+
+def _ragged_reduce_block(block, starts, statistic):
+    """
+    The statistic of each member segment along the last axis of block, skipping missing values.
+    """
+    values = np.asarray(block)
+    valid = ~np.isnan(values) if np.issubdtype(values.dtype, np.inexact) else np.ones(values.shape, dtype=bool)
+    count = np.add.reduceat(valid, starts, axis=-1, dtype=np.int64)
+    if statistic == "count":
+        return count
+    if statistic in ("min", "max"):
+        return (np.fmin if statistic == "min" else np.fmax).reduceat(values, starts, axis=-1)
+    total = np.add.reduceat(np.where(valid, values, 0), starts, axis=-1)
+    if statistic == "sum":
+        return total
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = total / count
+        if statistic == "mean":
+            return mean
+        lengths = np.diff(np.append(starts, values.shape[-1]))
+        deviations = np.where(valid, values - np.repeat(mean, lengths, axis=-1), 0)
+        variance = np.add.reduceat(deviations ** 2, starts, axis=-1) / count
+    return variance if statistic == "var" else np.sqrt(variance)
+
+def _ragged_quantile_block(block, starts, quantiles):
+    """
+    The quantiles of each member segment along the last axis of block, in a trailing quantile axis.
+    """
+    values = np.asarray(block, dtype=np.float64)
+    lengths = np.diff(np.append(starts, values.shape[-1]))
+    # the segments as rows padded with NaN, which sorts the missing values and the padding last
+    members = np.repeat(np.arange(len(starts)), lengths)
+    steps = np.arange(values.shape[-1]) - np.repeat(starts, lengths)
+    padded = np.full(values.shape[:-1] + (len(starts), lengths.max(initial=0)), np.nan)
+    padded[..., members, steps] = values
+    padded.sort(axis=-1)
+    n = (~np.isnan(padded)).sum(axis=-1)
+    positions = np.maximum(n - 1, 0)[..., None] * quantiles
+    low = np.take_along_axis(padded, np.floor(positions).astype(np.intp), axis=-1)
+    high = np.take_along_axis(padded, np.ceil(positions).astype(np.intp), axis=-1)
+    fraction = positions - np.floor(positions)
+    # interpolated as numpy does, from the closer order statistic and keeping infinite values
+    with np.errstate(invalid="ignore"):
+        result = np.where(fraction >= 0.5, high - (high - low) * (1 - fraction), low + (high - low) * fraction)
+    result = np.where(low == high, low, result)
+    return np.where(n[..., None] > 0, result, np.nan)
+
+
+# columns of the histograms of _sketch_quantile, followed by the bins of the positive and the negative values
+_POSITIVE_OFFSET, _NEGATIVE_OFFSET, _ZEROS, _NEGATIVE_INFINITE, _POSITIVE_INFINITE, _BINS = range(6)
+
+def _sketch_quantile(values, quantiles, log_gamma, bins, split_every):
+    """
+    Quantiles along the last axis of a dask array from merged logarithmic histograms, see chunked_quantile.
+
+    Bin j of a sign holds the magnitudes in (gamma**(i - 1), gamma**i] with i = offset - j, where the offset is
+    the bin index of the largest magnitude of that sign and element, so histograms with different offsets are
+    merged by shifting their bins, collapsing those beyond the last bin into it.
+    """
+    index = "".join(chr(ord("A") + i) for i in range(values.ndim - 1))
+    axis = values.ndim - 1
+    sketches = da.blockwise(_sketch_block, index + "tw", values, index + "t", new_axes={"w": _BINS + 2 * bins},
+                            adjust_chunks={"t": 1}, dtype=np.float32, concatenate=True, log_gamma=log_gamma,
+                            bins=bins)
+    while sketches.numblocks[axis] > 1:
+        sketches = sketches.rechunk({axis: split_every})
+        sketches = da.blockwise(_merge_sketch_block, index + "tw", sketches, index + "tw", adjust_chunks={"t": 1},
+                                dtype=np.float32, bins=bins)
+    return da.blockwise(_sketch_quantile_block, index + "j", sketches, index + "tw",
+                        new_axes={"j": len(quantiles)}, dtype=np.float64, concatenate=True, quantiles=quantiles,
+                        log_gamma=log_gamma, bins=bins)
+
+def _sketch_block(block, log_gamma, bins):
+    """
+    The histogram of every element of block over its last axis, in a trailing axis after a new axis of one.
+    """
+    values = np.asarray(block, dtype=np.float64)
+    shape = values.shape[:-1]
+    values = values.reshape(-1, values.shape[-1])
+    n_elements = len(values)
+    sketch = np.zeros((n_elements, _BINS + 2 * bins), dtype=np.float32)
+    sketch[:, _ZEROS] = (values == 0).sum(axis=-1)
+    sketch[:, _NEGATIVE_INFINITE] = (values == -np.inf).sum(axis=-1)
+    sketch[:, _POSITIVE_INFINITE] = (values == np.inf).sum(axis=-1)
+    finite = np.isfinite(values) & (values != 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        indices = np.ceil(np.log(np.abs(values)) / log_gamma)
+    for offset_column, first, sign in ((_POSITIVE_OFFSET, _BINS, 1), (_NEGATIVE_OFFSET, _BINS + bins, -1)):
+        match = finite & (sign * values > 0)
+        offsets = np.max(np.where(match, indices, -np.inf), axis=-1)
+        relative = np.clip(offsets[:, None] - indices, 0, bins - 1)
+        targets = np.where(match, relative, 0).astype(np.intp) + (np.arange(n_elements) * bins)[:, None]
+        sketch[:, first:first + bins] = np.bincount(targets[match], minlength=n_elements * bins).reshape(
+            n_elements, bins)
+        sketch[:, offset_column] = np.where(np.isfinite(offsets), offsets, np.nan)
+    return sketch.reshape(shape + (1, -1))
+
+def _merge_sketch_block(block, bins):
+    """
+    Merge the histograms along the second to last axis of block into one.
+    """
+    sketches = block.reshape((-1,) + block.shape[-2:])
+    n_elements = len(sketches)
+    merged = np.zeros((n_elements, block.shape[-1]), dtype=np.float32)
+    merged[:, _ZEROS:_BINS] = sketches[:, :, _ZEROS:_BINS].sum(axis=1)
+    for offset_column, first in ((_POSITIVE_OFFSET, _BINS), (_NEGATIVE_OFFSET, _BINS + bins)):
+        offsets = sketches[:, :, offset_column]
+        # fmax ignores the missing offsets of histograms without values of that sign
+        merged_offsets = np.fmax.reduce(offsets, axis=1)
+        shifts = np.nan_to_num(merged_offsets[:, None] - offsets).astype(np.intp)
+        targets = (np.minimum(np.arange(bins) + shifts[..., None], bins - 1)
+                   + (np.arange(n_elements) * bins)[:, None, None])
+        merged[:, first:first + bins] = np.bincount(targets.ravel(), weights=sketches[:, :, first:first + bins].ravel(),
+                                                    minlength=n_elements * bins).reshape(n_elements, bins)
+        merged[:, offset_column] = merged_offsets
+    return merged.reshape(block.shape[:-2] + (1, -1))
+
+def _sketch_quantile_block(block, quantiles, log_gamma, bins):
+    """
+    The quantiles of a merged histogram, interpolated linearly between order statistics as xarray does.
+    """
+    sketch = np.asarray(block, dtype=np.float64)[..., 0, :]
+    # the middle of a bin in relative terms, whose relative distance to all magnitudes in the bin is at most
+    # relative_error
+    steps = -np.arange(bins)
+    with np.errstate(over="ignore", invalid="ignore"):
+        positive = np.exp((sketch[..., _POSITIVE_OFFSET, None] + steps[::-1]) * log_gamma) * 2 / (np.exp(log_gamma) + 1)
+        negative = -np.exp((sketch[..., _NEGATIVE_OFFSET, None] + steps) * log_gamma) * 2 / (np.exp(log_gamma) + 1)
+    ones = np.ones(sketch.shape[:-1] + (1,))
+    # the bins in ascending order of their values
+    counts = np.concatenate([sketch[..., _NEGATIVE_INFINITE, None], sketch[..., _BINS + bins:],
+                             sketch[..., _ZEROS, None], sketch[..., _BINS + bins - 1:_BINS - 1:-1],
+                             sketch[..., _POSITIVE_INFINITE, None]], axis=-1)
+    values = np.concatenate([-np.inf * ones, negative, 0 * ones, positive, np.inf * ones], axis=-1)
+    cumulative = np.cumsum(counts, axis=-1)
+    n = cumulative[..., -1]
+    positions = np.maximum(n - 1, 0)[..., None] * quantiles
+    low, high = (np.take_along_axis(values, np.minimum((cumulative[..., None, :] <= ranks[..., None]).sum(axis=-1),
+                                                       counts.shape[-1] - 1), axis=-1)
+                 for ranks in (np.floor(positions), np.ceil(positions)))
+    fraction = positions - np.floor(positions)
+    with np.errstate(invalid="ignore"):
+        result = np.where(fraction >= 0.5, high - (high - low) * (1 - fraction), low + (high - low) * fraction)
+    result = np.where(low == high, low, result)
+    return np.where(n[..., None] > 0, result, np.nan)
@@ -0,0 +1,237 @@
+''' Content-addressed cache for results of the analysis and transformation functions.
+
+Functions decorated with ``cached`` (e.g. data_transform.add_region_sector and
+analysis_functions.aggregate_by_dimension_dict) look up their result in the active cache directory, keyed
+on the function and the dask token of its arguments. For lazily opened data, the token covers the paths and
+modification times of the opened files, so changed input files give new keys; data that still records its
+source file (e.g. a single opened file, but not members combined with xr.combine_by_coords) additionally
+keys on the path, modification time and size of that file. Hits are opened lazily from the cached NetCDF
+file, in the chunks and under the dask names of the lazy result of the call, so that results derived from
+hits have the same keys as those derived from misses and repeated runs find them in the cache. Misses
+return the lazy result and queue its write to the cache, so that graphs stay lazy: pass cache_writes() to
+the dask.compute of the results to fill the cache in the same computation (as the pipeline does); writes
+still queued when leaving the context are computed then. Without an active cache, the decorated functions
+behave as if they were not decorated.
+
+Example
+-------
+>>> with result_cache("/p/tmp/me/acclimate-cache", max_bytes=50 * 2**30):
+...     data = datatransform.add_region_sector(ensemble_data)
+...     aggregates = analysis.aggregate_by_dimension_dict(data, "region", regions)
+...     dask.compute(aggregates.to_netcdf("aggregates.nc", compute=False), *cache_writes())
+'''
+import contextlib
+import contextvars
+import functools
+import hashlib
+import json
+import os
+import time
+import uuid
+import warnings
+
+import dask
+import dask.base
+import xarray as xr
+
+DEFAULT_CACHE_BYTES = 10 * 2**30
+
+_active_cache = contextvars.ContextVar("active_cache", default=None)
+
+
+@contextlib.contextmanager
+def result_cache(directory, max_bytes=DEFAULT_CACHE_BYTES):
+    """
+    Activate the result cache in a directory for the decorated functions called within the context.
+
+    Parameters
+    ----------
+    directory : str
+        The cache directory, created if it does not exist.
+    max_bytes : int, optional
+        Maximum total size of the cached files. The least recently used files are removed after each
+        write beyond this size. Default is DEFAULT_CACHE_BYTES.
+
+    Yields
+    ------
+    str
+        The cache directory.
+    """
+    os.makedirs(directory, exist_ok=True)
+    pending = {}
+    token = _active_cache.set((directory, max_bytes, pending))
+    try:
+        yield directory
+        writes = cache_writes()
+        if writes:
+            dask.compute(*writes)
+    finally:
+        _active_cache.reset(token)
+        # partial files of writes that were not computed, e.g. after an exception
+        for _, partial_path, _ in pending.values():
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(partial_path)
+
+
+def cache_writes():
+    """
+    Take the queued writes of cache misses in the active result cache.
+
+    Returns
+    -------
+    list of dask.delayed.Delayed
+        The writes, to be computed together with the results (e.g. in one dask.compute). Empty without an
+        active cache.
+    """
+    cache = _active_cache.get()
+    if cache is None:
+        return []
+    pending = cache[2]
+    writes = [write for _, _, write in pending.values()]
+    pending.clear()
+    return writes
+
+
+def cached(function):
+    """
+    Decorator caching the xarray results of a function in the active result cache (see result_cache).
+
+    Results other than xarray Datasets or DataArrays, and results that can not be written to NetCDF, are
+    returned without caching.
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        cache = _active_cache.get()
+        if cache is None:
+            return function(*args, **kwargs)
+        directory, max_bytes, pending = cache
+        key = cache_key(function, args, kwargs)
+        for suffix, open_cached in ((".ds.nc", xr.open_dataset), (".da.nc", xr.open_dataarray)):
+            path = os.path.join(directory, key + suffix)
+            if os.path.exists(path):
+                # only the access time records the use for evict, the cached file itself stays unchanged
+                os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+                if not any(_is_lazy(arg) for arg in list(args) + list(kwargs.values())):
+                    return open_cached(path).load()
+                return _reopen(open_cached(path), function(*args, **kwargs))
+        if key in pending:
+            return pending[key][0]
+
+        result = function(*args, **kwargs)
+        if not isinstance(result, (xr.Dataset, xr.DataArray)):
+            return result
+        path = os.path.join(directory, key + (".ds.nc" if isinstance(result, xr.Dataset) else ".da.nc"))
+        partial_path = "{}.{}.partial".format(path, uuid.uuid4().hex)
+        try:
+            write = result.to_netcdf(partial_path, compute=False)
+        except (ValueError, TypeError, NotImplementedError) as error:
+            warnings.warn("Result of {} could not be cached: {!r}".format(function.__qualname__, error), UserWarning)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(partial_path)
+            return result
+        pending[key] = (result, partial_path,
+                        dask.delayed(_store)(write, partial_path, path, directory, max_bytes))
+        return result
+    return wrapper
+
+
+def _is_lazy(data):
+    """
+    Whether data is an xarray Dataset or DataArray with dask-backed variables.
+    """
+    if not isinstance(data, (xr.Dataset, xr.DataArray)):
+        return False
+    variables = data.variables.values() if isinstance(data, xr.Dataset) else [data.variable] + list(
+        data.coords.variables.values())
+    return any(variable.chunks is not None for variable in variables)
+
+
+def _reopen(opened, result):
+    """
+    The cached data of a hit in place of the dask-backed variables of the lazy result of the call.
+
+    The variables keep the chunks and dask names of the lazy result, so that data derived from a hit has the
+    same token, and thus the same cache keys, as data derived from the computed result. Variables that are not
+    dask-backed are taken from the result as they are.
+    """
+    opened = opened.drop_encoding()
+
+    def replace(variable, cached):
+        if variable.chunks is None:
+            return variable
+        chunks = dict(zip(variable.dims, variable.chunks))
+        return variable.copy(data=cached.chunk(chunks, name=variable.data.name).data)
+
+    coords = {name: replace(coord.variable, opened.coords[name].variable)
+              for name, coord in result.coords.items() if name not in result.indexes}
+    if isinstance(result, xr.DataArray):
+        result = result.copy(data=replace(result.variable, opened.variable).data)
+    else:
+        result = result.assign({name: replace(variable.variable, opened[name].variable)
+                                for name, variable in result.data_vars.items()})
+    return result.assign_coords(coords)
+
+
+def _store(write, partial_path, path, directory, max_bytes):
+    """
+    Move a computed write into place in the cache directory and evict beyond max_bytes.
+    """
+    os.replace(partial_path, path)
+    evict(directory, max_bytes, keep=path)
+
+
+def cache_key(function, args, kwargs):
+    """
+    Key of a function call: hash of the function name, the input manifest of the xarray arguments and the
+    token of all arguments.
+    """
+    arguments = list(args) + list(kwargs.values())
+    manifest = sorted(set().union(*[input_manifest(arg) for arg in arguments
+                                    if isinstance(arg, (xr.Dataset, xr.DataArray))]))
+    description = json.dumps([function.__module__, function.__qualname__, manifest,
+                              dask.base.tokenize(args, kwargs)])
+    return hashlib.blake2b(description.encode(), digest_size=16).hexdigest()
+
+
+def input_manifest(data):
+    """
+    The source files of lazily opened data as (path, modification time, size).
+    """
+    variables = data.variables.values() if isinstance(data, xr.Dataset) else [data.variable] + list(
+        data.coords.variables.values())
+    manifest = set()
+    for source in [data.encoding.get("source")] + [variable.encoding.get("source") for variable in variables]:
+        if isinstance(source, str) and os.path.isfile(source):
+            stat = os.stat(source)
+            manifest.add((source, stat.st_mtime_ns, stat.st_size))
+    return manifest
+
+
+def evict(directory, max_bytes, keep=None):
+    """
+    Remove the least recently used cached results until the cache directory is at most max_bytes large.
+
+    The use of a result is its access time, set on every hit, or the time it was written. The file keep
+    (e.g. the result just written) is not removed.
+    """
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.is_file() and entry.name.endswith(".nc"):
+            stat = entry.stat()
+            entries.append((max(stat.st_atime_ns, stat.st_mtime_ns), stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+        total -= size
+
+
+def clear_cache(directory):
+    """
+    Remove all cached results from a cache directory.
+    """
+    evict(directory, 0)
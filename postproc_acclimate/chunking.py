@@ -0,0 +1,237 @@
+''' Chunking planner for Acclimate ensemble data (time x agent x ensemble parameters).
+
+Instead of opening everything with chunks='auto', the planner looks at the operations planned on the data
+and at the chunk shapes of the variables on disk. Each operation names the dimensions it needs complete
+within one chunk (e.g. a sum over regions needs all agents, xarray's quantile over time needs the whole time
+axis). Consecutive operations share chunks as long as all their complete dimensions fit into the target chunk
+size; only where they do not, a rechunk point is inserted. The remaining dimensions are chunked in multiples
+of their on-disk chunks, so every on-disk chunk is read by exactly one task.
+'''
+import collections
+
+import numpy as np
+
+TARGET_CHUNK_BYTES = 128 * 2**20
+
+# operations on data derived from the agent dimension need complete agents when reading
+DIMENSION_ALIASES = {"region": "agent", "sector": "agent"}
+
+# operations that work on chunked dimensions, such as analysis_functions.chunked_quantile with
+# method="approximate"
+STREAMING_OPERATIONS = {"chunked_quantile"}
+
+# regional aggregates over all agents, exact medians over the whole time axis
+DEFAULT_OPERATIONS = (("sum", ("region",)), ("quantile", ("time",)))
+
+ChunkPlan = collections.namedtuple("ChunkPlan", ["read_chunks", "rechunks"])
+ChunkPlan.__doc__ = """
+Chunks to read the data with, and the rechunk points as a dict of operation index to the chunks needed from
+that operation on.
+"""
+
+
+def disk_chunks(variable):
+    """
+    Get the on-disk chunk shape of a lazily opened variable.
+
+    Parameters
+    ----------
+    variable : xarray.Variable or xarray.DataArray
+        A variable opened without dask (chunks=None), so that its encoding describes the file.
+
+    Returns
+    -------
+    dict
+        Chunk size per dimension, from encoding["preferred_chunks"] or encoding["chunksizes"] (NetCDF4/HDF5),
+        or encoding["chunks"] (Zarr). Contiguous variables have a single chunk.
+    """
+    encoding = variable.encoding
+    chunks = dict(variable.sizes)
+    if encoding.get("preferred_chunks"):
+        chunks.update({dim: size for dim, size in encoding["preferred_chunks"].items() if dim in chunks})
+    elif encoding.get("chunksizes") or encoding.get("chunks"):
+        chunks.update(zip(variable.dims, encoding.get("chunksizes") or encoding.get("chunks")))
+    return chunks
+
+
+def plan_chunks(sizes, operations=DEFAULT_OPERATIONS, on_disk_chunks=None, itemsize=8,
+                target_bytes=TARGET_CHUNK_BYTES):
+    """
+    Plan read chunks and rechunk points for a sequence of operations.
+
+    Parameters
+    ----------
+    sizes : dict
+        Size per dimension of the data, e.g. dataset.sizes.
+    operations : sequence of (str, sequence of str), optional
+        The planned operations in order, as pairs of a name and the dimensions the operation reduces or groups
+        over, e.g. [("sum", ["region"]), ("quantile", ["time"])]. Operations in STREAMING_OPERATIONS do not
+        need complete dimensions, dimensions not in sizes but in DIMENSION_ALIASES are mapped to the dimension
+        they are derived from, and other dimensions not in sizes are ignored. Default is DEFAULT_OPERATIONS.
+    on_disk_chunks : dict, optional
+        Chunk size per dimension on disk (see disk_chunks). Default is one chunk per dimension.
+    itemsize : int, optional
+        Bytes per value, default is 8.
+    target_bytes : int, optional
+        Targeted size of a chunk in bytes, default is TARGET_CHUNK_BYTES.
+
+    Returns
+    -------
+    ChunkPlan
+        The chunks to read with and the rechunk points.
+    """
+    sizes = dict(sizes)
+    on_disk_chunks = {dim: min(int(on_disk_chunks.get(dim, size)), size) if on_disk_chunks else size
+                      for dim, size in sizes.items()}
+    budget = max(1, target_bytes // itemsize)
+
+    stages = []
+    for index, (name, dims) in enumerate(operations):
+        complete = _complete_dims(name, dims, sizes)
+        if stages and np.prod([sizes[dim] for dim in stages[-1][1] | complete]) <= budget:
+            stages[-1][1].update(complete)
+        elif stages and not complete:
+            continue
+        else:
+            stages.append((index, complete))
+    if not stages:
+        stages = [(0, set())]
+
+    stage_chunks = [_stage_chunks(sizes, complete, on_disk_chunks, budget) for _, complete in stages]
+    rechunks = {index: chunks for (index, _), chunks in zip(stages[1:], stage_chunks[1:])}
+    return ChunkPlan(stage_chunks[0], rechunks)
+
+
+def _complete_dims(name, dims, sizes):
+    """
+    The dimensions of sizes an operation needs complete within one chunk.
+    """
+    if name in STREAMING_OPERATIONS:
+        return set()
+    dims = [dims] if isinstance(dims, str) else dims
+    return {dim if dim in sizes else DIMENSION_ALIASES.get(dim, dim) for dim in dims} & set(sizes)
+
+
+def _stage_chunks(sizes, complete, on_disk_chunks, budget):
+    """
+    Chunks with the complete dimensions whole and the others in multiples of their on-disk chunks.
+
+    The innermost dimensions, which are contiguous on disk, are grown first.
+    """
+    chunks = {dim: sizes[dim] for dim in complete}
+    remaining = max(1, budget // int(np.prod(list(chunks.values()), dtype=np.int64)))
+    for dim in reversed(list(sizes)):
+        if dim in complete:
+            continue
+        unit = on_disk_chunks[dim] if on_disk_chunks[dim] <= remaining else 1
+        chunks[dim] = max(1, min(sizes[dim], unit * (remaining // unit)))
+        remaining = max(1, remaining // chunks[dim])
+    return {dim: chunks[dim] for dim in sizes}
+
+
+def plan_dataset_chunks(dataset, operations=DEFAULT_OPERATIONS, target_bytes=TARGET_CHUNK_BYTES):
+    """
+    Plan the chunks of a lazily opened dataset from its sizes and on-disk chunks.
+
+    Parameters
+    ----------
+    dataset : xarray.Dataset
+        The dataset, opened without dask (chunks=None).
+    operations : sequence of (str, sequence of str), optional
+        The planned operations, see plan_chunks.
+    target_bytes : int, optional
+        Targeted size of a chunk in bytes, default is TARGET_CHUNK_BYTES.
+
+    Returns
+    -------
+    ChunkPlan
+        The chunks to read with and the rechunk points.
+    """
+    on_disk_chunks = {}
+    for variable in dataset.data_vars.values():
+        for dim, size in disk_chunks(variable).items():
+            on_disk_chunks[dim] = max(on_disk_chunks.get(dim, 0), size)
+    itemsize = max([variable.dtype.itemsize for variable in dataset.data_vars.values()], default=8)
+    return plan_chunks(dataset.sizes, operations, on_disk_chunks, itemsize, target_bytes)
+
+
+def chunk_dataset(dataset, operations=DEFAULT_OPERATIONS, target_bytes=TARGET_CHUNK_BYTES, token=None):
+    """
+    Chunk a lazily opened dataset with the read chunks planned for the given operations.
+
+    Parameters
+    ----------
+    dataset : xarray.Dataset
+        The dataset, opened without dask (chunks=None).
+    operations : sequence of (str, sequence of str), optional
+        The planned operations, see plan_chunks.
+    target_bytes : int, optional
+        Targeted size of a chunk in bytes, default is TARGET_CHUNK_BYTES.
+    token : str, optional
+        Token identifying the opened data, e.g. from its file path and modification time as xarray's
+        open_dataset uses. The lazily indexed file arrays have no deterministic token of their own, so
+        without it the dask names (and the keys of cached results, see caching) differ between openings.
+
+    Returns
+    -------
+    xarray.Dataset
+        The dask-backed dataset.
+    """
+    return dataset.chunk(plan_dataset_chunks(dataset, operations, target_bytes).read_chunks, token=token)
+
+
+def rechunk_for_operation(data, plan, index):
+    """
+    Rechunk data if the plan has a rechunk point before the operation with the given index.
+
+    Parameters
+    ----------
+    data : xarray.Dataset or xarray.DataArray
+        The data the operation is applied to.
+    plan : ChunkPlan
+        The chunk plan, see plan_chunks.
+    index : int
+        The index of the operation in the planned operations.
+
+    Returns
+    -------
+    xarray.Dataset or xarray.DataArray
+        The data, rechunked if needed. Dimensions of the plan that the data does not have any more are skipped.
+    """
+    if index not in plan.rechunks:
+        return data
+    return data.chunk({dim: size for dim, size in plan.rechunks[index].items() if dim in data.dims})
+
+
+def chunk_for_operations(data, operations, target_bytes=TARGET_CHUNK_BYTES):
+    """
+    Rechunk data only if the next operation needs a dimension complete that is split into several chunks.
+
+    The new chunks are planned for the next and all following operations, with the current chunks taking the
+    place of the on-disk chunks, so that a single rechunk serves as many of the following operations as
+    possible.
+
+    Parameters
+    ----------
+    data : xarray.Dataset or xarray.DataArray
+        The dask-backed data the operations are applied to.
+    operations : sequence of (str, sequence of str)
+        The next operation followed by the further planned operations, see plan_chunks.
+    target_bytes : int, optional
+        Targeted size of a chunk in bytes, default is TARGET_CHUNK_BYTES.
+
+    Returns
+    -------
+    xarray.Dataset or xarray.DataArray
+        The data, rechunked if needed.
+    """
+    if not operations or not data.chunks:
+        return data
+    current = {dim: max(sizes) for dim, sizes in data.chunksizes.items()}
+    name, dims = operations[0]
+    if all(current.get(dim, size) == size for dim, size in data.sizes.items()
+           if dim in _complete_dims(name, dims, data.sizes)):
+        return data
+    variables = data.data_vars.values() if hasattr(data, "data_vars") else [data]
+    itemsize = max([variable.dtype.itemsize for variable in variables], default=8)
+    return data.chunk(plan_chunks(data.sizes, operations, current, itemsize, target_bytes).read_chunks)
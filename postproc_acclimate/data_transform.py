@@ -1,7 +1,12 @@
 ''' Methods for data transformation of xarray ensemble data.'''
 
+import numpy as np
+import pandas as pd
 import xarray as xr
 
+from postproc_acclimate import helpers
+from postproc_acclimate.caching import cached
+
 
 def get_baseline_data(data, baseline_date, dimension="time"):
     """
@@ -22,9 +27,96 @@ def get_baseline_data(data, baseline_date, dimension="time"):
         The baseline data corresponding to the given date along the specified dimension.
         
     """
+    if is_ragged(data, dimension):
+        return _ragged_baseline_data(data, baseline_date, dimension)
     return data.sel({dimension: baseline_date})
 
-def add_region_sector(data):
+
+def is_ragged(data, dimension="time"):
+    """
+    Check whether data is a ragged ensemble (see ensemble_data_combination.build_ragged_ensemble) along dimension.
+
+    Parameters
+    ----------
+    data : xarray.DataArray or xarray.Dataset
+        The data to check.
+    dimension : str, optional
+        The ragged dimension, which is then a coordinate along the sample dimension. Default is "time".
+
+    Returns
+    -------
+    bool
+        True if dimension is a coordinate but not a dimension of data, and data has the step coordinate.
+    """
+    return dimension not in data.dims and dimension in data.coords and "step" in data.coords
+
+
+def ragged_member_index(data, obs_dim="obs"):
+    """
+    Get the position of the member of each sample of a ragged ensemble.
+
+    The members start where the relative time step index (the step coordinate along the samples) is 0, so
+    that the positions are also known for DataArrays taken from the ragged dataset, which lose the
+    coordinates along the member dimension such as member_length.
+
+    Parameters
+    ----------
+    data : xarray.DataArray or xarray.Dataset
+        The ragged ensemble data with a step coordinate.
+    obs_dim : str, optional
+        The sample dimension, default is "obs".
+
+    Returns
+    -------
+    xarray.DataArray
+        The member positions along obs_dim.
+    """
+    return xr.DataArray(np.cumsum(data["step"].values == 0) - 1, dims=obs_dim)
+
+
+def broadcast_to_ragged(member_data, ragged, member_dim="member", obs_dim="obs"):
+    """
+    Repeat data given per member, such as baselines, along the samples of a ragged ensemble.
+
+    Parameters
+    ----------
+    member_data : xarray.DataArray or xarray.Dataset
+        Data along member_dim.
+    ragged : xarray.DataArray or xarray.Dataset
+        The ragged ensemble data with a step coordinate.
+    member_dim : str, optional
+        The member dimension, default is "member".
+    obs_dim : str, optional
+        The sample dimension, default is "obs".
+
+    Returns
+    -------
+    xarray.DataArray or xarray.Dataset
+        member_data along obs_dim, without the coordinates along members or samples, which are taken from
+        ragged in arithmetic with it.
+    """
+    broadcast = member_data.isel({member_dim: ragged_member_index(ragged, obs_dim)})
+    return broadcast.drop_vars([name for name, coord in broadcast.coords.items()
+                                if obs_dim in coord.dims or member_dim in coord.dims])
+
+
+def _ragged_baseline_data(data, baseline_date, dimension, member_dim="member"):
+    """
+    The baseline of every member of a ragged ensemble, NaN for members not reaching the baseline date.
+    """
+    obs_dim = data[dimension].dims[0]
+    times = data[dimension].values
+    matches = np.flatnonzero(times == np.asarray(baseline_date).astype(times.dtype))
+    member_index = ragged_member_index(data, obs_dim).values
+    positions = np.full(member_index[-1] + 1, -1)
+    positions[member_index[matches]] = matches
+    baseline = data.isel({obs_dim: xr.DataArray(np.maximum(positions, 0), dims=member_dim)})
+    if (positions < 0).any():
+        baseline = baseline.where(xr.DataArray(positions >= 0, dims=member_dim))
+    return baseline
+
+@cached
+def add_region_sector(data, chunks='auto'):
     """
     Adds 'sector' and 'region' coordinates to the input xarray DataArray based on the 'agent' dimension,
     and then groups the data by 'sector' and 'region', summing the values within each group.
@@ -34,6 +126,9 @@ def add_region_sector(data):
     data : xarray.DataArray
         The input data array which must have an 'agent' dimension. The 'agent' values should be strings
         formatted as 'sector:region'.
+    chunks : int, dict, 'auto' or None, optional
+        Chunks of the result (default is 'auto'), e.g. planned with postproc_acclimate.chunking. If None,
+        the chunks resulting from the transformation are kept.
 
     Returns
     -------
@@ -43,9 +138,15 @@ def add_region_sector(data):
 
     Notes
     -----
-    This function assumes that the 'agent' values in the input data array are strings formatted as
-    'sector:region'. The function splits these strings to create new 'sector' and 'region' coordinates,
-    and then groups and sums the data accordingly.
+    This function assumes that the 'agent' values in the input data array are strings
+    formatted as 'sector:region', or int32 agent codes (see
+    helpers.encode_agent_coordinate). Coded agents are split by integer division, and
+    the resulting sector and region coordinates are coded as well (with their labels in
+    the 'code_labels' attribute, see helpers.decode_coordinates). As every (sector,
+    region) pair usually belongs to exactly one agent, the agent axis is scattered into
+    a (sector, region) grid in one vectorized reshape (missing pairs are filled with
+    NaN), which keeps the dask graph small. Only if duplicate pairs occur, the data is
+    grouped and summed by 'sector' and 'region' instead.
 
     Examples
     --------
@@ -64,11 +165,43 @@ def add_region_sector(data):
       * sector   (sector) <U1 'A' 'B'
       * region   (region) <U1 '1' '2'
     """
-    if "agent" in data.dims:
-        sector = xr.DataArray([agent.split(":")[0] for agent in data.agent.values], dims="agent")
-        region = xr.DataArray([agent.split(":")[1] for agent in data.agent.values], dims="agent")
-        
-        data = data.assign_coords(sector=sector, region=region)
+    if "agent" not in data.dims:
+        return data if chunks is None else data.chunk(chunks)
+    table = helpers.coordinate_code_table(data, "agent")
+    if isinstance(table, helpers.AgentCodeTable):
+        sector, region = np.divmod(np.asarray(data.agent.values, dtype=np.int32), np.int32(len(table.regions)))
+        label_attrs = {"sector": {helpers.LABEL_CODE_ATTR: helpers.labels_attr(table.sectors)},
+                       "region": {helpers.LABEL_CODE_ATTR: helpers.labels_attr(table.regions)}}
+    else:
+        agents = np.asarray(data.agent.values, dtype=str)
+        sector, _, region = np.moveaxis(np.char.partition(agents, ":"), -1, 0)
+        label_attrs = {"sector": {}, "region": {}}
+    sectors, sector_index = np.unique(sector, return_inverse=True)
+    regions, region_index = np.unique(region, return_inverse=True)
+    grid_index = sector_index * len(regions) + region_index
+
+    if len(np.unique(grid_index)) < len(grid_index):
+        data = data.assign_coords(sector=("agent", sector), region=("agent", region))
         data_transformed = data.groupby("sector").map(lambda x: x.groupby("region").sum())
-    return data_transformed.chunk('auto')
+        for name, attrs in label_attrs.items():
+            data_transformed[name].attrs.update(attrs)
+        return data_transformed if chunks is None else data_transformed.chunk(chunks)
 
+    axis = data.dims.index("agent") if isinstance(data, xr.DataArray) else None
+    if len(grid_index) == len(sectors) * len(regions):
+        # complete grid: sorting the agents by grid index makes the unstack a pure reshape
+        data = data.isel(agent=np.argsort(grid_index))
+        grid = pd.MultiIndex.from_product([sectors, regions], names=["sector", "region"])
+    else:
+        # missing (sector, region) pairs are filled with NaN
+        grid = pd.MultiIndex(levels=[sectors, regions], codes=[sector_index, region_index],
+                             names=["sector", "region"])
+    data = data.drop_vars("agent")
+    data_transformed = data.assign_coords(xr.Coordinates.from_pandas_multiindex(grid, "agent")).unstack("agent")
+    data_transformed = data_transformed.assign_coords(sector=("sector", sectors, label_attrs["sector"]),
+                                                      region=("region", regions, label_attrs["region"]))
+    if axis is not None:
+        dims = list(data.dims)
+        dims[axis:axis + 1] = ["sector", "region"]
+        data_transformed = data_transformed.transpose(*dims)
+    return data_transformed if chunks is None else data_transformed.chunk(chunks)
@@ -1,8 +1,12 @@
 # TODO important definitions such as standard region sets
 # TODO: unify, maybe base on *.yml lists of individual regions for easier sharing and use outside of this codebase
 
+import collections
+import hashlib
+import threading
+import warnings
+
 import numpy as np
-from matplotlib.colors import LinearSegmentedColormap
 
 WORLD_REGIONS = {
     "AFR": [
@@ -531,14 +535,34 @@ pik_colors = map(lambda i: pik_color(
 
 
 def pik_color_list(n_of_elements, col_list=[pik_color('green'), pik_color('blue'), pik_color('orange')]):
+    from matplotlib.colors import LinearSegmentedColormap
     c_map = LinearSegmentedColormap.from_list('my_colors', col_list, N=n_of_elements)
     return [(c_map(1. * i / (n_of_elements - 1))) for i in np.arange(0, n_of_elements)]
 
 
-agent_colors = pik_color_list(5)
-import matplotlib.colors
+# agent_colors and agent_colors_list need matplotlib and are built on first access, see __getattr__
+def _agent_colors():
+    return pik_color_list(5)
+
+
+def _agent_colors_list():
+    import matplotlib.colors
+    return [matplotlib.colors.to_hex(i_color) for i_color in __getattr__("agent_colors")]
+
 
-agent_colors_list = [matplotlib.colors.to_hex(i_color) for i_color in agent_colors]
+_LAZY_DEFINITIONS = {"agent_colors": _agent_colors, "agent_colors_list": _agent_colors_list}
+
+
+def __getattr__(name):
+    """
+    Build the lazy definitions in _LAZY_DEFINITIONS on first access, so that importing this module does not
+    import matplotlib.
+    """
+    if name not in _LAZY_DEFINITIONS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = _LAZY_DEFINITIONS[name]()
+    globals()[name] = value
+    return value
 
 # define maps to map numerical dimensions back to keys
 region_names = ['AFG',
@@ -846,3 +870,88 @@ dose_sector_groups = {"Agriculture":["AGRI","FISH"]
     ,"Manufacture":["FOOD","ELWA","OILC","WOOD","TEXT","METL","MACH","TREQ","MANU","CONS","MINQ","RECY"]
     ,"Services":["EDHE","TRAN","COMM","RETT","WHOT","GAST","REXI","OTHERS","FINC","HOUS","ADMI","REPA"]}
 
+
+# registry of the region and sector groups above, compiled per coordinate with compile_groups
+REGION_GROUPS = {"WORLD_REGIONS": WORLD_REGIONS,
+                 "world_bank_income_groups": world_bank_income_groups,
+                 "world_bank_income_groups_chn_usa": world_bank_income_groups_chn_usa,
+                 "world_bank_region_groups": world_bank_region_groups}
+SECTOR_GROUPS = {"consumption_baskets": consumption_baskets,
+                 "dose_sector_groups": dose_sector_groups}
+GROUP_REGISTRY = {**REGION_GROUPS, **SECTOR_GROUPS}
+
+# maximum number of compiled (group, coordinate) pairs kept
+COMPILED_GROUPS_CACHE_SIZE = 64
+
+CompiledGroups = collections.namedtuple("CompiledGroups", ["keys", "indices", "matrix", "unknown"])
+CompiledGroups.__doc__ = """
+Groups compiled for one coordinate: the group keys, the positions of the members of each key in the
+coordinate (dict of key to integer array), the membership matrix (keys x coordinate values, 1 where a value
+belongs to a key) and the members of each key that are not in the coordinate (dict of key to list).
+"""
+
+_compiled_groups = collections.OrderedDict()
+_compiled_groups_lock = threading.Lock()
+
+
+def compile_groups(name, coordinate_values=None):
+    """
+    Compile a registered group dict for the values of a coordinate.
+
+    The index arrays and the membership matrix are built once per group and coordinate and cached, so
+    repeated aggregations over the same coordinate need no label lookups. Members of the groups that are not
+    values of the coordinate (e.g. 'CHI' or 'XKX', which are not EORA regions, or 'TEXT' and 'OTHERS', which
+    are not Acclimate sectors) are left out and reported in one warning when compiling.
+
+    Parameters
+    ----------
+    name : str
+        The name of the groups in GROUP_REGISTRY, e.g. "WORLD_REGIONS".
+    coordinate_values : array-like of str, optional
+        The labels of the coordinate, e.g. data["region"].values. Default is region_names for the groups in
+        REGION_GROUPS and sector_names for the groups in SECTOR_GROUPS.
+
+    Returns
+    -------
+    CompiledGroups
+        The compiled groups, with read-only arrays.
+    """
+    if name not in GROUP_REGISTRY:
+        raise KeyError(f"No groups {name!r} registered, registered are {sorted(GROUP_REGISTRY)}")
+    if coordinate_values is None:
+        coordinate_values = region_names if name in REGION_GROUPS else sector_names
+    coordinate_values = np.ascontiguousarray(coordinate_values, dtype=str)
+    key = (name, coordinate_values.dtype.str, coordinate_values.shape,
+           hashlib.blake2b(coordinate_values.tobytes(), digest_size=16).hexdigest())
+    with _compiled_groups_lock:
+        if key in _compiled_groups:
+            _compiled_groups.move_to_end(key)
+            return _compiled_groups[key]
+    compiled = _compile_groups(name, GROUP_REGISTRY[name], coordinate_values)
+    with _compiled_groups_lock:
+        _compiled_groups[key] = compiled
+        while len(_compiled_groups) > COMPILED_GROUPS_CACHE_SIZE:
+            _compiled_groups.popitem(last=False)
+    return compiled
+
+
+def _compile_groups(name, groups, coordinate_values):
+    """
+    Build the index arrays and the membership matrix of groups over coordinate_values, see compile_groups.
+    """
+    positions = {value: i for i, value in enumerate(coordinate_values.tolist())}
+    matrix = np.zeros((len(groups), len(coordinate_values)), dtype=np.int8)
+    indices = {}
+    unknown = {}
+    for row, (group, members) in enumerate(groups.items()):
+        found = [positions[member] for member in members if member in positions]
+        missing = [member for member in members if member not in positions]
+        indices[group] = np.asarray(sorted(set(found)), dtype=np.intp)
+        indices[group].setflags(write=False)
+        matrix[row, indices[group]] = 1
+        if missing:
+            unknown[group] = missing
+    matrix.setflags(write=False)
+    if unknown:
+        warnings.warn(f"Members of {name} not in the coordinate are left out: {unknown}", UserWarning)
+    return CompiledGroups(list(groups.keys()), indices, matrix, unknown)
@@ -1,12 +1,38 @@
 ''' Methods for data combination of gridded ensemble data using xarray.'''
+import concurrent.futures
+import contextlib
+import fnmatch
+import functools
+import itertools
+import json
 import os
+import re
+import sqlite3
+import threading
+import time
+import warnings
+import dask
+import dask.array
+import dask.base
+import numpy as np
+import pandas as pd
 import xarray as xr
-import glob
+import importlib.util
 
-from postproc_acclimate import definitions
+from postproc_acclimate import chunking, helpers
 
+# the netCDF4/HDF5 libraries are not thread-safe, so threads of one process open the files and read their metadata
+# one at a time (the data is read under the locks of xarray);
+# the completeness prescan of the loading functions therefore runs in processes unless an executor is given
+_NETCDF4_LOCK = threading.Lock()
 
-def load_ensemble_files(ensembledir, pattern, group_to_load=None, group_variables=None, filetype="*.nc", recursive=False):
+# outer-join merges whose result would be more than this many times larger than their inputs are reported
+MAX_PADDING_RATIO = 2.0
+
+
+def load_ensemble_files(ensembledir, pattern, group_to_load=None, group_variables=None, filetype="*.nc", recursive=False,
+                        executor="thread", max_workers=None, return_failures=False, manifest=None, refresh_manifest=True,
+                        chunks='auto', operations=chunking.DEFAULT_OPERATIONS, time_length=None, tail_steps=0):
     """
     Load NetCDF files from a directory based on a regex pattern.
     This function loads NetCDF files from a specified directory that match a given regex pattern,
@@ -27,11 +53,42 @@ def load_ensemble_files(ensembledir, pattern, group_to_load=None, group_variable
         The file type pattern to match (default is "*.nc").
     recursive : bool, optional
         Whether to search directories recursively (default is False).
+    executor : {"thread", "process"}, concurrent.futures.Executor or None, optional
+        How the files are opened and prepared concurrently (default is "thread"). See map_ensemble_files.
+        Use "process" or None if the installed netCDF4/HDF5 libraries are not thread-safe. The completeness
+        check of time_length and tail_steps runs with the same executor, or in a process pool if executor
+        is None.
+    max_workers : int, optional
+        Maximum number of workers of the thread or process pool. If None, the concurrent.futures default is used.
+    return_failures : bool, optional
+        Whether to also return the files that could not be loaded (default is False).
+    manifest : str, optional
+        Path to an ensemble manifest (see update_ensemble_manifest). If given, files and their parameters are
+        taken from the manifest instead of globbing the directory and parsing every filename.
+    refresh_manifest : bool, optional
+        Whether to update the manifest with new or changed files before loading (default is True). If False,
+        the manifest is used as is and the directory is not scanned at all.
+    chunks : int, dict, 'auto', 'plan' or None, optional
+        Chunks of the loaded datasets (default is 'auto'). With 'plan', the read chunks are planned for
+        ``operations`` from the on-disk chunks of each file, see chunking.plan_chunks.
+    operations : sequence of (str, sequence of str), optional
+        The operations planned on the data if chunks is 'plan' (default is chunking.DEFAULT_OPERATIONS).
+    time_length : int, optional
+        If given, members whose time dimension has a different length are excluded before opening them,
+        see check_ensemble_completeness.
+    tail_steps : int, optional
+        If larger than 0, members with all values missing in their last tail_steps time steps are excluded
+        before opening them (default is 0).
     
     Returns
     -------
     list of xarray.Dataset
-        A list of xarray objects to be merged with the appropriate xr.combine_by_coords, xr.merge, or xr.concat function.
+        A list of xarray objects to be merged with the appropriate xr.combine_by_coords, xr.merge, or xr.concat function,
+        in the same order as the matched files. Files that failed to load or are incomplete are left out and reported
+        with a warning.
+    dict
+        Only if return_failures is True: the exceptions raised for the files that could not be loaded, by file path.
+        Incomplete members are included with a ValueError stating the reason.
     
     Raises
     ------
@@ -40,49 +97,531 @@ def load_ensemble_files(ensembledir, pattern, group_to_load=None, group_variable
     IndexError
         If the files list is empty.
     """
-    if not recursive:
-        files = [f for f in glob.glob(os.path.join(ensembledir, filetype)) if pattern.match(os.path.basename(f))]
+    files, parameter_type_dict, file_parameters = find_ensemble_members(
+        ensembledir, pattern, filetype, recursive, manifest, refresh_manifest, group_to_load, executor, max_workers)
+    files, file_parameters, incomplete = _exclude_incomplete_members(
+        files, file_parameters, group_to_load, group_variables, time_length, tail_steps, executor, max_workers)
+
+    prepare_member = functools.partial(_prepare_ensemble_member, parameter_type_dict=parameter_type_dict,
+                                       group_to_load=group_to_load, group_variables=group_variables,
+                                       chunks=chunks, operations=operations)
+    data_to_merge, failures = map_ensemble_files(prepare_member, files, executor, max_workers, file_parameters)
+    if failures:
+        warnings.warn("{} of {} ensemble files could not be loaded: {}".format(
+            len(failures), len(files), "; ".join("{}: {!r}".format(f, error) for f, error in failures.items())), UserWarning)
+
+    if return_failures:
+        failures.update({f: ValueError(reason) for f, reason in incomplete.items()})
+        return data_to_merge, failures
+    return data_to_merge
+
+
+def _exclude_incomplete_members(files, file_parameters, group_to_load, group_variables, time_length, tail_steps,
+                                executor, max_workers):
+    """
+    Check the completeness of the ensemble files if requested, and warn about and leave out the incomplete ones.
+    """
+    if time_length is None and not tail_steps:
+        return files, file_parameters, {}
+    # a given executor is used as is, with the netCDF4 reads of threads serialized by _NETCDF4_LOCK
+    if executor is None:
+        executor = "process"
+    complete, incomplete = check_ensemble_completeness(files, group_to_load, group_variables, time_length, tail_steps,
+                                                       executor=executor, max_workers=max_workers)
+    if incomplete:
+        warnings.warn("{} of {} ensemble members are incomplete and left out: {}".format(
+            len(incomplete), len(files), "; ".join("{}: {}".format(f, reason) for f, reason in incomplete.items())),
+            UserWarning)
+    file_parameters = [params for f, params in zip(files, file_parameters) if f not in incomplete]
+    return complete, file_parameters, incomplete
+
+
+def find_ensemble_members(ensembledir, pattern, filetype="*.nc", recursive=False, manifest=None, refresh_manifest=True,
+                          group_to_load=None, executor="thread", max_workers=None):
+    """
+    Find the ensemble files and the typed parameters encoded in their filenames.
+
+    Parameters
+    ----------
+    ensembledir : str
+        The directory containing the ensemble files.
+    pattern : re.Pattern
+        A compiled regular expression pattern with named groups to match filenames.
+    filetype : str, optional
+        The file type pattern to match (default is "*.nc").
+    recursive : bool, optional
+        Whether to search directories recursively (default is False).
+    manifest : str, optional
+        Path to an ensemble manifest to take files and parameters from (see update_ensemble_manifest).
+    refresh_manifest : bool, optional
+        Whether to update the manifest before reading it (default is True).
+    group_to_load : str, optional
+        The group described in the manifest.
+    executor : {"thread", "process"}, concurrent.futures.Executor or None, optional
+        How new files are read when refreshing the manifest (default is "thread").
+    max_workers : int, optional
+        Maximum number of workers of the thread or process pool.
+
+    Returns
+    -------
+    list of str
+        The ensemble files.
+    dict
+        The parameter types by parameter name, in the order of the named groups of the pattern.
+    list of dict
+        The typed parameter values of each file.
+
+    Raises
+    ------
+    IndexError
+        If no files matched the pattern.
+    """
+    if manifest is not None:
+        if refresh_manifest:
+            update_ensemble_manifest(manifest, ensembledir, pattern, group_to_load, filetype, recursive, executor, max_workers)
+        manifest_data = read_ensemble_manifest(manifest)
+        files = list(manifest_data.index)
+        parameter_type_dict = manifest_data.attrs["parameter_types"]
+        file_parameters = manifest_data[list(parameter_type_dict)].to_dict("records")
     else:
-        files = [f for f in glob.glob(os.path.join(ensembledir, '**', filetype), recursive=True) if pattern.match(os.path.basename(f))]
+        files = find_pattern_files(ensembledir, pattern, filetype, recursive)
+        parameter_type_dict = get_parameter_types(pattern, files) if files else {}
+        file_parameters = [
+            {param: parameter_type_dict[param](value) for param, value in pattern.match(os.path.basename(f)).groupdict().items()}
+            for f in files
+        ]
     if not files:
         raise IndexError("No files matched the given pattern.")
-    
-    testmatch = pattern.match(os.path.basename(files[0]))
-    ensemble_parameters = testmatch.groupdict().keys()
-    
-    parameter_type_dict = get_parameter_types(pattern, files)
+    return files, parameter_type_dict, file_parameters
+
+
+def build_virtual_ensemble(ensembledir, pattern, group_to_load=None, group_variables=None, filetype="*.nc", recursive=False,
+                           manifest=None, refresh_manifest=True, member_chunks=None, fill_value=np.nan,
+                           operations=chunking.DEFAULT_OPERATIONS, store=None):
+    """
+    Build one lazy ensemble dataset over the full parameter grid without combining per-file datasets.
+
+    The parameter grid is computed from the filenames up front (all unique values of each parameter, sorted).
+    Each variable is then assembled as a single dask array whose blocks read the variable from the
+    corresponding member file, so there is no per-file expand_dims, no alignment in xr.combine_by_coords or
+    xr.merge, and the dask graph has one layer per variable instead of one per file. Grid cells without a
+    member file are filled with ``fill_value``.
+
+    All members need to share the non-parameter dimensions and coordinates of the first file, which are used
+    as a template. Incomplete members should be excluded beforehand. Agent names can be tidied once on the
+    result, e.g. with helpers.tidy_agents, as all members share the same agents.
+
+    Parameters
+    ----------
+    ensembledir : str
+        The directory containing the ensemble files.
+    pattern : re.Pattern
+        A compiled regular expression pattern with named groups to match filenames.
+    group_to_load : str, optional
+        The group within the NetCDF files to load. If None, the entire file is loaded.
+    group_variables : list of str, optional
+        The variables within the group to load. If None, all variables are loaded.
+    filetype : str, optional
+        The file type pattern to match (default is "*.nc").
+    recursive : bool, optional
+        Whether to search directories recursively (default is False).
+    manifest : str, optional
+        Path to an ensemble manifest to take files and parameters from (see update_ensemble_manifest).
+    refresh_manifest : bool, optional
+        Whether to update the manifest before reading it (default is True).
+    member_chunks : dict or 'plan', optional
+        Chunk sizes of the non-parameter dimensions within each member, e.g. {"time": 365}. With 'plan', they
+        are planned for ``operations`` from the on-disk chunks of the first file (see chunking.plan_chunks).
+        By default each member is read as a single block.
+    fill_value : scalar, optional
+        Value for grid cells without a member file (default is NaN).
+    operations : sequence of (str, sequence of str), optional
+        The operations planned on the data if member_chunks is 'plan' or a store is written (default is
+        chunking.DEFAULT_OPERATIONS).
+    store : str or MutableMapping, optional
+        If given, the ensemble is written to this new Zarr store (see write_ensemble_store) and the store
+        is returned, opened lazily.
+
+    Returns
+    -------
+    xarray.Dataset
+        The lazy ensemble dataset with the parameter dimensions first, followed by the member dimensions.
+    """
+    files, parameter_type_dict, file_parameters = find_ensemble_members(
+        ensembledir, pattern, filetype, recursive, manifest, refresh_manifest, group_to_load)
+    parameters = list(parameter_type_dict)
+    grid = {param: sorted(set(member[param] for member in file_parameters)) for param in parameters}
+    grid_index = {param: {value: i for i, value in enumerate(values)} for param, values in grid.items()}
+    member_files = {tuple(grid_index[param][member[param]] for param in parameters): f
+                    for f, member in zip(files, file_parameters)}
+    grid_shape = tuple(len(grid[param]) for param in parameters)
+    complete_grid = len(member_files) == int(np.prod(grid_shape))
+
+    template = open_ensemble_member(files[0], group_to_load, group_variables, chunks=None)
+    if isinstance(member_chunks, str) and member_chunks == "plan":
+        member_chunks = chunking.plan_dataset_chunks(template, operations).read_chunks
+    member_chunks = member_chunks or {}
+    token = dask.base.tokenize(files, group_to_load, group_variables, member_chunks, fill_value)
+
+    data_vars = {}
+    for var in template.data_vars:
+        variable = template[var].variable
+        dtype = variable.dtype if complete_grid else np.result_type(variable.dtype, np.asarray(fill_value).dtype)
+        inner_chunks = tuple(
+            dask.array.core.normalize_chunks(member_chunks.get(dim, -1), (size,))[0]
+            for dim, size in zip(variable.dims, variable.shape)
+        )
+        blocks = [
+            (block, tuple(slice(start, start + size) for start, size in block_slices))
+            for block, block_slices in zip(
+                itertools.product(*(range(len(c)) for c in inner_chunks)),
+                itertools.product(*(zip(np.cumsum((0,) + c[:-1]), c) for c in inner_chunks)))
+        ]
+        name = "virtual-ensemble-{}-{}".format(var, token)
+        graph = {}
+        for cell in itertools.product(*(range(n) for n in grid_shape)):
+            for block, index in blocks:
+                shape = (1,) * len(parameters) + tuple(s.stop - s.start for s in index)
+                graph[(name,) + cell + block] = (_read_member_block, member_files.get(cell), group_to_load, var, index,
+                                                 shape, dtype, fill_value)
+        array = dask.array.Array(dask.highlevelgraph.HighLevelGraph.from_collections(name, graph, dependencies=()),
+                                 name, chunks=tuple((1,) * n for n in grid_shape) + inner_chunks, dtype=dtype)
+        data_vars[var] = xr.Variable(parameters + list(variable.dims), array, attrs=variable.attrs)
+
+    coords = {param: xr.Variable(param, np.asarray(grid[param], dtype=parameter_type_dict[param]),
+                                 attrs={'standard_name': param}) for param in parameters}
+    coords.update({name: coord.variable.load() for name, coord in template.coords.items()})
+    template.close()
+    dataset = xr.Dataset(data_vars, coords=coords, attrs=template.attrs)
+    if store is not None:
+        write_ensemble_store(dataset, store, parameters, operations)
+        return open_ensemble_store(store)
+    return dataset
+
+
+def _read_member_block(file, group, variable, index, shape, dtype, fill_value):
+    """
+    Read a block of a variable from a member file, or create a filled block if there is no member file.
+    """
+    if file is None:
+        return np.full(shape, fill_value, dtype=dtype)
+    # the file handle is shared through xarray's file cache by all blocks of the member, so it is not closed here
+    with _NETCDF4_LOCK:
+        values = xr.open_dataset(file, group=group)[variable].variable[index].values
+    if values.size != int(np.prod(shape)):
+        raise ValueError("Member {} has a different shape than the first member of the ensemble for {}.".format(file, variable))
+    return values.astype(dtype, copy=False).reshape(shape)
+
+
+def find_pattern_files(ensembledir, pattern, filetype="*.nc", recursive=False):
+    """
+    Find the files in a directory whose basename matches a regex pattern.
+
+    Parameters
+    ----------
+    ensembledir : str
+        The directory containing the ensemble files.
+    pattern : re.Pattern
+        A compiled regular expression pattern to match filenames.
+    filetype : str, optional
+        The file type pattern to match (default is "*.nc").
+    recursive : bool, optional
+        Whether to search directories recursively (default is False).
+
+    Returns
+    -------
+    list of str
+        The matching file paths.
+    """
+    filetype_regex = re.compile(fnmatch.translate(filetype))
+    return [f for f in scan_directory(ensembledir, filetype_regex, recursive) if pattern.match(os.path.basename(f))]
+
+
+def scan_directory(basedir, filename_regex, recursive=True, exclude_dirs=None, max_workers=None):
+    """
+    Find the files below a directory whose names match a regex, scanning the directories concurrently.
 
-    data_to_merge = []
+    The directories are listed with os.scandir level by level, all directories of a level in a thread pool, so
+    that the latency of parallel file systems such as GPFS or Lustre is paid once per level instead of once per
+    directory. Directories matching exclude_dirs are not entered at all, and symbolic links to directories
+    are not followed.
+
+    Parameters
+    ----------
+    basedir : str
+        The directory to scan.
+    filename_regex : re.Pattern
+        A compiled regular expression the file names (without directory) have to match, e.g. compiled from
+        fnmatch.translate of a glob pattern.
+    recursive : bool, optional
+        Whether to scan subdirectories (default is True).
+    exclude_dirs : list of str, optional
+        Glob patterns of directory names not to scan, e.g. ["restart*", ".*"].
+    max_workers : int, optional
+        Maximum number of threads listing directories. If None, the concurrent.futures default is used.
+
+    Returns
+    -------
+    list of str
+        The paths of the matching files, in the order they were listed.
+    """
+    exclude_regex = re.compile("|".join(fnmatch.translate(pattern) for pattern in exclude_dirs)) if exclude_dirs else None
+    scan = functools.partial(_scan_single_directory, filename_regex=filename_regex, exclude_regex=exclude_regex)
+    files = []
+    pending = [basedir]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending:
+            subdirs = []
+            for directory_files, directory_subdirs in pool.map(scan, pending):
+                files.extend(directory_files)
+                subdirs.extend(directory_subdirs)
+            pending = subdirs if recursive else []
+    return files
+
+
+def _scan_single_directory(directory, filename_regex, exclude_regex=None):
+    """
+    List the matching files and the not excluded subdirectories of a directory, skipping unreadable ones as glob does.
+    """
+    files = []
+    subdirs = []
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if exclude_regex is None or not exclude_regex.match(entry.name):
+                            subdirs.append(entry.path)
+                    elif filename_regex.match(entry.name) and entry.is_file():
+                        files.append(entry.path)
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return files, subdirs
+
+
+def _prepare_ensemble_member(f, parameters, parameter_type_dict, group_to_load=None, group_variables=None, chunks='auto',
+                             operations=chunking.DEFAULT_OPERATIONS):
+    """
+    Open one ensemble file and add the parameters encoded in its filename as dimensions.
+    """
+    dataset = open_ensemble_member(f, group_to_load, group_variables, chunks, operations)
+
+    for i_param in parameter_type_dict:
+        dataset[i_param] = parameters[i_param]
+        dataset[i_param] = dataset[i_param].astype(parameter_type_dict[i_param])
+        dataset[i_param].attrs['standard_name'] = i_param
+    return dataset.set_coords(list(parameter_type_dict)).expand_dims(list(parameter_type_dict))
+
+
+def map_ensemble_files(function, files, executor="thread", max_workers=None, *iterables):
+    """
+    Apply a function to each ensemble file concurrently, collecting failures instead of stopping.
+
+    Parameters
+    ----------
+    function : callable
+        Function called with a file path and the corresponding items of ``iterables``. Has to be
+        picklable for a process pool.
+    files : list of str
+        The files to process.
+    executor : {"thread", "process"}, concurrent.futures.Executor or None, optional
+        "thread" (default) or "process" create a ThreadPoolExecutor or ProcessPoolExecutor for this call,
+        an existing Executor is used as is, and None processes the files sequentially.
+    max_workers : int, optional
+        Maximum number of workers of a newly created pool. With 1, "thread" and "process" process the files
+        sequentially; an existing Executor is used regardless.
+    *iterables : iterable
+        Further per-file arguments passed to ``function``, in the order of ``files``.
+
+    Returns
+    -------
+    list
+        The results for the files that were processed successfully, in the order of ``files``.
+    dict
+        The exceptions raised for the files that failed, by file path.
+    """
+    arguments = list(zip(files, *iterables))
+    results = {}
+    failures = {}
+
+    def run(submit):
+        futures = {args[0]: submit(function, *args) for args in arguments}
+        for f, future in futures.items():
+            try:
+                results[f] = future.result()
+            except Exception as error:  # pylint: disable=broad-except
+                failures[f] = error
+
+    if executor is None or (isinstance(executor, str) and max_workers == 1):
+        for args in arguments:
+            try:
+                results[args[0]] = function(*args)
+            except Exception as error:  # pylint: disable=broad-except
+                failures[args[0]] = error
+    elif isinstance(executor, concurrent.futures.Executor):
+        run(executor.submit)
+    else:
+        pools = {"thread": concurrent.futures.ThreadPoolExecutor, "process": concurrent.futures.ProcessPoolExecutor}
+        if executor not in pools:
+            raise ValueError("executor must be 'thread', 'process', None or a concurrent.futures.Executor, got {!r}".format(executor))
+        with pools[executor](max_workers=max_workers) as pool:
+            run(pool.submit)
+
+    return [results[f] for f in files if f in results], {f: failures[f] for f in files if f in failures}
+
+
+def check_ensemble_completeness(files, group_to_load=None, group_variables=None, time_length=None, tail_steps=1,
+                                time_dim="time", executor="process", max_workers=None):
+    """
+    Find incomplete ensemble members from the file metadata and the last time steps only, before opening any dataset.
+
+    A member is incomplete if its time dimension does not have time_length steps, or if all values of a variable
+    in its last tail_steps time steps are missing (NaN or fill values), as in runs that crashed after the output
+    file was created. Only the dimension sizes and the last time steps are read, with netCDF4 directly, so that
+    scanning large ensembles costs little more than listing them.
+
+    Parameters
+    ----------
+    files : list of str
+        The ensemble files.
+    group_to_load : str, optional
+        The group within the NetCDF files to check. If None, the root group is checked.
+    group_variables : list of str, optional
+        The variables to check the last time steps of. If None, all variables along the time dimension are checked.
+    time_length : int, optional
+        The expected length of the time dimension. If None, the length is not checked.
+    tail_steps : int, optional
+        Number of last time steps checked for missing values (default is 1). With 0, the values are not read.
+    time_dim : str, optional
+        Name of the time dimension (default is "time").
+    executor : {"thread", "process"}, concurrent.futures.Executor or None, optional
+        How the files are scanned concurrently (default is "process"), see map_ensemble_files. As the
+        netCDF4 library is not thread-safe, threads of one process read the files one after the other.
+    max_workers : int, optional
+        Maximum number of workers of the thread or process pool.
+
+    Returns
+    -------
+    list of str
+        The complete files, in the order of ``files``.
+    dict
+        The reason each incomplete or unreadable file was excluded, by file path.
+    """
+    check_member = functools.partial(_check_ensemble_member, group_to_load=group_to_load,
+                                     group_variables=group_variables, time_length=time_length,
+                                     tail_steps=tail_steps, time_dim=time_dim)
+    results, failures = map_ensemble_files(check_member, files, executor, max_workers)
+    checked = dict(zip([f for f in files if f not in failures], results))
+    incomplete = {}
     for f in files:
-        match = pattern.match(os.path.basename(f))
-        parameters = {param: match.group(param) for param in ensemble_parameters}
+        if f in failures:
+            incomplete[f] = "could not be read: {!r}".format(failures[f])
+        elif checked[f] is not None:
+            incomplete[f] = checked[f]
+    return [f for f in files if f not in incomplete], incomplete
+
+
+def _check_ensemble_member(f, group_to_load=None, group_variables=None, time_length=None, tail_steps=1,
+                           time_dim="time"):
+    """
+    The reason an ensemble file is incomplete, or None if it is complete.
+    """
+    import netCDF4
+
+    with _NETCDF4_LOCK, netCDF4.Dataset(f) as root:
+        group = root[group_to_load] if group_to_load else root
+        # dimensions of parent groups are visible in the group, as with inherited coordinates in a DataTree
+        dimension = next((node.dimensions[time_dim] for node in _group_ancestry(group)
+                          if time_dim in node.dimensions), None)
+        if dimension is None:
+            return "no {} dimension".format(time_dim)
+        length = len(dimension)
+        if time_length is not None and length != time_length:
+            return "{} length {} instead of {}".format(time_dim, length, time_length)
+        if not tail_steps or not length:
+            return None
+        names = group_variables if group_variables else [name for name, variable in group.variables.items()
+                                                         if time_dim in variable.dimensions]
+        for name in names:
+            variable = group.variables[name]
+            if time_dim not in variable.dimensions:
+                continue
+            tail = variable[tuple(slice(max(length - tail_steps, 0), None) if dim == time_dim else slice(None)
+                                  for dim in variable.dimensions)]
+            if not np.issubdtype(tail.dtype, np.number):
+                continue
+            values = np.ma.filled(np.ma.asarray(tail, dtype=float), np.nan)
+            if values.size and np.isnan(values).all():
+                return "{} missing in the last {} {} steps".format(name, min(tail_steps, length), time_dim)
+    return None
 
-        if group_to_load:
-            dataset = xr.open_datatree(f, chunks='auto')[group_to_load].to_dataset()
-            if group_variables:
-                dataset = dataset[group_variables]
-        else:
-            dataset = xr.open_dataset(f, chunks='auto')
-        
-        # Remove dimensions without variables occuring in DataTree
-        if group_to_load:
-            tmp_data = xr.open_datatree(f, chunks='auto')[group_to_load].to_dataset(inherit=False)
-            if group_variables:
-                remaining_dims = tmp_data[group_variables].dims
-            else:
-                remaining_dims = tmp_data.dims
-            for dim in dataset.dims:
-                if dim not in remaining_dims:
-                    dataset = dataset.drop_vars(dim)
-
-        for i_param in ensemble_parameters:
-            dataset[i_param] = parameters[i_param]
-            dataset[i_param] = dataset[i_param].astype(parameter_type_dict[i_param])
-            dataset[i_param].attrs['standard_name'] = i_param
-        dataset = dataset.set_coords(list(parameters.keys())).expand_dims(list(parameters.keys()))
-        data_to_merge.append(dataset)
-        
-    return data_to_merge
+
+def _group_ancestry(group):
+    """
+    A netCDF4 group followed by its parent groups up to the root group.
+    """
+    while group is not None:
+        yield group
+        group = group.parent
+
+
+def open_ensemble_member(file, group_to_load=None, group_variables=None, chunks='auto',
+                         operations=chunking.DEFAULT_OPERATIONS):
+    """
+    Open a single ensemble member file, reading the file only once.
+
+    If a group is given, the DataTree of the file is opened once and both the group's dataset (including
+    inherited coordinates) and the group's own dimensions are taken from this single handle. Inherited
+    coordinates of dimensions that are not used by the (selected) group variables are dropped.
+
+    Parameters
+    ----------
+    file : str
+        Path to the NetCDF file.
+    group_to_load : str, optional
+        The group within the NetCDF file to load. If None, the entire file is loaded.
+    group_variables : list of str, optional
+        The variables within the group to load. If None, all variables are loaded.
+    chunks : int, dict, 'auto', 'plan' or None, optional
+        Chunks passed to the xarray backend (default is 'auto'). With 'plan', the file is opened without dask
+        and chunked as planned for ``operations`` from its on-disk chunks (see chunking.chunk_dataset).
+    operations : sequence of (str, sequence of str), optional
+        The operations planned on the data if chunks is 'plan' (default is chunking.DEFAULT_OPERATIONS).
+
+    Returns
+    -------
+    xarray.Dataset
+        The lazily loaded dataset of the ensemble member.
+    """
+    if chunks == "plan":
+        return chunking.chunk_dataset(open_ensemble_member(file, group_to_load, group_variables, None), operations,
+                                      token=_file_token(file, group_to_load, group_variables))
+    if not group_to_load:
+        with _NETCDF4_LOCK:
+            return xr.open_dataset(file, chunks=chunks)
+
+    with _NETCDF4_LOCK:
+        node = xr.open_datatree(file, chunks=chunks)[group_to_load]
+    dataset = node.to_dataset()
+    own_data = node.to_dataset(inherit=False)
+    if group_variables:
+        dataset = dataset[group_variables]
+        own_data = own_data[group_variables]
+
+    # Remove dimensions without variables occuring in DataTree
+    remaining_dims = own_data.dims
+    unused_dims = [dim for dim in dataset.dims if dim not in remaining_dims]
+    return dataset.drop_vars(unused_dims)
+
+
+def _file_token(file, *args):
+    """
+    Token of data opened from a file, from its path and modification time like the tokens of xarray's
+    open_dataset, and the further arguments of the opening (e.g. the group and variables).
+    """
+    return dask.base.tokenize(file, os.path.getmtime(file), *args)
 
 
 def get_parameter_types(pattern, files):
@@ -126,14 +665,415 @@ def get_parameter_types(pattern, files):
     return parameter_types
 
 
+def update_ensemble_manifest(manifest, ensembledir, pattern, group_to_load=None, filetype="*.nc", recursive=False,
+                             executor="thread", max_workers=None, time_dim="time"):
+    """
+    Create or incrementally update an on-disk ensemble manifest.
+
+    The manifest is a SQLite database keyed by file path, storing modification time and size of each file
+    together with the parameters parsed from its filename, the dimension sizes, the length of the time
+    dimension and the variables of the (group of the) file. Only files that are new or whose modification
+    time or size changed are parsed and opened; entries of files that no longer exist are removed. If the
+    pattern or group differ from the ones the manifest was built with, it is rebuilt from scratch.
+
+    Parameters
+    ----------
+    manifest : str
+        Path to the SQLite manifest file. Created if it does not exist.
+    ensembledir : str
+        The directory containing the ensemble files.
+    pattern : re.Pattern
+        A compiled regular expression pattern with named groups to match filenames.
+    group_to_load : str, optional
+        The group within the NetCDF files to describe. If None, the root of the files is described.
+    filetype : str, optional
+        The file type pattern to match (default is "*.nc").
+    recursive : bool, optional
+        Whether to search directories recursively (default is False).
+    executor : {"thread", "process"}, concurrent.futures.Executor or None, optional
+        How new files are opened to read their metadata (default is "thread"). See map_ensemble_files.
+    max_workers : int, optional
+        Maximum number of workers of the thread or process pool.
+    time_dim : str, optional
+        Name of the time dimension whose length is recorded (default is "time").
+
+    Returns
+    -------
+    dict
+        Number of "added", "updated", "removed" and "unchanged" files.
+    """
+    settings = {"pattern": pattern.pattern, "group_to_load": group_to_load or ""}
+    files = find_pattern_files(ensembledir, pattern, filetype, recursive)
+    stats = {f: os.stat(f) for f in files}
+
+    with contextlib.closing(sqlite3.connect(manifest)) as connection, connection:
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, "
+            "parameters TEXT, dims TEXT, time_length INTEGER, variables TEXT)")
+        connection.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)")
+        stored_settings = dict(connection.execute("SELECT key, value FROM settings"))
+        if any(stored_settings.get(key) != value for key, value in settings.items()):
+            connection.execute("DELETE FROM files")
+            connection.execute("DELETE FROM settings")
+            connection.executemany("INSERT INTO settings VALUES (?, ?)", settings.items())
+            stored_settings = {}
+
+        known = {path: (mtime, size) for path, mtime, size in connection.execute("SELECT path, mtime, size FROM files")}
+        removed = [path for path in known if path not in stats]
+        changed = [f for f in files if known.get(f) != (stats[f].st_mtime, stats[f].st_size)]
+
+        if "parameter_types" not in stored_settings or not known:
+            parameter_types = get_parameter_types(pattern, files) if files else {}
+            connection.execute("INSERT OR REPLACE INTO settings VALUES (?, ?)", (
+                "parameter_types", json.dumps({param: dtype.__name__ for param, dtype in parameter_types.items()})))
+
+        describe = functools.partial(_describe_ensemble_file, group_to_load=group_to_load, time_dim=time_dim)
+        descriptions, failures = map_ensemble_files(describe, changed, executor, max_workers)
+        if failures:
+            warnings.warn("{} of {} new ensemble files could not be read: {}".format(
+                len(failures), len(changed), "; ".join("{}: {!r}".format(f, error) for f, error in failures.items())), UserWarning)
+        described_files = [f for f in changed if f not in failures]
+
+        connection.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in removed + list(failures)])
+        connection.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)", [
+            (f, stats[f].st_mtime, stats[f].st_size, json.dumps(pattern.match(os.path.basename(f)).groupdict()),
+             json.dumps(description["dims"]), description["time_length"], json.dumps(description["variables"]))
+            for f, description in zip(described_files, descriptions)
+        ])
+
+    n_updated = sum(f in known for f in described_files)
+    return {"added": len(described_files) - n_updated, "updated": n_updated, "removed": len(removed),
+            "unchanged": len(files) - len(changed)}
+
+
+def _describe_ensemble_file(f, group_to_load=None, time_dim="time"):
+    """
+    Read dimension sizes and variables of an ensemble file from its metadata only.
+    """
+    # close the file right away instead of leaving it to the garbage collector, which may run concurrently to
+    # opening other files in a worker thread
+    if group_to_load:
+        with xr.open_datatree(f) as tree:
+            dataset = tree[group_to_load].to_dataset(inherit=False)
+            dims = {dim: int(size) for dim, size in dataset.sizes.items()}
+            variables = list(dataset.data_vars)
+    else:
+        with xr.open_dataset(f) as dataset:
+            dims = {dim: int(size) for dim, size in dataset.sizes.items()}
+            variables = list(dataset.data_vars)
+    return {"dims": dims, "time_length": dims.get(time_dim), "variables": variables}
+
+
+def read_ensemble_manifest(manifest):
+    """
+    Read an ensemble manifest written by update_ensemble_manifest.
+
+    Parameters
+    ----------
+    manifest : str
+        Path to the SQLite manifest file.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per file, indexed by path, with columns for mtime, size, dims, time_length, variables and
+        one column per ensemble parameter holding the typed parameter values. The inferred parameter types
+        are available in ``attrs["parameter_types"]``.
+    """
+    if not os.path.exists(manifest):
+        raise FileNotFoundError("Ensemble manifest {} does not exist.".format(manifest))
+    with contextlib.closing(sqlite3.connect(manifest)) as connection:
+        rows = connection.execute(
+            "SELECT path, mtime, size, parameters, dims, time_length, variables FROM files ORDER BY path").fetchall()
+        settings = dict(connection.execute("SELECT key, value FROM settings"))
+
+    type_names = {"int": int, "float": float, "str": str}
+    parameter_types = {param: type_names[name] for param, name in json.loads(settings.get("parameter_types", "{}")).items()}
+    records = []
+    for path, mtime, size, parameters, dims, time_length, variables in rows:
+        record = {"path": path, "mtime": mtime, "size": size, "dims": json.loads(dims), "time_length": time_length,
+                  "variables": json.loads(variables)}
+        record.update({param: parameter_types[param](value) for param, value in json.loads(parameters).items()})
+        records.append(record)
+    columns = ["path", "mtime", "size", "dims", "time_length", "variables"] + list(parameter_types)
+    manifest_data = pd.DataFrame.from_records(records, columns=columns).set_index("path")
+    manifest_data.attrs["parameter_types"] = parameter_types
+    return manifest_data
+
+
+def write_ensemble_store(dataset, store, ensemble_dims=None, operations=chunking.DEFAULT_OPERATIONS, mode="w-",
+                         compute=True):
+    """
+    Write a combined ensemble dataset to a Zarr store with consolidated metadata.
+
+    Unlike a single NetCDF4 file, the chunks of a Zarr store are written in parallel by the dask workers.
+    The chunk layout is planned for the later analyses (see chunking.plan_chunks), with one chunk per
+    value of the ensemble dimensions so that members can be added or rewritten individually
+    (see append_ensemble_members).
+
+    Parameters
+    ----------
+    dataset : xarray.Dataset
+        The combined ensemble dataset, e.g. from xr.combine_by_coords of load_ensemble_files or
+        build_virtual_ensemble.
+    store : str or MutableMapping
+        Path or mapping of the Zarr store.
+    ensemble_dims : list of str, optional
+        The ensemble (parameter) dimensions. By default, the dimensions whose coordinate has a standard_name
+        equal to the dimension name, as set by load_ensemble_files and build_virtual_ensemble.
+    operations : sequence of (str, sequence of str), optional
+        The operations planned on the data (default is chunking.DEFAULT_OPERATIONS).
+    mode : str, optional
+        Write mode passed to xarray.Dataset.to_zarr (default is "w-", failing if the store exists).
+    compute : bool, optional
+        Whether to write immediately (default is True) or return a dask.delayed object.
+
+    Returns
+    -------
+    xarray.backends.ZarrStore or dask.delayed.Delayed
+        As returned by xarray.Dataset.to_zarr.
+    """
+    _require_zarr()
+    ensemble_dims = _ensemble_dims(dataset, ensemble_dims)
+    current = {dim: max(sizes) for dim, sizes in dataset.chunksizes.items()} if dataset.chunks else None
+    itemsize = max([variable.dtype.itemsize for variable in dataset.data_vars.values()], default=8)
+    chunks = chunking.plan_chunks(dataset.sizes, operations, current, itemsize).read_chunks
+    chunks.update({dim: 1 for dim in ensemble_dims})
+    dataset = dataset.drop_encoding().chunk(chunks)
+    return dataset.to_zarr(store, mode=mode, consolidated=True, compute=compute)
+
+
+def open_ensemble_store(store, chunks=None):
+    """
+    Open an ensemble Zarr store written by write_ensemble_store lazily.
+
+    Parameters
+    ----------
+    store : str or MutableMapping
+        Path or mapping of the Zarr store.
+    chunks : dict, optional
+        Chunks passed to xarray.open_zarr. Default is None, i.e. the chunks of the store.
+
+    Returns
+    -------
+    xarray.Dataset
+        The lazily loaded ensemble dataset.
+    """
+    _require_zarr()
+    return xr.open_zarr(store, consolidated=True, chunks={} if chunks is None else chunks)
+
+
+def append_ensemble_members(dataset, store, ensemble_dims=None, operations=chunking.DEFAULT_OPERATIONS, compute=True,
+                            grid=None):
+    """
+    Add ensemble members to a Zarr store without rewriting it.
+
+    The store covers a grid of ensemble (parameter) values, by default those of the members and those already
+    in the store; with ``grid``, e.g. the parameter values of all matched files of a running ensemble, it
+    covers these as well. If the store does not exist yet, it is created over the grid with
+    write_ensemble_store. New values are appended to the store one ensemble dimension at a time, with the
+    grid cells of the new values filled with NaN, so members may add values along several ensemble
+    dimensions at once. Every member is then written into its region of the store, replacing the stored
+    values. If the dataset has a boolean ``member_loaded`` variable over the ensemble dimensions (see
+    update_ensemble_store), only the members marked in it are written into the store, so the other members
+    in the store are left untouched.
+
+    Parameters
+    ----------
+    dataset : xarray.Dataset
+        The ensemble members to add, with the same variables and non-ensemble dimensions as the store.
+    store : str or MutableMapping
+        Path or mapping of the Zarr store.
+    ensemble_dims : list of str, optional
+        The ensemble (parameter) dimensions, by default detected as in write_ensemble_store.
+    operations : sequence of (str, sequence of str), optional
+        The operations planned on the data, used if the store is created.
+    compute : bool, optional
+        Whether to write immediately (default is True) or return dask.delayed objects. The store is grown
+        to the grid immediately in either case, as the regions of the members are written into it.
+    grid : dict, optional
+        Values of the ensemble dimensions the store covers in addition to those of the members, by
+        dimension. Values already in the store are kept.
+
+    Returns
+    -------
+    list
+        The results of the xarray.Dataset.to_zarr calls.
+    """
+    _require_zarr()
+    ensemble_dims = _ensemble_dims(dataset, ensemble_dims)
+    fill_value = {"member_loaded": False}
+    grid = {dim: pd.Index(dataset.indexes[dim]).union(pd.Index((grid or {}).get(dim, [])))
+            for dim in ensemble_dims}
+    dataset = dataset.drop_encoding()
+    if not (isinstance(store, (str, os.PathLike)) and os.path.exists(store)):
+        return [write_ensemble_store(dataset.reindex(grid, fill_value=fill_value), store, ensemble_dims, operations,
+                                     compute=compute)]
+
+    stored = open_ensemble_store(store)
+    store_chunks = {dim: 1 for dim in ensemble_dims}
+    for variable in stored.data_vars.values():
+        store_chunks.update({dim: max(sizes) for dim, sizes in zip(variable.dims, variable.chunks or ())
+                             if dim not in ensemble_dims})
+    # the new grid cells are appended filled, one dimension after the other, as a Zarr store grows along one
+    # dimension per write
+    indexes = {dim: stored.indexes[dim] for dim in ensemble_dims}
+    empty = dataset.isel({dim: slice(0, 0) for dim in ensemble_dims})
+    for dim in ensemble_dims:
+        new_values = grid[dim].difference(indexes[dim])
+        if not new_values.empty:
+            filled = empty.reindex({**indexes, dim: new_values}, fill_value=fill_value)
+            filled.chunk(store_chunks).to_zarr(store, append_dim=dim, consolidated=True)
+            indexes[dim] = indexes[dim].append(new_values)
+
+    writes = []
+    # every member is its own region, as the members need not be contiguous in the store
+    positions = {dim: indexes[dim].get_indexer(dataset[dim].values) for dim in ensemble_dims}
+    region_variables = [name for name, variable in dataset.data_vars.items() if set(ensemble_dims) <= set(variable.dims)]
+    loaded = dataset["member_loaded"].transpose(*ensemble_dims).values if "member_loaded" in dataset else None
+    for cell in itertools.product(*(range(dataset.sizes[dim]) for dim in ensemble_dims)):
+        if loaded is not None and not loaded[cell]:
+            continue
+        member = dataset[region_variables].isel({dim: slice(i, i + 1) for dim, i in zip(ensemble_dims, cell)})
+        region = {dim: slice(positions[dim][i], positions[dim][i] + 1) for dim, i in zip(ensemble_dims, cell)}
+        # coordinates are in the store already, and only variables along the region can be written
+        member = member.drop_vars(list(member.coords))
+        writes.append(member.chunk(store_chunks).to_zarr(store, region=region, consolidated=True, compute=compute))
+    return writes
+
+
+def update_ensemble_store(ensembledir, pattern, store, group_to_load=None, group_variables=None, filetype="*.nc",
+                          recursive=False, executor="thread", max_workers=None, manifest=None, preprocess=None,
+                          derived=None, chunks='auto', operations=chunking.DEFAULT_OPERATIONS, time_length=None,
+                          tail_steps=1):
+    """
+    Add only the newly finished ensemble members to a combined Zarr store.
+
+    The store keeps a boolean ``member_loaded`` variable over the ensemble (parameter) dimensions. Only the
+    files of members not marked in it are opened, combined and written into their regions of the store, which
+    covers the parameter values of all matched files (see append_ensemble_members), so updating the store
+    while an ensemble is still running costs time in the number of new members instead of the whole
+    ensemble. Derived results, e.g. regional aggregates per member, are computed for the new members only
+    and written to their own stores the same way. Members whose files changed after they were loaded are not
+    detected; rewrite the store for them.
+
+    Parameters
+    ----------
+    ensembledir : str
+        The directory containing the ensemble files.
+    pattern : re.Pattern
+        A compiled regular expression pattern with named groups to match filenames.
+    store : str
+        Path of the combined Zarr store, created if it does not exist.
+    group_to_load : str, optional
+        The group within the NetCDF files to load. If None, the entire file is loaded.
+    group_variables : list of str, optional
+        The variables within the group to load. If None, all variables are loaded.
+    filetype : str, optional
+        The file type pattern to match (default is "*.nc").
+    recursive : bool, optional
+        Whether to search directories recursively (default is False).
+    executor : {"thread", "process"}, concurrent.futures.Executor or None, optional
+        How the new files are opened concurrently (default is "thread"), see map_ensemble_files. Their
+        completeness is checked with the same executor, or in a process pool if executor is None.
+    max_workers : int, optional
+        Maximum number of workers of the thread or process pool.
+    manifest : str, optional
+        Path to an ensemble manifest to find the files with (see update_ensemble_manifest).
+    preprocess : callable, optional
+        Function applied to each new member dataset before combining, e.g. helpers.tidy_agents.
+    derived : dict, optional
+        Derived results to update, as a dict of name to (function, store path). The function gets the
+        combined new members and has to keep the ensemble dimensions, e.g.
+        ``lambda data: analysis.aggregate_by_dimension_dict(data, "agent", regions)``.
+    chunks : int, dict, 'auto', 'plan' or None, optional
+        Chunks to open the new files with (default is 'auto'), see open_ensemble_member.
+    operations : sequence of (str, sequence of str), optional
+        The operations planned on the data, for chunks='plan' and the chunk layout of new stores.
+    time_length : int, optional
+        If given, new members whose time dimension has a different length are not written yet.
+    tail_steps : int, optional
+        New members with all values missing in their last tail_steps time steps, i.e. runs that are still
+        running or crashed, are not written yet (default is 1). See check_ensemble_completeness.
+
+    Returns
+    -------
+    dict
+        Report with the newly written files ("new"), the number of members already in the store
+        ("existing"), the files that could not be loaded ("failures", exceptions by path) and the incomplete
+        members left for a later update ("incomplete", reasons by path).
+    """
+    files, parameter_type_dict, file_parameters = find_ensemble_members(
+        ensembledir, pattern, filetype, recursive, manifest, True, group_to_load, executor, max_workers)
+    parameters = list(parameter_type_dict)
+
+    loaded = set()
+    if os.path.exists(store):
+        stored = open_ensemble_store(store)
+        if "member_loaded" in stored:
+            flags = stored["member_loaded"].transpose(*parameters).values
+            loaded = {tuple(stored.indexes[param][i] for param, i in zip(parameters, index))
+                      for index in zip(*np.nonzero(flags))}
+    new_members = [(f, params) for f, params in zip(files, file_parameters)
+                   if tuple(params[param] for param in parameters) not in loaded]
+    report = {"new": [], "existing": len(files) - len(new_members), "failures": {}, "incomplete": {}}
+    if not new_members:
+        return report
+    new_files, new_parameters, report["incomplete"] = _exclude_incomplete_members(
+        [f for f, _ in new_members], [params for _, params in new_members], group_to_load, group_variables,
+        time_length, tail_steps, executor, max_workers)
+
+    prepare_member = functools.partial(_prepare_ensemble_member, parameter_type_dict=parameter_type_dict,
+                                       group_to_load=group_to_load, group_variables=group_variables,
+                                       chunks=chunks, operations=operations)
+    members, failures = map_ensemble_files(prepare_member, new_files, executor, max_workers, new_parameters)
+    report["failures"] = failures
+    report["new"] = [f for f in new_files if f not in failures]
+    if not members:
+        return report
+    if preprocess is not None:
+        members = [preprocess(member) for member in members]
+    loaded_flag = xr.DataArray(np.ones((1,) * len(parameters), dtype=bool), dims=parameters)
+    dataset = xr.combine_by_coords([member.assign(member_loaded=loaded_flag) for member in members], join="outer")
+    dataset["member_loaded"] = dataset["member_loaded"].fillna(False).astype(bool)
+
+    # the stores cover the parameter values of all matched files, also of the members not written yet
+    grid = {param: sorted(set(params[param] for params in file_parameters)) for param in parameters}
+    append_ensemble_members(dataset, store, parameters, operations, grid=grid)
+    for function, derived_store in (derived or {}).values():
+        result = function(dataset).assign(member_loaded=dataset["member_loaded"])
+        append_ensemble_members(result, derived_store, parameters, operations, grid=grid)
+    return report
+
+
+def _ensemble_dims(dataset, ensemble_dims=None):
+    """
+    The given ensemble dimensions, or those marked by a standard_name equal to the dimension name.
+    """
+    if ensemble_dims is not None:
+        return list(ensemble_dims)
+    return [dim for dim in dataset.dims if dim in dataset.coords and dataset[dim].attrs.get("standard_name") == dim]
+
+
+def _require_zarr():
+    """
+    Raise an ImportError if the optional zarr package is not installed.
+    """
+    if importlib.util.find_spec("zarr") is None:
+        raise ImportError("Writing and reading ensemble stores requires the optional zarr package.")
+
+
 #TODO: consider what to keep of this specialised pipeline for model - scenario - timeperiod data
-def find_ensemble_files(basedir, scenario_prefix="ssp", scenario_globpattern="[0-9][0-9][0-9]", time_globterm="[0-9][0-9][0-9][0-9]-[0-9][0-9][0-9][0-9]", modellist=None, recursive=True):
+def find_ensemble_files(basedir, scenario_prefix="ssp", scenario_globpattern="[0-9][0-9][0-9]", time_globterm="[0-9][0-9][0-9][0-9]-[0-9][0-9][0-9][0-9]", modellist=None, recursive=True, exclude_dirs=None, max_workers=None, verbose=False):
     
     """
     Find and organize ensemble files based on specified patterns.
     This function searches for NetCDF files in the given base directory that match
     the specified scenario and time period patterns. It organizes the found files into
     a nested dictionary structure based on model, scenario, and time period.
+    The directories are scanned concurrently (see scan_directory) and the file names are matched with a single
+    regular expression compiled from the glob patterns. Files without one of the models followed by a time
+    period in their path are skipped.
     Args:
         basedir (str): The base directory to search for files.
         scenario_prefix (str, optional): The prefix for the scenario. Defaults to "ssp".
@@ -141,6 +1081,9 @@ def find_ensemble_files(basedir, scenario_prefix="ssp", scenario_globpattern="[0
         time_globterm (str, optional): The glob pattern for time period. Defaults to "[0-9][0-9][0-9][0-9]-[0-9][0-9][0-9][0-9]".
         modellist (list, optional): List of model names to search for. Defaults to None, which uses a standard list of models.
         recursive (bool, optional): Whether to search directories recursively. Defaults to True.
+        exclude_dirs (list of str, optional): Glob patterns of directory names not to search, e.g. ["restart*"]. Defaults to None.
+        max_workers (int, optional): Maximum number of threads scanning directories. Defaults to None.
+        verbose (bool, optional): Whether to print the number of files found and the time the scan took. Defaults to False.
     Returns:
         dict: A nested dictionary where the keys are model names, scenarios, and time periods,
               and the values are lists of file paths matching the criteria.
@@ -150,70 +1093,137 @@ def find_ensemble_files(basedir, scenario_prefix="ssp", scenario_globpattern="[0
 
     scenario_globterm = scenario_prefix + scenario_globpattern
     globterm = "*".join(["", time_globterm, scenario_globterm, ".nc"])
-    outputfiles = glob.glob(basedir + '**' + globterm, recursive=recursive)
+    start_time = time.perf_counter()
+    outputfiles = scan_directory(basedir, re.compile(fnmatch.translate(globterm)), recursive, exclude_dirs, max_workers)
+
+    # the models in the order of modellist, as the first model of the list found in the path is used
+    model_regex = re.compile("|".join("(?P<model{}>{})-(?P<timeperiod{}>20.{{7}})".format(i, re.escape(model), i)
+                                      for i, model in enumerate(modellist)))
+    scenario_regex = re.compile(re.escape(scenario_prefix) + "(.{0,3})")
+    model_priority = {model: i for i, model in enumerate(modellist)}
 
     datadict = {}
     for file in outputfiles:
-        model = next((model for model in modellist if model in file), None)
-        scenario = scenario_prefix + file.split(scenario_prefix)[1][:3]
-        timeperiod = "20" + file.split(model + "-20")[1][:7]  # TODO: generalise
-
-        if model not in datadict:
-            datadict[model] = {}
-        if scenario not in datadict[model]:
-            datadict[model][scenario] = {}
-        if timeperiod not in datadict[model][scenario]:
-            datadict[model][scenario][timeperiod] = []
-        datadict[model][scenario][timeperiod].append(file)
-    
+        matches = list(model_regex.finditer(file))
+        if not matches:
+            continue
+        match = min(matches, key=lambda match: model_priority[_matched_model(match, modellist)])
+        model = _matched_model(match, modellist)
+        timeperiod = match.group("timeperiod{}".format(model_priority[model]))
+        scenario = scenario_prefix + scenario_regex.search(file).group(1)
+        datadict.setdefault(model, {}).setdefault(scenario, {}).setdefault(timeperiod, []).append(file)
+
+    if verbose:
+        print("Found {} ensemble files in {:.1f} s".format(len(outputfiles), time.perf_counter() - start_time), flush=True)
     return datadict
 
 
-def process_datadict_to_datatree(datadict, group_selection, group_variables, data_agent_converter=None):
+def _matched_model(match, modellist):
+    """
+    The model of a match of the model regex of find_ensemble_files.
+    """
+    return modellist[int(match.lastgroup[len("timeperiod"):])]
+
+
+def process_datadict_to_datatree(datadict, group_selection, group_variables, data_agent_converter=None, chunks='auto',
+                                 operations=chunking.DEFAULT_OPERATIONS, executor="thread", max_workers=None,
+                                 return_report=False):
     """
     Process a datadict of grouped netcdf files to create a nested DataTree structure.
+
+    The files are opened and their groups extracted concurrently, and the data stays dask-backed, so that only
+    metadata is read while building the tree. Time periods with several files and files that could not be
+    processed are left out of the tree and reported with a warning.
     
     Args:
         datadict (dict): The nested dictionary of file paths organized by model, scenario, and time period.
         group_selection (list): List of groups to select from the raw output.
         group_variables (dict): Dictionary specifying variables to keep for each group.
-        data_agent_converter (function, optional): Function to convert raw output data agent dimension. Defaults to None.
+        data_agent_converter (function, optional): Function to convert raw output data agent dimension. Has to be picklable for a process pool. Defaults to None.
+        chunks (int, dict, 'auto', 'plan' or None, optional): Chunks to open the files with. With 'plan', each group is chunked as planned for operations from its on-disk chunks (see chunking.plan_chunks), with None the data is not dask-backed. Defaults to 'auto'.
+        operations (sequence of (str, sequence of str), optional): The operations planned on the data if chunks is 'plan'. Defaults to chunking.DEFAULT_OPERATIONS.
+        executor ({"thread", "process"}, concurrent.futures.Executor or None, optional): How the files are processed concurrently, see map_ensemble_files. Defaults to "thread".
+        max_workers (int, optional): Maximum number of workers of the thread or process pool. Defaults to None.
+        return_report (bool, optional): Whether to also return the report of left out files. Defaults to False.
     
     Returns:
         xr.DataTree: A nested DataTree structure containing the processed data.
+        dict: Only if return_report is True: the files of time periods with several files by (model, scenario,
+              timeperiod) as "duplicates", and the exceptions raised for files that could not be processed by
+              file path as "failures".
     """
-    def process_file(file):
-        raw_output = xr.open_datatree(file)
-        output_dict = {}
-        for group in group_selection:
-            output_dict[group] = raw_output[group].to_dataset()
-            if group_variables[group] != "ALL":
-                output_dict[group] = output_dict[group][group_variables[group]]
-            if "agent" in raw_output[group].dims and data_agent_converter:
-                #new agent names
-                new_agent_names = data_agent_converter(output_dict[group])
-                #change agent names
-                output_dict[group] = output_dict[group].assign_coords(agent=new_agent_names)
-            if group_variables[group] != "ALL":
-                remaining_dims = raw_output[group].to_dataset(inherit=False)[group_variables[group]].dims
-            else:
-                remaining_dims = raw_output[group].to_dataset(inherit=False).dims
-            for dim in output_dict[group].dims:
-                if dim not in remaining_dims:
-                    output_dict[group] = output_dict[group].drop_vars(dim)
-        return output_dict
+    leaves = {}
+    duplicates = {}
+    for model, modeldict in datadict.items():
+        for scenario, scenariodict in modeldict.items():
+            for timeperiod, files in scenariodict.items():
+                if len(files) == 1:
+                    leaves[(model, scenario, timeperiod)] = files[0]
+                else:
+                    duplicates[(model, scenario, timeperiod)] = list(files)
 
-    model_dict = {model: xr.DataTree.from_dict({
-        scenario: xr.DataTree.from_dict({
-            timeperiod: xr.DataTree.from_dict(process_file(files[0])) if len(files) == 1 else print(
-                "Warning: multiple files found for model", model, "scenario", scenario, "timeperiod", timeperiod)
-            for timeperiod, files in scenariodict.items()
-        }) for scenario, scenariodict in modeldict.items()
-    }) for model, modeldict in datadict.items()}
+    process_file = functools.partial(_process_ensemble_file, group_selection=group_selection,
+                                     group_variables=group_variables, data_agent_converter=data_agent_converter,
+                                     chunks=chunks, operations=operations)
+    files = list(leaves.values())
+    processed, failures = map_ensemble_files(process_file, files, executor, max_workers)
+    processed = dict(zip([f for f in files if f not in failures], processed))
 
-    return xr.DataTree.from_dict(model_dict)
+    if duplicates:
+        warnings.warn("Several files found for {} time periods, which are left out: {}".format(
+            len(duplicates), "; ".join("{}: {}".format("/".join(key), files) for key, files in duplicates.items())),
+            UserWarning)
+    if failures:
+        warnings.warn("{} of {} ensemble files could not be processed: {}".format(
+            len(failures), len(files), "; ".join("{}: {!r}".format(f, error) for f, error in failures.items())),
+            UserWarning)
 
-def process_datadict_to_datasets(datadict, variable_selection=None):
+    model_dict = {}
+    for (model, scenario, timeperiod), file in leaves.items():
+        if file in processed:
+            model_dict.setdefault(model, {}).setdefault(scenario, {})[timeperiod] = xr.DataTree.from_dict(
+                processed[file])
+    datatree = xr.DataTree.from_dict({
+        model: xr.DataTree.from_dict({
+            scenario: xr.DataTree.from_dict(timeperioddict) for scenario, timeperioddict in scenariodict.items()
+        }) for model, scenariodict in model_dict.items()})
+
+    if return_report:
+        return datatree, {"duplicates": duplicates, "failures": failures}
+    return datatree
+
+
+def _process_ensemble_file(file, group_selection, group_variables, data_agent_converter=None, chunks='auto',
+                           operations=chunking.DEFAULT_OPERATIONS):
+    """
+    Open a grouped ensemble file and extract the selected groups and variables as datasets by group.
+    """
+    with _NETCDF4_LOCK:
+        raw_output = xr.open_datatree(file, chunks=None if chunks == "plan" else chunks)
+    output_dict = {}
+    for group in group_selection:
+        output_dict[group] = raw_output[group].to_dataset()
+        if group_variables[group] != "ALL":
+            output_dict[group] = output_dict[group][group_variables[group]]
+        if "agent" in raw_output[group].dims and data_agent_converter:
+            #new agent names
+            new_agent_names = data_agent_converter(output_dict[group])
+            #change agent names
+            output_dict[group] = output_dict[group].assign_coords(agent=new_agent_names)
+        if group_variables[group] != "ALL":
+            remaining_dims = raw_output[group].to_dataset(inherit=False)[group_variables[group]].dims
+        else:
+            remaining_dims = raw_output[group].to_dataset(inherit=False).dims
+        for dim in output_dict[group].dims:
+            if dim not in remaining_dims:
+                output_dict[group] = output_dict[group].drop_vars(dim)
+        if chunks == "plan":
+            output_dict[group] = chunking.chunk_dataset(output_dict[group], operations,
+                                                        token=_file_token(file, group, group_variables[group]))
+    return output_dict
+
+def process_datadict_to_datasets(datadict, variable_selection=None, chunks=None, operations=chunking.DEFAULT_OPERATIONS,
+                                 concat_timeperiods=False, padding="warn", max_padding_ratio=MAX_PADDING_RATIO):
     """
     Process a dictionary of NetCDF files into one ensemble dataset.
 
@@ -225,29 +1235,48 @@ def process_datadict_to_datasets(datadict, variable_selection=None):
     Args:
         datadict (dict): A nested dictionary where the first level keys are model names, the second 
                          level keys are scenario names, and the third level keys are time periods. The 
-                         values are file paths to the NetCDF files.
+                         values are lists of file paths to the NetCDF files, as from find_ensemble_files,
+                         or single file paths. Several files of a time period are combined by their
+                         coordinates.
         variable_selection (str or list of str, optional): A variable or list of variables to select 
                                                            from the NetCDF files. If None, all 
                                                            variables are selected. Defaults to None.
+        chunks (int, dict, 'auto' or 'plan', optional): Chunks to open the files with. With 'plan', each file
+                                                        is chunked as planned for operations from its on-disk
+                                                        chunks (see chunking.plan_chunks). Defaults to None,
+                                                        i.e. no dask.
+        operations (sequence of (str, sequence of str), optional): The operations planned on the data if
+                                                                   chunks is 'plan'. Defaults to
+                                                                   chunking.DEFAULT_OPERATIONS.
+        concat_timeperiods (bool, optional): Whether to stitch the time periods of each model and scenario into
+                                             one continuous time axis (see stitch_timeperiods) instead of
+                                             combining them along a timeperiod dimension, in which every time
+                                             period is padded with NaN to all dates. Defaults to False.
+        padding ({"warn", "raise", "ignore"}, optional): What to do if combining the files would pad the data
+                                                        beyond max_padding_ratio (see check_outer_join_size).
+                                                        Defaults to "warn".
+        max_padding_ratio (float, optional): Largest accepted ratio of the combined to the input size. Defaults
+                                             to MAX_PADDING_RATIO.
 
     Returns:
         xarray.Dataset: An xarray dataset containing the combined data from all the NetCDF files, 
-                        with additional coordinates for model, scenario, and time period.
+                        with additional coordinates for model, scenario, and time period (only model and
+                        scenario if concat_timeperiods is True).
 
     Example:
         datadict = {
             'model1': {
                 'scenario1': {
-                    '2020-2030': 'path/to/netcdf1.nc',
-                    '2030-2040': 'path/to/netcdf2.nc'
+                    '2020-2030': ['path/to/netcdf1.nc'],
+                    '2030-2040': ['path/to/netcdf2.nc']
                 },
                 'scenario2': {
-                    '2020-2030': 'path/to/netcdf3.nc'
+                    '2020-2030': ['path/to/netcdf3.nc']
                 }
             },
             'model2': {
                 'scenario1': {
-                    '2020-2030': 'path/to/netcdf4.nc'
+                    '2020-2030': ['path/to/netcdf4.nc']
                 }
             }
         }
@@ -256,68 +1285,275 @@ def process_datadict_to_datasets(datadict, variable_selection=None):
     datalist = []
     for model in datadict:
         for scenario in datadict[model]:
-            for timeperiod in datadict[model][scenario]:
-                data = xr.open_dataset(datadict[model][scenario][timeperiod])
+            periods = {}
+            for timeperiod, files in datadict[model][scenario].items():
+                # find_ensemble_files gives a list of files per time period
+                files = [files] if isinstance(files, (str, os.PathLike)) else list(files)
+                datasets = []
+                for file in files:
+                    data = xr.open_dataset(file, chunks=None if chunks == "plan" else chunks)
+                    if chunks == "plan":
+                        data = chunking.chunk_dataset(data, operations, token=_file_token(file))
+                    datasets.append(data)
+                # several files of a time period, e.g. split by variables or regions, are combined by coordinates
+                data = datasets[0] if len(datasets) == 1 else xr.combine_by_coords(datasets, join="outer")
                 if variable_selection is not None:
                     data = data[variable_selection]
-                data["model"] = model
-                data["scenario"] = scenario
-                data["timeperiod"] = timeperiod
-                data = data.expand_dims(["model", "scenario", "timeperiod"])
-                data = data.set_coords(["model", "scenario", "timeperiod"])
+                periods[timeperiod] = data
+            if concat_timeperiods:
+                members = [(stitch_timeperiods(list(periods.values())), {"model": model, "scenario": scenario})]
+            else:
+                members = [(data, {"model": model, "scenario": scenario, "timeperiod": timeperiod})
+                           for timeperiod, data in periods.items()]
+            for data, labels in members:
+                for dim, value in labels.items():
+                    data[dim] = value
+                data = data.set_coords(list(labels))
+                data = data.expand_dims(list(labels))
                 datalist.append(data)
-    return xr.combine_by_coords(datalist)
+    check_outer_join_size(datalist, max_padding_ratio, padding)
+    return xr.combine_by_coords(datalist, join="outer")
+
+
+def stitch_timeperiods(datasets, time_dim="time"):
+    """
+    Stitch the datasets of consecutive time periods of one ensemble member into one continuous time axis.
+
+    The datasets are ordered by their first time step and concatenated lazily along time_dim. Time steps
+    contained in several time periods, e.g. the first day of a period that is also the last day of the previous
+    one, are kept only from the earlier period. Variables without time_dim are taken from the first dataset.
+
+    Args:
+        datasets (list of xarray.Dataset): The datasets of the time periods, each with a sorted time_dim.
+        time_dim (str, optional): The name of the time dimension. Defaults to "time".
+
+    Returns:
+        xarray.Dataset: The dataset over the stitched time axis, without duplicate time steps.
+    """
+    datasets = sorted(datasets, key=lambda data: data.indexes[time_dim][0])
+    if len(datasets) == 1:
+        return datasets[0]
+    stitched = xr.concat(datasets, dim=time_dim, data_vars="minimal", coords="minimal", compat="override",
+                         combine_attrs="override")
+    duplicated = stitched.indexes[time_dim].duplicated()
+    if duplicated.any():
+        stitched = stitched.isel({time_dim: np.flatnonzero(~duplicated)})
+    return stitched
+
+
+def check_outer_join_size(datasets, max_padding_ratio=MAX_PADDING_RATIO, errors="warn"):
+    """
+    Estimate the size of merging datasets with an outer join from their indexes, and warn or raise before
+    allocating it if the merged data would be mostly padding.
+
+    The merged size is estimated from the union of the index values of every dimension, which is the shape
+    xr.merge and xr.combine_by_coords give each variable, without reading any data.
+
+    Args:
+        datasets (list of xarray.Dataset): The datasets to be merged, e.g. with their ensemble dimensions expanded.
+        max_padding_ratio (float, optional): Largest accepted ratio of the merged to the summed input size.
+                                             Defaults to MAX_PADDING_RATIO.
+        errors ({"warn", "raise", "ignore"}, optional): Whether to warn or raise a ValueError if the ratio is
+                                                       exceeded. Defaults to "warn".
+
+    Returns:
+        tuple of int: The summed size of the inputs and the estimated size of the merged data in bytes.
+
+    Raises:
+        ValueError: If errors is "raise" and the merged data would exceed max_padding_ratio.
+    """
+    if errors not in ("warn", "raise", "ignore"):
+        raise ValueError("errors must be 'warn', 'raise' or 'ignore', got {!r}".format(errors))
+    indexes = {}
+    sizes = {}
+    itemsizes = {}
+    variable_dims = {}
+    input_bytes = 0
+    for data in datasets:
+        for dim, index in data.indexes.items():
+            # most datasets share their indexes, so only different ones are joined
+            known = indexes.setdefault(dim, [])
+            if not any(index.equals(other) for other in known[-1:]):
+                known.append(index)
+        for dim, size in data.sizes.items():
+            sizes[dim] = max(sizes.get(dim, 0), size)
+        for name, variable in data.data_vars.items():
+            variable_dims[name] = variable.dims
+            # padding turns other types into floats
+            itemsize = variable.dtype.itemsize if variable.dtype.kind in "fc" else 8
+            itemsizes[name] = max(itemsizes.get(name, 0), itemsize)
+            input_bytes += variable.size * variable.dtype.itemsize
+    for dim, known in indexes.items():
+        sizes[dim] = len(functools.reduce(lambda index, other: index.union(other), known))
+    merged_bytes = sum(int(np.prod([sizes[dim] for dim in dims], dtype=np.int64)) * itemsizes[name]
+                       for name, dims in variable_dims.items())
+
+    if errors != "ignore" and merged_bytes > max_padding_ratio * max(input_bytes, 1):
+        message = ("Merging the datasets with an outer join would pad {:.3g} GB of data to {:.3g} GB ({:.1f} times). "
+                   "Align the coordinates first, e.g. stitch time periods with concat_timeperiods=True.").format(
+            input_bytes / 1e9, merged_bytes / 1e9, merged_bytes / max(input_bytes, 1))
+        if errors == "raise":
+            raise ValueError(message)
+        warnings.warn(message, UserWarning)
+    return input_bytes, merged_bytes
          
 
-def datatree_to_dataset_dict(data_tree, group_selection):
+def build_ragged_ensemble(members, ensemble_dims=None, time_dim="time", obs_dim="obs", member_dim="member"):
+    """
+    Combine ensemble members with different numbers of time steps into a ragged ensemble without padding.
+
+    The members are stored in the contiguous ragged array layout of the CF conventions: the time steps of all
+    members are concatenated (lazily) along a sample dimension obs_dim, and the count variable member_length
+    (with the CF attribute sample_dimension) gives the number of time steps of each member. The time of each
+    sample is kept as a coordinate along obs_dim, together with the relative index step of the sample within
+    its member (which marks the start of every member also for DataArrays taken from the ensemble, as those
+    lose the coordinates along member_dim), and the ensemble parameters become coordinates along member_dim.
+    The memory of the ensemble is thus proportional to the time steps actually simulated, and incomplete runs
+    stay usable.
+
+    Aggregates over other dimensions (analysis_functions.aggregate_by_dimension_dict), baselines and baseline
+    deviations (data_transform.get_baseline_data, analysis_functions.get_baseline_deviation) work on ragged
+    ensembles as they are; statistics and quantiles over time are computed per member with
+    analysis_functions.ragged_reduce and analysis_functions.ragged_quantile.
+
+    Parameters
+    ----------
+    members : list of xarray.Dataset
+        The members with their ensemble dimensions of size one, e.g. as returned by load_ensemble_files.
+        Members without time steps are left out.
+    ensemble_dims : list of str, optional
+        The ensemble dimensions. If None, the dimensions whose coordinate has a standard_name equal to the
+        dimension name (as set by load_ensemble_files) are used.
+    time_dim : str, optional
+        The time dimension of the members (default is "time").
+    obs_dim : str, optional
+        The sample dimension of the ragged ensemble (default is "obs").
+    member_dim : str, optional
+        The member dimension of the ragged ensemble (default is "member").
+
+    Returns
+    -------
+    xarray.Dataset
+        The ragged ensemble.
+    """
+    ensemble_dims = _ensemble_dims(members[0], ensemble_dims)
+    members = [member for member in members if member.sizes.get(time_dim, 0) > 0]
+    samples = []
+    labels = {dim: [] for dim in ensemble_dims}
+    for member in members:
+        for dim in ensemble_dims:
+            labels[dim].append(member[dim].values.item())
+        member = member.isel({dim: 0 for dim in ensemble_dims}, drop=True).swap_dims({time_dim: obs_dim})
+        samples.append(member.assign_coords(step=(obs_dim, np.arange(member.sizes[obs_dim]))))
+    ragged = xr.concat(samples, dim=obs_dim, data_vars="minimal", coords="minimal", compat="override",
+                       join="outer", combine_attrs="override")
+    lengths = xr.DataArray(np.array([member.sizes[obs_dim] for member in samples]), dims=member_dim,
+                           attrs={"sample_dimension": obs_dim, "long_name": "number of time steps of the member"})
+    member_coords = {dim: xr.DataArray(np.asarray(values), dims=member_dim, attrs=members[0][dim].attrs)
+                     for dim, values in labels.items()}
+    return ragged.assign_coords(member_coords).assign_coords(member_length=lengths)
+
+
+def combine_ensemble_members(datasets, labels, ensemble_dims, padding="warn", max_padding_ratio=MAX_PADDING_RATIO):
+    """
+    Combine datasets of single ensemble members into one dataset with the ensemble dimensions.
+
+    If all datasets share the same variables and coordinates, which is checked once against the first
+    dataset, they are concatenated along a single stacked ensemble dimension that is then unstacked into
+    ``ensemble_dims``. This avoids the pairwise alignment of every coordinate done by xr.merge. Only if
+    the coordinates really differ, each dataset is expanded by the ensemble dimensions and xr.merge is used,
+    after checking how much the outer join would pad the data (see check_outer_join_size).
+    In both cases, combinations of labels without a dataset are filled with NaN.
+
+    Parameters
+    ----------
+    datasets : list of xarray.Dataset
+        The datasets of the individual ensemble members.
+    labels : list of tuple
+        The values of the ensemble dimensions for each dataset.
+    ensemble_dims : list of str
+        The names of the ensemble dimensions.
+    padding : {"warn", "raise", "ignore"}, optional
+        What to do if merging would pad the data beyond max_padding_ratio (default is "warn").
+    max_padding_ratio : float, optional
+        Largest accepted ratio of the merged to the input size (default is MAX_PADDING_RATIO).
+
+    Returns
+    -------
+    xarray.Dataset
+        The combined dataset with the ensemble dimensions first.
+    """
+    first = datasets[0]
+    stackable = len(set(labels)) == len(labels) and all(
+        set(data.data_vars) == set(first.data_vars)
+        and data.sizes == first.sizes
+        and set(data.coords) == set(first.coords)
+        and all(data[name].variable.equals(first[name].variable) for name in first.coords)
+        for data in datasets[1:]
+    )
+    if not stackable:
+        # assign_coords gives new datasets, the datasets of the caller are left as they are
+        mergelist = [data.assign_coords(dict(zip(ensemble_dims, label))).expand_dims(ensemble_dims)
+                     for data, label in zip(datasets, labels)]
+        check_outer_join_size(mergelist, max_padding_ratio, padding)
+        return xr.merge(mergelist, join="outer", compat="no_conflicts")
+
+    member_index = pd.MultiIndex.from_tuples(labels, names=ensemble_dims)
+    stacked = xr.concat(datasets, dim="ensemble_member", data_vars="all", coords="minimal", compat="override",
+                        join="override", combine_attrs="override")
+    stacked = stacked.assign_coords(xr.Coordinates.from_pandas_multiindex(member_index, "ensemble_member"))
+    combined = stacked.unstack("ensemble_member").transpose(*ensemble_dims, ...)
+    # pandas stores string labels as objects, while expand_dims would give fixed-width strings
+    return combined.assign_coords({dim: np.asarray(combined.indexes[dim].tolist()) for dim in ensemble_dims})
+
+
+def datatree_to_dataset_dict(data_tree, group_selection, concat_timeperiods=False, padding="warn",
+                             max_padding_ratio=MAX_PADDING_RATIO):
     """
     Convert a DataTree to a dictionary of Datasets by model, scenario, and time period.
     
     Args:
         data_tree (xr.DataTree): The DataTree containing the processed data.
         group_selection (list): List of groups to select from the DataTree.
+        concat_timeperiods (bool, optional): Whether to stitch the time periods of each model and scenario into one continuous time axis (see stitch_timeperiods) instead of a timeperiod dimension. Defaults to False.
+        padding ({"warn", "raise", "ignore"}, optional): What to do if combining would pad the data beyond max_padding_ratio, see combine_ensemble_members. Defaults to "warn".
+        max_padding_ratio (float, optional): Largest accepted ratio of the combined to the input size. Defaults to MAX_PADDING_RATIO.
         
     Returns:
         dict: A dictionary where each key is a group name and each value is a Dataset containing data 
               from all models, scenarios, and time periods for that group.
     """
+    ensemble_dims = ["model", "scenario"] if concat_timeperiods else ["model", "scenario", "timeperiod"]
     groupdata = {}
     for group in group_selection:
-        mergelist = []
+        leaves = []
+        labels = []
         models = list(data_tree.keys())
         for model in models:
             scenarios = list(data_tree[model].keys())
             for scenario in scenarios:
                 timeperiods = list(data_tree[model][scenario].keys())
-                for timeperiod in timeperiods:
-                    data = data_tree[model][scenario][timeperiod][group]
-                    data = data.to_dataset(inherit=False)
-                    data["model"] = model
-                    data["scenario"] = scenario
-                    data["timeperiod"] = timeperiod
-                    data = data.set_coords(["model", "scenario", "timeperiod"])
-                    data = data.expand_dims(["model", "scenario", "timeperiod"])
-                    mergelist.append(data)
-        groupdata[group] = xr.merge(mergelist)
+                periods = [data_tree[model][scenario][timeperiod][group].to_dataset(inherit=False)
+                           for timeperiod in timeperiods]
+                if concat_timeperiods:
+                    leaves.append(stitch_timeperiods(periods))
+                    labels.append((model, scenario))
+                else:
+                    leaves.extend(periods)
+                    labels.extend((model, scenario, timeperiod) for timeperiod in timeperiods)
+        groupdata[group] = combine_ensemble_members(leaves, labels, ensemble_dims, padding, max_padding_ratio)
         
         #select for consumers / firms if in these groups TODO: improve Acclimate output to only give consumer / firm agents in the first place
         if group in ["consumers", "firms"]:
-            agents = groupdata[group].agent.values
-            regions = [agent.split(":")[1] for agent in agents]
-            unique_regions = []
-            for region in regions:
-                if region not in unique_regions:
-                    unique_regions.append(region)
-            consumer_agents = [quintile+":"+region for quintile in definitions.short_quintiles for region in unique_regions]
-            other_agents = [agent for agent in agents if agent not in consumer_agents]
+            consumer_mask, firm_mask = helpers.classify_agents(groupdata[group].agent.values)
             if group == "consumers":
-                groupdata[group] = groupdata[group].sel(agent=consumer_agents)
+                groupdata[group] = groupdata[group].isel(agent=np.flatnonzero(consumer_mask))
             else:
-                groupdata[group] = groupdata[group].sel(agent=other_agents)
+                groupdata[group] = groupdata[group].isel(agent=np.flatnonzero(firm_mask))
     return groupdata
 
 
-def create_ensemble_dataset(basedir, scenario_prefix="ssp",scenario_globpattern="[0-9][0-9][0-9]", time_globterm="[0-9][0-9][0-9][0-9]-[0-9][0-9][0-9][0-9]", modellist=None, recursive=True, variable_selection=None):
+def create_ensemble_dataset(basedir, scenario_prefix="ssp",scenario_globpattern="[0-9][0-9][0-9]", time_globterm="[0-9][0-9][0-9][0-9]-[0-9][0-9][0-9][0-9]", modellist=None, recursive=True, variable_selection=None, chunks=None, operations=chunking.DEFAULT_OPERATIONS, store=None, concat_timeperiods=False, padding="warn"):
         """ Create an ensemble dataset by combining NetCDF files from a specified base directory.
         This function searches for NetCDF files in the given base directory that match specified patterns for scenario and time period.
         It then combines the data from these files into a single xarray dataset.
@@ -330,15 +1566,25 @@ def create_ensemble_dataset(basedir, scenario_prefix="ssp",scenario_globpattern=
             modellist (list, optional): List of model names to search for. Defaults to None.
             recursive (bool, optional): Whether to search directories recursively. Defaults to True.
             variable_selection (str or list of str, optional): A variable or list of variables to select from the NetCDF files. Defaults to None, which implies all variables are processed.
+            chunks (int, dict, 'auto' or 'plan', optional): Chunks to open the files with, see process_datadict_to_datasets. Defaults to None.
+            operations (sequence of (str, sequence of str), optional): The operations planned on the data if chunks is 'plan' or a store is written. Defaults to chunking.DEFAULT_OPERATIONS.
+            store (str or MutableMapping, optional): If given, the dataset is written to this new Zarr store (see write_ensemble_store) and the store is returned, opened lazily. Defaults to None.
+            concat_timeperiods (bool, optional): Whether to stitch the time periods into one continuous time axis instead of a timeperiod dimension, see process_datadict_to_datasets. Defaults to False.
+            padding ({"warn", "raise", "ignore"}, optional): What to do if combining the files would mostly pad the data, see check_outer_join_size. Defaults to "warn".
         
         Returns:
             xarray.Dataset: An xarray dataset containing the combined data from all the NetCDF files.
         """
         datadict = find_ensemble_files(basedir, scenario_prefix,scenario_globpattern, time_globterm, modellist, recursive)
-        combined_dataset = process_datadict_to_datasets(datadict, variable_selection)
+        combined_dataset = process_datadict_to_datasets(datadict, variable_selection, chunks, operations,
+                                                        concat_timeperiods, padding)
+        if store is not None:
+            ensemble_dims = ["model", "scenario"] if concat_timeperiods else ["model", "scenario", "timeperiod"]
+            write_ensemble_store(combined_dataset, store, ensemble_dims, operations)
+            return open_ensemble_store(store)
         return combined_dataset
 
-def create_ensemble_datatree(basedir, group_selection, group_variables, modellist=None, scenario_prefix="ssp",scenario_globpattern="[0-9][0-9][0-9]", time_globterm="[0-9][0-9][0-9][0-9]-[0-9][0-9][0-9][0-9]", recursive=True, data_agent_converter=None):
+def create_ensemble_datatree(basedir, group_selection, group_variables, modellist=None, scenario_prefix="ssp",scenario_globpattern="[0-9][0-9][0-9]", time_globterm="[0-9][0-9][0-9][0-9]-[0-9][0-9][0-9][0-9]", recursive=True, data_agent_converter=None, chunks='auto', operations=chunking.DEFAULT_OPERATIONS, executor="thread", max_workers=None, return_report=False):
     """
     Create an ensemble DataTree from a base directory containing grouped NetCDF files.
     
@@ -356,9 +1602,15 @@ def create_ensemble_datatree(basedir, group_selection, group_variables, modellis
         time_globterm (str, optional): The glob pattern for time period. Defaults to "[0-9][0-9][0-9][0-9]-[0-9][0-9][0-9][0-9]".
         recursive (bool, optional): Whether to search directories recursively. Defaults to True.
         data_agent_converter (function, optional): Function to convert raw output data agent dimension. Defaults to None.
+        chunks (int, dict, 'auto', 'plan' or None, optional): Chunks to open the files with, see process_datadict_to_datatree. Defaults to 'auto'.
+        operations (sequence of (str, sequence of str), optional): The operations planned on the data if chunks is 'plan'. Defaults to chunking.DEFAULT_OPERATIONS.
+        executor ({"thread", "process"}, concurrent.futures.Executor or None, optional): How the files are processed concurrently. Defaults to "thread".
+        max_workers (int, optional): Maximum number of workers of the thread or process pool. Defaults to None.
+        return_report (bool, optional): Whether to also return the report of left out files, see process_datadict_to_datatree. Defaults to False.
     
     Returns:
         xr.DataTree: A nested DataTree structure containing the processed data.
+        dict: Only if return_report is True: the report of left out files.
     
     Example:
         basedir = "/path/to/data"
@@ -370,5 +1622,5 @@ def create_ensemble_datatree(basedir, group_selection, group_variables, modellis
         datatree = create_ensemble_datatree(basedir, group_selection, group_variables)
     """
     datadict = find_ensemble_files(basedir, scenario_prefix,scenario_globpattern, time_globterm, modellist, recursive)
-    combined_datatree = process_datadict_to_datatree(datadict, group_selection, group_variables, data_agent_converter)
-    return combined_datatree
+    return process_datadict_to_datatree(datadict, group_selection, group_variables, data_agent_converter, chunks,
+                                        operations, executor, max_workers, return_report)
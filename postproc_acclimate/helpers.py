@@ -3,8 +3,31 @@ Helper functions for dealing with acclimate output datasets.
 """
 
 from postproc_acclimate import definitions
+import collections
+import hashlib
+import json
+import threading
 import warnings
 
+import numpy as np
+
+AGENT_CACHE_SIZE = 16
+
+AgentCoordinates = collections.namedtuple("AgentCoordinates", ["names", "sectors", "regions", "consumer_mask"])
+
+AgentCodeTable = collections.namedtuple("AgentCodeTable", ["sectors", "regions"])
+AgentCodeTable.__doc__ = """
+Labels of the sector (or consumer quintile) and region codes of integer-coded agents. The code of an agent is
+sector code * len(regions) + region code.
+"""
+
+# attributes of coded coordinates holding the labels of their codes as JSON lists, see labels_attr
+AGENT_CODE_ATTRS = ("code_sectors", "code_regions")
+LABEL_CODE_ATTR = "code_labels"
+
+_agent_cache = collections.OrderedDict()
+_agent_cache_lock = threading.Lock()
+
 def data_agent_converter(data):
     """
     Convert agent data to a more readable format.
@@ -19,53 +42,101 @@ def data_agent_converter(data):
     list
         Converted agent names.
     """
-    def agent_name_converter(agents):
-        """
-        Convert agent names from quadruple to a string format.
-
-        Parameters
-        ----------
-        agents : list
-            List of agent quadruples.
-
-        Returns
-        -------
-        list
-            List of converted agent names.
-        """
-        agent_names = []
-        for agent in agents:
-            agent_name = agent[0].tobytes().decode("utf-8").rstrip('\x00')
-            if agent_name:
-                agent_names.append(agent_name)
-                
-        quintiles = definitions.long_quintiles
-        new_quintiles = definitions.short_quintiles
-
-        new_consumer_names = []
-        old_consumer_names = []
-        region = agent_names[0].split(":")[1]
-        for agent_name in agent_names:
-            if 'income_quintile' not in agent_name:
-                region = agent_name.split(":")[1]
-            for quintile, new_quintile in zip(quintiles, new_quintiles):
-                if quintile in agent_name:
-                    old_consumer_names.append(agent_name)
-                    new_agent_name = new_quintile + ":" + region
-                    new_consumer_names.append(new_agent_name)
-
-        new_agent_names = agent_names.copy()
-        for old, new in zip(old_consumer_names, new_consumer_names):
-            new_agent_names = [new if agent is old else agent for agent in new_agent_names]
-        return new_agent_names
-
     if "agent" in data.dims:
-        return agent_name_converter(data["agent"].values)
+        return decode_agent_coordinates(data["agent"].values).names.tolist()
     else:
         warnings.warn("No agents found in the dataset", UserWarning)
         return None
 
-def tidy_agents(dataset, group_to_load="firms"):
+
+def decode_agent_names(agents):
+    """
+    Convert raw agent records of Acclimate output to agent names of the form 'type:region'.
+
+    The names are taken from the first field of the agent records, a fixed-width byte string, which is
+    decoded for all agents in one numpy call. Empty names are dropped. Consumer agents (long income quintile
+    names, see definitions.long_quintiles) are renamed to the short quintile name and the region of the
+    closest preceding non-consumer agent, e.g. 'q1:DEU'. Runs in linear time in the number of agents.
+
+    Parameters
+    ----------
+    agents : numpy.ndarray
+        The raw agent records, or already decoded agent names.
+
+    Returns
+    -------
+    list
+        List of converted agent names.
+    """
+    names = _decode_fixed_width(np.asarray(agents))
+    names = names[names != ""]
+
+    agent_types, _, regions = np.moveaxis(np.char.partition(names, ":"), -1, 0)
+    consumers = np.char.find(names, "income_quintile") >= 0
+    # consumers take the region of the closest preceding agent that is not a consumer (or of the first agent)
+    regions = regions[np.maximum.accumulate(np.where(consumers, 0, np.arange(len(names))))]
+
+    long_to_short = dict(zip(definitions.long_quintiles, definitions.short_quintiles))
+    new_agent_names = names.tolist()
+    for i in np.flatnonzero(consumers):
+        short_quintile = long_to_short.get(agent_types[i]) or next(
+            (short for long, short in long_to_short.items() if long in names[i]), None)
+        if short_quintile:
+            new_agent_names[i] = short_quintile + ":" + regions[i]
+    return new_agent_names
+
+
+def decode_agent_coordinates(agents):
+    """
+    Decode raw agent records once and return the agent coordinates derived from them.
+
+    All members of an ensemble share the same agent records, so the result is memoized on a hash of the raw
+    array in a bounded LRU cache (AGENT_CACHE_SIZE entries, shared with classify_agents) and every further
+    file of the same model setup reuses it. The returned arrays are read-only.
+
+    Parameters
+    ----------
+    agents : numpy.ndarray
+        The raw agent records, e.g. the values of the 'agent' coordinate of Acclimate output.
+
+    Returns
+    -------
+    AgentCoordinates
+        Named tuple of the decoded agent names (see decode_agent_names), their sector and region parts and
+        the boolean consumer mask (see classify_agents).
+    """
+    agents = np.asarray(agents)
+    return _cached(("coordinates",) + _array_key(agents), lambda: _compute_agent_coordinates(agents))
+
+
+def _compute_agent_coordinates(agents):
+    names = np.asarray(decode_agent_names(agents), dtype=str)
+    sectors, _, regions = np.moveaxis(np.char.partition(names, ":"), -1, 0)
+    consumer_mask = np.isin(sectors, definitions.short_quintiles)
+    coordinates = AgentCoordinates(names, sectors, regions, consumer_mask)
+    for values in coordinates:
+        values.setflags(write=False)
+    return coordinates
+
+
+def _decode_fixed_width(agents):
+    """
+    Decode the names of raw agent records into a unicode numpy array.
+    """
+    if agents.dtype.names:
+        agents = agents[agents.dtype.names[0]]
+    elif agents.dtype.kind != "S" and agents.ndim > 1:
+        agents = agents[:, 0]
+    if agents.dtype.kind == "S":
+        agents = np.ascontiguousarray(agents)
+        if agents.ndim > 1:
+            # array of characters per agent, join them into one fixed-width byte string per agent
+            agents = agents.view("S{}".format(agents.dtype.itemsize * int(np.prod(agents.shape[1:])))).reshape(len(agents))
+        return np.char.rstrip(np.char.decode(agents, "utf-8"), "\x00")
+    return np.char.rstrip(agents.astype(str), "\x00")
+
+
+def tidy_agents(dataset, group_to_load="firms", encode=False, table=None):
     """
     Tidy up agent names in the dataset and optionally filter by group.
 
@@ -75,25 +146,301 @@ def tidy_agents(dataset, group_to_load="firms"):
         The dataset containing agent data.
     group_to_load : str, optional
         The group of agents to load, by default "firms".
+    encode : bool, optional
+        Whether to replace the agent names by int32 agent codes (see encode_agent_coordinate), by default False.
+    table : AgentCodeTable, optional
+        The code table to encode with. If None, the table of the definitions and of the agents of the dataset
+        is used (agent_code_table(agents)), which is the same for all members of an ensemble with the same
+        agents. Pass a table built over the agents of all members if their agents differ, e.g. in subregions.
 
     Returns
     -------
     xarray.Dataset
         The dataset with tidied agent names.
+
+    Raises
+    ------
+    KeyError
+        If encode is True and a sector or region of the agents is not in the given code table.
     """
     if "agent" in dataset.dims:
-        new_agent_names = data_agent_converter(dataset['agent'])
-        dataset = dataset.assign_coords(agent=new_agent_names)
+        coordinates = decode_agent_coordinates(dataset['agent'].values)
+        dataset = dataset.assign_coords(agent=coordinates.names)
         
-        regions = [agent.split(":")[1] for agent in new_agent_names]
-        unique_regions = []
-        for region in regions:
-            if region not in unique_regions:
-                unique_regions.append(region)
-        consumer_agents = [quintile+":"+region for quintile in definitions.short_quintiles for region in unique_regions]
-        other_agents = [agent for agent in new_agent_names if agent not in consumer_agents]
         if group_to_load == "consumers":
-            dataset = dataset.sel(agent=consumer_agents)
+            dataset = dataset.isel(agent=np.flatnonzero(coordinates.consumer_mask))
         else:
-            dataset = dataset.sel(agent=other_agents)
-    return dataset
\ No newline at end of file
+            dataset = dataset.isel(agent=np.flatnonzero(~coordinates.consumer_mask))
+        if encode:
+            agents = dataset["agent"].values
+            dataset = encode_agent_coordinate(dataset, agent_code_table(agents) if table is None else table)
+    return dataset
+
+
+def agent_code_table(agents=()):
+    """
+    Build the code table of integer-coded agents.
+
+    The sectors are definitions.sector_names and definitions.short_quintiles (the consumer agents), the regions
+    definitions.region_names, together with the sectors and regions of the given agents that are not defined
+    there, e.g. subregions such as 'US.CA'. Members of an ensemble can only be combined if they are encoded with
+    the same table, so the agents have to be those of all members. The labels are sorted, so that codes sort
+    like their labels and results (e.g. of data_transform.add_region_sector) are ordered as with label
+    coordinates.
+
+    Parameters
+    ----------
+    agents : array-like of str, optional
+        Agent names of the form 'sector:region' the table has to cover.
+
+    Returns
+    -------
+    AgentCodeTable
+        The sector and region labels, as read-only numpy arrays.
+    """
+    sectors = set(definitions.sector_names) | set(definitions.short_quintiles)
+    regions = set(definitions.region_names)
+    agents = np.asarray(agents, dtype=str)
+    if agents.size:
+        agent_sectors, _, agent_regions = np.moveaxis(np.char.partition(np.unique(agents), ":"), -1, 0)
+        sectors |= set(agent_sectors.tolist())
+        regions |= set(agent_regions.tolist())
+    table = AgentCodeTable(np.asarray(sorted(sectors), dtype=str), np.asarray(sorted(regions), dtype=str))
+    for labels in table:
+        labels.setflags(write=False)
+    return table
+
+
+def encode_agents(agents, table):
+    """
+    Encode agent names of the form 'sector:region' into int32 agent codes.
+
+    Parameters
+    ----------
+    agents : array-like of str
+        The agent names.
+    table : AgentCodeTable
+        The code table, see agent_code_table.
+
+    Returns
+    -------
+    numpy.ndarray
+        The int32 codes, sector code * len(table.regions) + region code.
+
+    Raises
+    ------
+    KeyError
+        If a sector or region of the agents is not in the table.
+    """
+    agents = np.asarray(agents, dtype=str)
+    unique_agents, inverse = np.unique(agents, return_inverse=True)
+    sectors, _, regions = np.moveaxis(np.char.partition(unique_agents, ":"), -1, 0)
+    sector_codes = encode_labels(sectors, table.sectors)
+    region_codes = encode_labels(regions, table.regions)
+    return (sector_codes * len(table.regions) + region_codes).astype(np.int32)[inverse.reshape(agents.shape)]
+
+
+def decode_agents(codes, table):
+    """
+    Decode int32 agent codes into agent names of the form 'sector:region'.
+
+    Parameters
+    ----------
+    codes : array-like of int
+        The agent codes.
+    table : AgentCodeTable
+        The code table the codes were encoded with.
+
+    Returns
+    -------
+    numpy.ndarray
+        The agent names.
+    """
+    sector_codes, region_codes = np.divmod(np.asarray(codes), len(table.regions))
+    return np.char.add(np.char.add(table.sectors[sector_codes], ":"), table.regions[region_codes])
+
+
+def encode_labels(labels, table_labels):
+    """
+    Encode labels into their int32 positions in a table of labels.
+
+    Raises
+    ------
+    KeyError
+        If a label is not in the table.
+    """
+    positions = {label: code for code, label in enumerate(np.asarray(table_labels).tolist())}
+    labels = np.asarray(labels, dtype=str)
+    missing = sorted(set(labels.ravel().tolist()) - set(positions))
+    if missing:
+        raise KeyError(f"{missing} not found in the code table, build the table over all agents with "
+                       "agent_code_table(agents)")
+    return np.asarray([positions[label] for label in labels.ravel().tolist()], dtype=np.int32).reshape(labels.shape)
+
+
+def encode_agent_coordinate(data, table=None):
+    """
+    Replace the agent names of data by int32 agent codes.
+
+    Merges, selections and aggregations then compare integers instead of strings. The code table is stored
+    in the attributes of the agent coordinate (AGENT_CODE_ATTRS), where it is found by add_region_sector,
+    analysis_functions.aggregate_by_dimension_dict, code_labels and decode_coordinates, so that the labels are
+    only restored for the output.
+
+    Parameters
+    ----------
+    data : xarray.Dataset or xarray.DataArray
+        Data with agent names of the form 'sector:region' as agent coordinate.
+    table : AgentCodeTable, optional
+        The code table. If None, it is built for the agents of data (see agent_code_table).
+
+    Returns
+    -------
+    xarray.Dataset or xarray.DataArray
+        The data with the coded agent coordinate.
+    """
+    agents = np.asarray(data["agent"].values, dtype=str)
+    table = agent_code_table(agents) if table is None else table
+    attrs = dict(zip(AGENT_CODE_ATTRS, (labels_attr(table.sectors), labels_attr(table.regions))))
+    return data.assign_coords(agent=("agent", encode_agents(agents, table), attrs))
+
+
+def labels_attr(labels):
+    """
+    The labels of codes as an attribute value, a JSON list that keeps labels with spaces and can be written to
+    NetCDF and Zarr files.
+    """
+    return json.dumps(np.asarray(labels, dtype=str).tolist())
+
+
+def attr_labels(value):
+    """
+    The labels of codes from an attribute value written by labels_attr.
+    """
+    return np.asarray(json.loads(value), dtype=str)
+
+
+def coordinate_code_table(data, dimension):
+    """
+    Get the labels of the codes of a coded coordinate, or None if the coordinate is not coded.
+
+    Returns
+    -------
+    AgentCodeTable, numpy.ndarray or None
+        The code table of a coded agent coordinate, the labels of a coded sector or region coordinate.
+    """
+    if dimension not in data.coords:
+        return None
+    attrs = data[dimension].attrs
+    if all(name in attrs for name in AGENT_CODE_ATTRS):
+        return AgentCodeTable(*(attr_labels(attrs[name]) for name in AGENT_CODE_ATTRS))
+    if LABEL_CODE_ATTR in attrs:
+        return attr_labels(attrs[LABEL_CODE_ATTR])
+    return None
+
+
+def code_labels(data, dimension, labels):
+    """
+    Translate labels into the codes of a coded coordinate, e.g. for data.sel or aggregation dictionaries.
+
+    Parameters
+    ----------
+    data : xarray.Dataset or xarray.DataArray
+        The data with the coordinate.
+    dimension : str
+        The name of the coordinate.
+    labels : str or array-like of str
+        The labels, agent names for an agent coordinate.
+
+    Returns
+    -------
+    int, numpy.ndarray or the labels
+        The codes of the labels, or the labels as they are if the coordinate is not coded.
+    """
+    table = coordinate_code_table(data, dimension)
+    if table is None:
+        return labels
+    codes = encode_agents(labels, table) if isinstance(table, AgentCodeTable) else encode_labels(labels, table)
+    return codes.item() if np.ndim(labels) == 0 else codes
+
+
+def decode_coordinates(data):
+    """
+    Replace the coded agent, sector and region coordinates of data by their labels, e.g. before writing output.
+
+    Parameters
+    ----------
+    data : xarray.Dataset or xarray.DataArray
+        Data with coded coordinates (see encode_agent_coordinate and data_transform.add_region_sector).
+
+    Returns
+    -------
+    xarray.Dataset or xarray.DataArray
+        The data with label coordinates; coordinates that are not coded are left as they are.
+    """
+    decoded = {}
+    for name, coord in data.coords.items():
+        table = coordinate_code_table(data, name)
+        if table is None:
+            continue
+        labels = decode_agents(coord.values, table) if isinstance(table, AgentCodeTable) else table[coord.values]
+        attrs = {key: value for key, value in coord.attrs.items() if key not in AGENT_CODE_ATTRS + (LABEL_CODE_ATTR,)}
+        decoded[name] = (coord.dims, labels, attrs)
+    return data.assign_coords(decoded) if decoded else data
+
+
+def classify_agents(agents):
+    """
+    Classify agent names of the form 'type:region' into consumers and firms.
+
+    Consumers are the agents whose type is one of the short income quintile names (see
+    definitions.short_quintiles), all other agents are firms. The classification is vectorized with numpy
+    string operations and cached per agent coordinate, so repeated calls for the same agents are cheap.
+
+    Parameters
+    ----------
+    agents : array-like of str
+        The agent names, e.g. the values of an 'agent' coordinate.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        Boolean masks along the agents for consumers and firms.
+    """
+    names = np.asarray(agents)
+    if names.dtype.kind != "U":
+        names = names.astype(str)
+    return _cached(("masks",) + _array_key(names), lambda: _compute_agent_masks(names))
+
+
+def _compute_agent_masks(names):
+    agent_types = np.char.partition(names, ":")[..., 0]
+    consumer_mask = np.isin(agent_types, definitions.short_quintiles)
+    masks = (consumer_mask, ~consumer_mask)
+    for mask in masks:
+        mask.setflags(write=False)
+    return masks
+
+
+def _cached(key, compute):
+    """
+    Return the cached result for key, or compute and store it in the bounded LRU agent cache.
+    """
+    with _agent_cache_lock:
+        if key in _agent_cache:
+            _agent_cache.move_to_end(key)
+            return _agent_cache[key]
+    result = compute()
+    with _agent_cache_lock:
+        _agent_cache[key] = result
+        while len(_agent_cache) > AGENT_CACHE_SIZE:
+            _agent_cache.popitem(last=False)
+    return result
+
+
+def _array_key(values):
+    """
+    Key identifying the contents of a numpy array, used for caching results per agent coordinate.
+    """
+    values = np.ascontiguousarray(values)
+    return values.dtype.str, values.shape, hashlib.blake2b(values.tobytes(), digest_size=16).hexdigest()
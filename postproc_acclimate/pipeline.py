@@ -0,0 +1,285 @@
+''' Declarative post-processing pipeline for Acclimate ensembles.
+
+A pipeline lists the stages of a post-processing run (loading the ensemble, tidying agents, the region/sector
+transformation, aggregates, quantiles, baseline deviations and exports) without executing them. Running it
+builds one lazy graph in which all outputs share their intermediates, and computes only the requested exports
+in a single dask.compute, so the ensemble is read once instead of once per written and re-opened file.
+
+Example
+-------
+>>> pipeline = (EnsemblePipeline(ensembledir, pattern, "firms", ["production_value"])
+...             .tidy_agents()
+...             .add_region_sector()
+...             .aggregate("aggregates_regions", "region", {"EU27": definitions.WORLD_REGIONS["EU27"]})
+...             .baseline_deviation("baseline_deviation", "aggregates_regions", baseline_date)
+...             .quantiles("medians", [0.5])
+...             .export("medians", "medians.nc")
+...             .export("baseline_deviation", "baseline_deviation.csv", format="csv"))
+>>> pipeline.run()
+'''
+import os
+
+import dask
+import numpy as np
+import xarray as xr
+
+from postproc_acclimate import analysis_functions, caching, chunking, data_transform, helpers
+from postproc_acclimate import ensemble_data_combination as edc
+
+
+class EnsemblePipeline:
+    """
+    Declarative pipeline from ensemble files to exported results.
+
+    The stages are added with the methods below, which return the pipeline so they can be chained. The
+    stages tidy_agents and add_region_sector (and checkpoint) change the data passed on to the following
+    stages, while aggregate, quantiles and baseline_deviation add named results. tidy_agents works on the
+    single members before they are combined, so it has to be the first stage. Nothing is read or computed
+    before run.
+
+    Parameters
+    ----------
+    ensembledir : str
+        The directory containing the ensemble files.
+    pattern : re.Pattern
+        A compiled regular expression pattern with named groups to match filenames.
+    group_to_load : str, optional
+        The group within the NetCDF files to load (default is "firms").
+    group_variables : list of str, optional
+        The variables within the group to load. If None, all variables are loaded.
+    time_length : int, optional
+        If given, only members with this length of the time dimension are used. Incomplete runs are found from
+        the file metadata and skipped before opening them, see ensemble_data_combination.check_ensemble_completeness.
+    **load_kwargs
+        Further keyword arguments for ensemble_data_combination.load_ensemble_files, e.g. recursive, manifest
+        or tail_steps. By default, the files are opened with chunks planned for the stages of the pipeline.
+    """
+
+    def __init__(self, ensembledir, pattern, group_to_load="firms", group_variables=None, time_length=None,
+                 **load_kwargs):
+        self.ensembledir = ensembledir
+        self.pattern = pattern
+        self.group_to_load = group_to_load
+        self.group_variables = group_variables
+        self.time_length = time_length
+        self.load_kwargs = dict(load_kwargs)
+        self.stages = []
+        self.exports = []
+
+    def tidy_agents(self, encode=False):
+        """
+        Tidy the agent names of every member and keep the agents of the loaded group, see helpers.tidy_agents.
+
+        With encode=True, the agents are coded as int32 (see helpers.encode_agent_coordinate) for all following
+        stages, and the NetCDF and CSV exports are decoded to labels when writing. The code table is built once
+        over the agents of all members, so that the members are combined with the same codes.
+
+        Raises
+        ------
+        ValueError
+            If the pipeline has stages already, as the agents are tidied per member before combining them.
+        """
+        if self.stages:
+            raise ValueError("tidy_agents has to be the first stage of the pipeline and can only be added once")
+        return self._add_stage("tidy_agents", encode=encode)
+
+    def add_region_sector(self):
+        """
+        Transform the agent dimension into sector and region dimensions, see data_transform.add_region_sector.
+        """
+        return self._add_stage("add_region_sector")
+
+    def aggregate(self, name, dimension, dict, new_dimension_name=None, method="matrix", weights=None,
+                  statistic="sum"):
+        """
+        Add the result name aggregating the data, see analysis_functions.aggregate_by_dimension_dict.
+        """
+        return self._add_stage("aggregate", name, dimension=dimension, dict=dict, new_dimension_name=new_dimension_name,
+                               method=method, weights=weights, statistic=statistic)
+
+    def quantiles(self, name, q, dim="time", method="exact", relative_error=0.01):
+        """
+        Add the result name with quantiles of the data along dim, see analysis_functions.chunked_quantile.
+
+        With method="exact", the chunks are planned with dim whole from this stage on (with a rechunk point if
+        earlier stages need other chunks), so that every task holds dim for one block of the other dimensions.
+        With method="approximate", dim stays chunked and is read in a single pass with bounded memory.
+        """
+        return self._add_stage("quantiles", name, q=q, dim=dim, method=method, relative_error=relative_error)
+
+    def baseline_deviation(self, name, result, baseline_date=None, dimension="time", deviation="relative",
+                           baseline_name=None):
+        """
+        Add the result name with the relative or absolute deviation of a result from its value at baseline_date.
+
+        If baseline_date is None, the first value along dimension is the baseline. If baseline_name is given,
+        the baseline is added as a result with that name, too.
+        """
+        if deviation not in ("relative", "absolute"):
+            raise ValueError(f"Unknown deviation {deviation!r}, expected 'relative' or 'absolute'")
+        if baseline_name is not None and (baseline_name in ("data", name) or baseline_name in self._result_names):
+            raise ValueError(f"Result name {baseline_name!r} is already used")
+        return self._add_stage("baseline_deviation", name, result=result, baseline_date=baseline_date,
+                               dimension=dimension, deviation=deviation, baseline_name=baseline_name)
+
+    def checkpoint(self, path, reuse=True, format="netcdf"):
+        """
+        Write the data at this point of the pipeline to a NetCDF file or a Zarr store as part of the run.
+
+        If reuse is True and the file exists already, the following stages read the data from it instead of
+        from the previous stages. Coded coordinates (see tidy_agents) are written coded with their code
+        tables, e.g. to keep the combined ensemble with its agents before add_region_sector. Zarr stores are
+        written as the Zarr exports.
+        """
+        if format not in ("netcdf", "zarr"):
+            raise ValueError(f"Unknown checkpoint format {format!r}, expected 'netcdf' or 'zarr'")
+        return self._add_stage("checkpoint", path=path, reuse=reuse, format=format)
+
+    def export(self, name, path, format="netcdf"):
+        """
+        Export a result, or the data itself with name "data", to a NetCDF file, a Zarr store or a CSV file
+        when running.
+
+        Coded agent, sector and region coordinates (see tidy_agents) are decoded to labels in NetCDF and CSV
+        files, and kept coded with their code tables in Zarr stores.
+        A result can be exported to several files, e.g. to NetCDF and to CSV for plotting. Zarr stores are
+        written in parallel with a chunk layout planned for the later analyses (see
+        ensemble_data_combination.write_ensemble_store).
+        """
+        if format not in ("netcdf", "zarr", "csv"):
+            raise ValueError(f"Unknown export format {format!r}, expected 'netcdf', 'zarr' or 'csv'")
+        self.exports.append((name, path, format))
+        return self
+
+    def _add_stage(self, kind, name=None, **kwargs):
+        if name is not None and (name == "data" or name in self._result_names):
+            raise ValueError(f"Result name {name!r} is already used")
+        self.stages.append((kind, name, kwargs))
+        return self
+
+    @property
+    def _result_names(self):
+        names = []
+        for _, name, kwargs in self.stages:
+            names += [name, kwargs.get("baseline_name")]
+        return [name for name in names if name is not None]
+
+    @property
+    def operations(self):
+        """
+        The operations of the stages, used to plan the chunks (see chunking.plan_chunks).
+        """
+        operations = []
+        for kind, _, kwargs in self.stages:
+            if kind == "aggregate":
+                operations.append(("sum", (kwargs["dimension"],)))
+            elif kind == "quantiles":
+                operation = "quantile" if kwargs["method"] == "exact" else "chunked_quantile"
+                operations.append((operation, (kwargs["dim"],)))
+        return operations
+
+    def build(self):
+        """
+        Build the lazy data and results of all stages.
+
+        Returns
+        -------
+        dict
+            The lazy results by name, including the data after the last stage as "data".
+        list
+            Delayed writes of the checkpoints that are not reused.
+        """
+        load_kwargs = {"chunks": "plan", "operations": self.operations, "time_length": self.time_length,
+                       **self.load_kwargs}
+        members = edc.load_ensemble_files(self.ensembledir, self.pattern, self.group_to_load, self.group_variables,
+                                          **load_kwargs)
+        # agents are tidied per member, as the raw agent records can not be combined by coordinates
+        if self.stages and self.stages[0][0] == "tidy_agents":
+            table = None
+            if self.stages[0][2]["encode"]:
+                table = helpers.agent_code_table(np.concatenate(
+                    [helpers.decode_agent_coordinates(member["agent"].values).names for member in members
+                     if "agent" in member.dims]))
+            members = [helpers.tidy_agents(member, self.group_to_load, table=table, **self.stages[0][2])
+                       for member in members]
+        data = xr.combine_by_coords(members)
+
+        results = {}
+        checkpoints = []
+        operations = self.operations
+        for kind, name, kwargs in self.stages:
+            if kind == "add_region_sector":
+                data = data_transform.add_region_sector(data, chunks=None)
+            elif kind == "aggregate":
+                data = chunking.chunk_for_operations(data, operations)
+                operations = operations[1:]
+                results[name] = analysis_functions.aggregate_by_dimension_dict(data, **kwargs)
+            elif kind == "quantiles":
+                data = chunking.chunk_for_operations(data, operations)
+                operations = operations[1:]
+                results[name] = analysis_functions.chunked_quantile(data, **kwargs)
+            elif kind == "baseline_deviation":
+                result = results[kwargs["result"]]
+                baseline_date = kwargs["baseline_date"]
+                if baseline_date is None:
+                    baseline_date = result[kwargs["dimension"]].values[0]
+                baseline = data_transform.get_baseline_data(result, baseline_date, dimension=kwargs["dimension"])
+                deviation = result - baseline
+                results[name] = deviation / baseline if kwargs["deviation"] == "relative" else deviation
+                if kwargs["baseline_name"] is not None:
+                    results[kwargs["baseline_name"]] = baseline
+            elif kind == "checkpoint":
+                zarr = kwargs["format"] == "zarr"
+                if kwargs["reuse"] and os.path.exists(kwargs["path"]):
+                    data = edc.open_ensemble_store(kwargs["path"]) if zarr else xr.open_dataset(kwargs["path"], chunks={})
+                elif zarr:
+                    checkpoints.append(edc.write_ensemble_store(data, kwargs["path"], operations=operations, mode="w",
+                                                                compute=False))
+                else:
+                    checkpoints.append(data.to_netcdf(kwargs["path"], compute=False))
+        results["data"] = data
+        return results, checkpoints
+
+    def run(self, outputs=None, **compute_kwargs):
+        """
+        Build the pipeline and compute the requested exports (and checkpoints) in a single dask.compute.
+
+        Within an active result cache (see caching.result_cache), the cache writes of the stages are part of the
+        same computation.
+
+        Parameters
+        ----------
+        outputs : list of str, optional
+            Names of the results whose exports are written. Default is None, i.e. all exports.
+        **compute_kwargs
+            Keyword arguments passed to dask.compute, e.g. num_workers.
+
+        Returns
+        -------
+        list of str
+            The paths of the written exports.
+        """
+        exported = [name for name, _, _ in self.exports]
+        outputs = exported if outputs is None else outputs
+        unknown = [name for name in outputs if name not in exported]
+        if unknown:
+            raise KeyError(f"No exports of {unknown}, exported are {sorted(set(exported))}")
+        exports = [(name, path, format) for name, path, format in self.exports if name in outputs]
+
+        results, checkpoints = self.build()
+        writes = list(checkpoints) + caching.cache_writes()
+        tables = {}
+        for name, path, format in exports:
+            if format == "netcdf":
+                writes.append(helpers.decode_coordinates(results[name]).to_netcdf(path, compute=False))
+            elif format == "zarr":
+                writes.append(edc.write_ensemble_store(results[name], path, operations=self.operations, mode="w",
+                                                       compute=False))
+            else:
+                # decoding moves the coordinates, the columns are kept in the order of the coded dimensions
+                tables[path] = (helpers.decode_coordinates(results[name]), list(results[name].dims))
+
+        computed = dask.compute(tables, *writes, **compute_kwargs)[0]
+        for path, (result, dim_order) in computed.items():
+            result.to_dataframe(dim_order=dim_order).to_csv(path)
+        return [path for _, path, _ in exports]
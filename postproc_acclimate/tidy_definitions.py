@@ -1,5 +1,7 @@
-from iso3166 import countries_by_alpha3
-from pycountry_convert import country_alpha3_to_continent_code, convert_continent_code_to_continent_name
+import json
+import os
+
+from postproc_acclimate.definitions import WORLD_REGIONS
 
 # TODO important definitions such as standard region sets
 # TODO: unify, maybe base on *.yml lists of individual regions for easier sharing and use outside of this codebase
@@ -11,21 +13,50 @@ world_regions_keys = [
 
 continent_region_groups = ["AFR", "ASI", "EUR", "LAM", "NAM", "OCE"]
 
-#generate a dict of continental definitions using iso3166 codes
-continent_definitions = {}
-for region in continent_region_groups:
-    continent_definitions[region] = []
-
-for country_code in countries_by_alpha3.keys():
-    try:
-        continent_code = country_alpha3_to_continent_code(country_code)
-        continent_name = convert_continent_code_to_continent_name(continent_code)
-        for region in continent_region_groups:
-            if region[:3].upper() in continent_name.upper():
-                continent_definitions[region].append(country_code)
-    except KeyError:
-        continue
-    
+# prebuilt continent_definitions, loaded on first access (see __getattr__) and rebuilt by running this module
+CONTINENT_DEFINITIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data",
+                                          "continent_definitions.json")
+
+
+def build_continent_definitions():
+    """
+    Generate the dict of continental definitions using iso3166 codes.
+
+    Needs the packages iso3166 and pycountry_convert, which are only imported here.
+    """
+    from iso3166 import countries_by_alpha3
+    from pycountry_convert import (convert_continent_code_to_continent_name, country_alpha2_to_continent_code,
+                                   country_alpha3_to_country_alpha2)
+
+    continent_definitions = {}
+    for region in continent_region_groups:
+        continent_definitions[region] = []
+
+    for country_code in countries_by_alpha3.keys():
+        try:
+            continent_code = country_alpha2_to_continent_code(country_alpha3_to_country_alpha2(country_code))
+            continent_name = convert_continent_code_to_continent_name(continent_code)
+            for region in continent_region_groups:
+                if region[:3].upper() in continent_name.upper():
+                    continent_definitions[region].append(country_code)
+        except KeyError:
+            continue
+    return continent_definitions
+
+
+def __getattr__(name):
+    """
+    Load continent_definitions from CONTINENT_DEFINITIONS_FILE on first access, so that importing this module
+    neither imports nor loops over the country packages.
+    """
+    if name != "continent_definitions":
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with open(CONTINENT_DEFINITIONS_FILE) as file:
+        value = json.load(file)
+    globals()[name] = value
+    return value
+
+
 #TODO: generate dictonaries of political groups like EU, OECD, G20, BRICS
     
 # WORLD BANK region definitions & income groups based on 2021 data
@@ -115,3 +146,9 @@ dose_sector_groups = {"Agriculture":["AGRI","FISH"]
 
 
 # 
+
+
+if __name__ == "__main__":
+    with open(CONTINENT_DEFINITIONS_FILE, "w") as file:
+        json.dump(build_continent_definitions(), file, indent=1)
+        file.write("\n")
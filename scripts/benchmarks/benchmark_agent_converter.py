@@ -0,0 +1,75 @@
+""" Micro-benchmark of decoding the agent coordinate of Acclimate output.
+
+Builds a synthetic array of raw agent records the size of a full EORA + admin-1 run (every sector and
+every income quintile in every region of definitions.region_names) and compares the time of the previous
+per-agent decoder with helpers.decode_agent_names. Both have to give the same agent names.
+
+Usage: python benchmark_agent_converter.py [repetitions]
+"""
+import sys
+import time
+
+import numpy as np
+
+from postproc_acclimate import definitions, helpers
+
+NAME_LENGTH = 40
+
+
+def synthetic_agents():
+    """ Raw agent records with a fixed-width name field as written by Acclimate. """
+    names = []
+    for region in definitions.region_names:
+        names += [sector + ":" + region for sector in definitions.sector_names]
+        names += [quintile + ":" + region for quintile in definitions.long_quintiles]
+    agents = np.zeros(len(names), dtype=[("name", "S1", (NAME_LENGTH,)), ("type", "i1")])
+    agents["name"] = np.frombuffer(b"".join(name.encode().ljust(NAME_LENGTH, b"\0") for name in names),
+                                   dtype="S1").reshape(len(names), NAME_LENGTH)
+    return agents
+
+
+def previous_converter(agents):
+    """ Reference: the previous decoder, quadratic in the number of consumers. """
+    agent_names = []
+    for agent in agents:
+        agent_name = agent[0].tobytes().decode("utf-8").rstrip('\x00')
+        if agent_name:
+            agent_names.append(agent_name)
+
+    new_consumer_names = []
+    old_consumer_names = []
+    region = agent_names[0].split(":")[1]
+    for agent_name in agent_names:
+        if 'income_quintile' not in agent_name:
+            region = agent_name.split(":")[1]
+        for quintile, new_quintile in zip(definitions.long_quintiles, definitions.short_quintiles):
+            if quintile in agent_name:
+                old_consumer_names.append(agent_name)
+                new_consumer_names.append(new_quintile + ":" + region)
+
+    new_agent_names = agent_names.copy()
+    for old, new in zip(old_consumer_names, new_consumer_names):
+        new_agent_names = [new if agent is old else agent for agent in new_agent_names]
+    return new_agent_names
+
+
+def best_time(function, agents, repetitions):
+    timings = []
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        result = function(agents)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+if __name__ == "__main__":
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    agents = synthetic_agents()
+    print(f"{len(agents)} agents in {len(definitions.region_names)} regions")
+
+    previous_time, previous_names = best_time(previous_converter, agents, repetitions)
+    current_time, current_names = best_time(helpers.decode_agent_names, agents, repetitions)
+    assert previous_names == current_names
+
+    print(f"previous converter: {1000 * previous_time:10.2f} ms")
+    print(f"decode_agent_names: {1000 * current_time:10.2f} ms ({previous_time / current_time:.0f}x faster)")
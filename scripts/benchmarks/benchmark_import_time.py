@@ -0,0 +1,67 @@
+""" Benchmark the import time of the postproc_acclimate modules imported by dask workers.
+
+Imports every module in a fresh interpreter and reports the best wall time over the repetitions. Each import
+has to be free of side effects: it must not import matplotlib or the country packages (iso3166,
+pycountry_convert), and must not start subprocesses such as versioneer's git calls. Finally, the lazily built
+definitions are compared with building them directly.
+
+Usage: python benchmark_import_time.py [repetitions]
+"""
+import json
+import subprocess
+import sys
+
+MODULES = ["postproc_acclimate", "postproc_acclimate.definitions", "postproc_acclimate.tidy_definitions",
+           "postproc_acclimate.helpers"]
+
+HEAVY_MODULES = ["matplotlib", "iso3166", "pycountry_convert"]
+
+# run in a fresh interpreter: count subprocesses started during the import and time it
+IMPORT_SNIPPET = """
+import importlib, json, subprocess, sys, time
+started = []
+original_init = subprocess.Popen.__init__
+def counting_init(self, *args, **kwargs):
+    started.append(args[0] if args else kwargs.get("args"))
+    original_init(self, *args, **kwargs)
+subprocess.Popen.__init__ = counting_init
+start = time.perf_counter()
+importlib.import_module({module!r})
+duration = time.perf_counter() - start
+print(json.dumps({{"seconds": duration, "subprocesses": len(started),
+                  "heavy": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+# the lazy definitions have to equal the ones built directly
+CHECK_SNIPPET = """
+from postproc_acclimate import definitions, tidy_definitions
+assert definitions.agent_colors == definitions.pik_color_list(5)
+assert len(definitions.agent_colors_list) == 5
+try:
+    built = tidy_definitions.build_continent_definitions()
+except ImportError:
+    print("iso3166/pycountry_convert not installed, prebuilt continent_definitions not checked")
+else:
+    assert tidy_definitions.continent_definitions == built, "continent_definitions.json is outdated"
+import postproc_acclimate
+print("__version__", postproc_acclimate.__version__)
+"""
+
+
+def import_module(module):
+    """ Import module in a fresh interpreter and return its timing, subprocesses and heavy imports. """
+    output = subprocess.run([sys.executable, "-c", IMPORT_SNIPPET.format(module=module, heavy=HEAVY_MODULES)],
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    repetitions = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for module in MODULES:
+        results = [import_module(module) for _ in range(repetitions)]
+        best = min(result["seconds"] for result in results)
+        print(f"{module:40s} {1000 * best:10.2f} ms")
+        assert not results[0]["subprocesses"], f"importing {module} started subprocesses"
+        assert not results[0]["heavy"], f"importing {module} imported {results[0]['heavy']}"
+
+    subprocess.run([sys.executable, "-c", CHECK_SNIPPET], check=True)
@@ -0,0 +1,76 @@
+""" Benchmark opening a synthetic ensemble with load_ensemble_files.
+
+Writes a synthetic 500-member ensemble of grouped NetCDF files to a temporary directory and reports the
+number of ``xr.open_datatree`` calls and the wall time per file, both for the previous loading scheme
+(one open for the data and one more for the group's own dimensions) and for the current single-open path.
+
+Usage: python benchmark_load_ensemble_files.py [number_of_members]
+"""
+import sys
+import tempfile
+import time
+
+import xarray as xr
+
+import postproc_acclimate.ensemble_data_combination as edc
+from synthetic_ensemble import PATTERN, write_ensemble
+
+GROUP = "firms"
+VARIABLES = ["production_value", "production_quantity", "forcing"]
+
+
+class OpenCounter:
+    """ Wrap xr.open_datatree and count its calls. """
+
+    def __init__(self):
+        self.calls = 0
+        self.original = xr.open_datatree
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        return self.original(*args, **kwargs)
+
+    def __enter__(self):
+        xr.open_datatree = self
+        return self
+
+    def __exit__(self, *exc):
+        xr.open_datatree = self.original
+
+
+def open_twice(file):
+    """ Reference: the previous loading scheme opening the DataTree twice per file. """
+    dataset = xr.open_datatree(file, chunks='auto')[GROUP].to_dataset()[VARIABLES]
+    tmp_data = xr.open_datatree(file, chunks='auto')[GROUP].to_dataset(inherit=False)
+    remaining_dims = tmp_data[VARIABLES].dims
+    for dim in dataset.dims:
+        if dim not in remaining_dims:
+            dataset = dataset.drop_vars(dim)
+    return dataset
+
+
+def report(label, n_files, counter, seconds):
+    print(f"{label:>12}: {counter.calls:6d} opens ({counter.calls / n_files:.1f} per file), "
+          f"{seconds:8.2f} s total, {1000 * seconds / n_files:8.2f} ms per file")
+
+
+if __name__ == "__main__":
+    n_members = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    with tempfile.TemporaryDirectory() as ensembledir:
+        files = write_ensemble(ensembledir, n_members=n_members)
+
+        with OpenCounter() as counter:
+            start = time.perf_counter()
+            for f in files:
+                open_twice(f)
+            report("two opens", len(files), counter, time.perf_counter() - start)
+
+        with OpenCounter() as counter:
+            start = time.perf_counter()
+            datasets = edc.load_ensemble_files(ensembledir, PATTERN, GROUP, VARIABLES)
+            report("single open", len(files), counter, time.perf_counter() - start)
+
+        assert len(datasets) == len(files)
+        assert set(datasets[0].dims) == {"storage_capacity", "forcing_amplitude", "model", "scenario",
+                                         "timeperiod", "time", "agent"}, datasets[0].dims
+        print(f"loaded {len(datasets)} members")
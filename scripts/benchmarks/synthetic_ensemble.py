@@ -0,0 +1,61 @@
+""" Synthetic Acclimate-like output files for the benchmark scripts in this directory.
+
+The files mimic the layout of grouped Acclimate output: a root group holding the shared
+coordinates (time, agent, sector, region) and a ``firms`` group holding the variables per agent.
+Parameters are encoded in the filename in the same way as for the storage sensitivity ensembles.
+"""
+import itertools
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+FILENAME_TEMPLATE = "storage_capacity_{storage_capacity}_forcing_amplitude_{forcing_amplitude}_DOSE_TAS_PR_MPI-ESM1-2-HR-ssp370_2024-2034.nc"
+
+PATTERN = re.compile(
+    r"storage_capacity_(?P<storage_capacity>\d+)_" +
+    r"forcing_amplitude_(?P<forcing_amplitude>\d+\.\d+)_" +
+    r"DOSE_TAS_PR_(?P<model>[a-zA-Z0-9\-]+)-" +
+    r"(?P<scenario>ssp[0-9\-]+)_" +
+    r"(?P<timeperiod>\d+-\d+)\.nc"
+)
+
+SECTORS = ["AGRI", "FOOD", "MANU", "TRAN"]
+REGIONS = ["CHN", "DEU", "USA", "ZAF"]
+
+
+def member_dataset(n_time=30, seed=0):
+    """
+    Create the data of one ensemble member as a DataTree with a root and a ``firms`` group.
+    """
+    rng = np.random.default_rng(seed)
+    agents = [sector + ":" + region for sector in SECTORS for region in REGIONS]
+    time = pd.date_range("2024-01-01", periods=n_time, freq="D")
+    root = xr.Dataset(coords={"time": time, "agent": agents, "sector": SECTORS, "region": REGIONS})
+    shape = (n_time, len(agents))
+    firms = xr.Dataset(
+        {
+            "production_value": (("time", "agent"), rng.random(shape)),
+            "production_quantity": (("time", "agent"), rng.random(shape)),
+            "forcing": (("time", "agent"), rng.random(shape)),
+        }
+    )
+    return xr.DataTree.from_dict({"/": root, "/firms": firms})
+
+
+def write_ensemble(directory, n_members=500, n_time=30):
+    """
+    Write ``n_members`` synthetic member files to ``directory`` and return their paths.
+    """
+    os.makedirs(directory, exist_ok=True)
+    n_capacity = int(np.ceil(np.sqrt(n_members)))
+    grid = itertools.product(range(n_capacity), range(n_capacity))
+    files = []
+    for i_member, (capacity, amplitude) in zip(range(n_members), grid):
+        filename = os.path.join(directory, FILENAME_TEMPLATE.format(
+            storage_capacity=capacity, forcing_amplitude="{:.1f}".format(amplitude / 10)))
+        member_dataset(n_time, seed=i_member).to_netcdf(filename)
+        files.append(filename)
+    return files
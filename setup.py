@@ -51,7 +51,10 @@ REQUIREMENTS_DEV = [
     "pylint",
 ] + REQUIREMENTS_DOCS
 
+REQUIREMENTS_ZARR = ["zarr"]
+
 REQUIREMENTS_EXTRAS = {
+    "zarr": REQUIREMENTS_ZARR,
     "docs": REQUIREMENTS_DOCS,
     "dev": REQUIREMENTS_DEV,
 }
@@ -71,6 +74,7 @@ setup(
     license=LICENSE,
     classifiers=CLASSIFIERS,
     packages=find_packages(exclude=["tests"]),
+    package_data={NAME: ["data/*.json"]},
     install_requires=REQUIREMENTS_INSTALL,
     extras_require=REQUIREMENTS_EXTRAS,
 )
@@ -0,0 +1,49 @@
+import itertools
+import os
+import re
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+SECTORS = ["AGRI", "FOOD", "MANU", "TRAN"]
+REGIONS = ["DEU", "FRA", "ZAF"]
+
+FILENAME_TEMPLATE = "storage_capacity_{storage_capacity}_forcing_amplitude_{forcing_amplitude}_DOSE_TAS_PR_MPI-ESM1-2-HR-ssp370_2024-2034.nc"
+
+PATTERN = re.compile(
+    r"storage_capacity_(?P<storage_capacity>\d+)_" +
+    r"forcing_amplitude_(?P<forcing_amplitude>\d+\.\d+)_" +
+    r"DOSE_TAS_PR_(?P<model>[a-zA-Z0-9\-]+)-" +
+    r"(?P<scenario>ssp[0-9\-]+)_" +
+    r"(?P<timeperiod>\d+-\d+)\.nc"
+)
+
+
+def write_member(path, n_time=12, seed=0, regions=REGIONS):
+    """Write a file in the layout of grouped Acclimate output: shared coordinates and a firms group."""
+    rng = np.random.default_rng(seed)
+    agents = sorted(sector + ":" + region for sector in SECTORS for region in regions)
+    root = xr.Dataset(coords={"time": pd.date_range("2024-01-01", periods=n_time, freq="D"), "agent": agents,
+                              "sector": SECTORS, "region": list(regions)})
+    shape = (n_time, len(agents))
+    firms = xr.Dataset({"production_value": (("time", "agent"), rng.random(shape)),
+                        "forcing": (("time", "agent"), rng.random(shape))})
+    xr.DataTree.from_dict({"/": root, "/firms": firms}).to_netcdf(path)
+    return path
+
+
+def member_path(directory, storage_capacity, forcing_amplitude):
+    return os.path.join(directory, FILENAME_TEMPLATE.format(storage_capacity=storage_capacity,
+                                                            forcing_amplitude=forcing_amplitude))
+
+
+@pytest.fixture
+def ensemble_dir(tmp_path):
+    """A directory with a complete 2 x 2 ensemble of storage capacities and forcing amplitudes."""
+    directory = tmp_path / "runs"
+    directory.mkdir()
+    for seed, (capacity, amplitude) in enumerate(itertools.product([0, 1], ["0.0", "0.1"])):
+        write_member(member_path(directory, capacity, amplitude), seed=seed)
+    return str(directory)
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+from postproc_acclimate import analysis_functions, data_transform, helpers
+
+AGENTS = ["AGRI:DEU", "AGRI:US.CA", "AGRI:US.TX", "Food processing:DEU", "Food processing:US.CA",
+          "Food processing:US.TX", "q1:DEU"]
+REGIONS = {"US": ["US.CA", "US.TX"], "EU": ["DEU"]}
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    return xr.DataArray(rng.random((4, len(AGENTS))), dims=("time", "agent"), coords={"agent": AGENTS},
+                        name="production_value")
+
+
+def test_round_trip_of_labels_with_spaces(data, tmp_path):
+    table = helpers.agent_code_table(AGENTS)
+    coded = helpers.encode_agent_coordinate(data, table)
+    assert coded["agent"].dtype == np.int32
+    coded.to_netcdf(tmp_path / "coded.nc")
+    reopened = xr.open_dataarray(tmp_path / "coded.nc")
+    xr.testing.assert_identical(helpers.decode_coordinates(reopened).load(), data)
+    assert "Food processing" in helpers.coordinate_code_table(reopened, "agent").sectors
+
+
+def test_add_region_sector_of_codes_equals_labels(data, tmp_path):
+    expected = data_transform.add_region_sector(data, chunks=None)
+    coded = data_transform.add_region_sector(helpers.encode_agent_coordinate(data), chunks=None)
+    coded.to_netcdf(tmp_path / "coded.nc")
+    reopened = xr.open_dataarray(tmp_path / "coded.nc")
+    xr.testing.assert_identical(helpers.decode_coordinates(reopened).load(), expected)
+
+
+def test_aggregate_of_codes_equals_labels(data):
+    expected = analysis_functions.aggregate_by_dimension_dict(data_transform.add_region_sector(data, chunks=None),
+                                                              "region", REGIONS)
+    coded = helpers.encode_agent_coordinate(data)
+    result = analysis_functions.aggregate_by_dimension_dict(data_transform.add_region_sector(coded, chunks=None),
+                                                            "region", REGIONS)
+    xr.testing.assert_allclose(helpers.decode_coordinates(result), expected)
+
+
+def test_tidy_agents_encodes_subregions(data):
+    dataset = data.to_dataset()
+    expected = helpers.tidy_agents(dataset)
+    coded = helpers.tidy_agents(dataset, encode=True)
+    xr.testing.assert_identical(helpers.decode_coordinates(coded), expected)
+    assert "US.CA" in helpers.coordinate_code_table(coded, "agent").regions
+
+
+def test_labels_missing_from_the_table(data):
+    with pytest.raises(KeyError, match="agent_code_table"):
+        helpers.encode_agent_coordinate(data, helpers.agent_code_table())
@@ -0,0 +1,85 @@
+import os
+
+import dask
+import dask.array as da
+import xarray as xr
+
+from postproc_acclimate import analysis_functions, caching, data_transform, helpers
+from postproc_acclimate.pipeline import EnsemblePipeline
+
+from conftest import PATTERN
+
+REGIONS = {"EU": ["DEU", "FRA"], "ZAF": ["ZAF"]}
+
+
+def cached_files(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(".nc"))
+
+
+def run_pipeline(ensemble_dir, output_dir):
+    pipeline = (EnsemblePipeline(ensemble_dir, PATTERN, "firms", ["production_value"])
+                .tidy_agents()
+                .add_region_sector()
+                .aggregate("aggregates", "region", REGIONS)
+                .quantiles("medians", [0.5]))
+    pipeline.export("aggregates", os.path.join(output_dir, "aggregates.nc"))
+    pipeline.export("medians", os.path.join(output_dir, "medians.nc"))
+    pipeline.run()
+    return {name: xr.load_dataset(os.path.join(output_dir, name + ".nc")) for name in ("aggregates", "medians")}
+
+
+def test_repeated_pipeline_runs_hit_the_cache(ensemble_dir, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    expected = run_pipeline(ensemble_dir, str(tmp_path))
+    with caching.result_cache(cache_dir):
+        first = run_pipeline(ensemble_dir, str(tmp_path))
+    files = cached_files(cache_dir)
+    assert files
+    for _ in range(2):
+        with caching.result_cache(cache_dir):
+            again = run_pipeline(ensemble_dir, str(tmp_path))
+        assert cached_files(cache_dir) == files
+        for name in expected:
+            xr.testing.assert_allclose(again[name], expected[name])
+            xr.testing.assert_allclose(first[name], expected[name])
+
+
+def test_miss_stays_lazy_and_hit_keeps_its_names(ensemble_dir, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    name = sorted(os.listdir(ensemble_dir))[0]
+    data = helpers.tidy_agents(xr.open_datatree(os.path.join(ensemble_dir, name), chunks={})["firms"].to_dataset())
+    expected = analysis_functions.aggregate_by_dimension_dict(
+        data_transform.add_region_sector(data), "region", REGIONS).compute()
+    with caching.result_cache(cache_dir):
+        result = analysis_functions.aggregate_by_dimension_dict(data_transform.add_region_sector(data), "region",
+                                                                REGIONS)
+        assert isinstance(result["production_value"].data, da.Array)
+        assert not cached_files(cache_dir)
+        computed, *_ = dask.compute(result, *caching.cache_writes())
+    assert len(cached_files(cache_dir)) == 2
+    xr.testing.assert_allclose(computed, expected)
+
+    with caching.result_cache(cache_dir):
+        transformed = data_transform.add_region_sector(data)
+        hit = analysis_functions.aggregate_by_dimension_dict(transformed, "region", REGIONS)
+        assert not caching.cache_writes()
+    # read from the cached file, under the names of the lazy result
+    assert dask.base.tokenize(hit) == dask.base.tokenize(result)
+    assert len(hit.__dask_graph__()) < len(result.__dask_graph__())
+    xr.testing.assert_allclose(hit.compute(), expected)
+
+
+def test_evict_keeps_the_recently_used_results(tmp_path):
+    directory = str(tmp_path)
+    paths = []
+    for i in range(3):
+        path = os.path.join(directory, f"{i}.da.nc")
+        xr.DataArray(range(1000), dims="x").to_netcdf(path)
+        os.utime(path, ns=(i * 10**9, i * 10**9))
+        paths.append(path)
+    # a hit on the oldest result only updates its access time
+    mtime = os.stat(paths[0]).st_mtime_ns
+    os.utime(paths[0], ns=(10 * 10**9, mtime))
+    caching.evict(directory, 2 * os.path.getsize(paths[0]))
+    assert cached_files(directory) == ["0.da.nc", "2.da.nc"]
+    assert os.stat(paths[0]).st_mtime_ns == mtime
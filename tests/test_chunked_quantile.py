@@ -0,0 +1,94 @@
+import dask
+import dask.array as da
+import numpy as np
+import pytest
+import xarray as xr
+from dask.callbacks import Callback
+
+from postproc_acclimate import analysis_functions
+
+QUANTILES = [0, 0.1, 0.5, 0.9, 1]
+
+
+class PeakMemory(Callback):
+    """Track the largest number of bytes held in the scheduler cache while computing."""
+
+    def __init__(self):
+        super().__init__()
+        self.peak = 0
+
+    def _posttask(self, key, result, dsk, state, worker_id):
+        self.peak = max(self.peak, sum(getattr(value, "nbytes", 0) for value in state["cache"].values()))
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(1)
+    values = rng.lognormal(0, 3, (20, 1000)) * np.where(rng.random((20, 1000)) < 0.3, -1, 1)
+    values[rng.random(values.shape) < 0.05] = np.nan
+    values[0] = np.nan
+    values[2, ::3] = 0
+    values[3] = 7.0
+    return xr.DataArray(values, dims=("agent", "time"), name="production_value").chunk({"time": 50})
+
+
+def test_exact_equals_xarray(data):
+    expected = data.compute().quantile(QUANTILES, dim="time")
+    result = analysis_functions.chunked_quantile(data, QUANTILES)
+    assert isinstance(result.data, da.Array)
+    # equal up to rounding, numpy's nanquantile takes another path per block
+    xr.testing.assert_allclose(result.compute(), expected, rtol=1e-12)
+
+
+def test_exact_dataset_equals_xarray(data):
+    dataset = data.to_dataset()
+    expected = dataset.compute().quantile(0.5, dim="time")
+    xr.testing.assert_allclose(analysis_functions.chunked_quantile(dataset, 0.5).compute(), expected, rtol=1e-12)
+
+
+def test_approximate_within_relative_error(data):
+    expected = data.compute().quantile(QUANTILES, dim="time")
+    result = analysis_functions.chunked_quantile(data, QUANTILES, method="approximate", relative_error=0.01)
+    assert result.dims == expected.dims
+    assert result.name == expected.name
+    result = result.compute()
+    np.testing.assert_array_equal(np.isnan(result), np.isnan(expected))
+    np.testing.assert_allclose(result, expected, rtol=0.01)
+
+
+def test_approximate_scalar_quantile(data):
+    result = analysis_functions.chunked_quantile(data, 0.5, method="approximate")
+    expected = data.compute().quantile(0.5, dim="time")
+    assert result.dims == expected.dims
+    assert float(result["quantile"]) == 0.5
+    np.testing.assert_allclose(result, expected, rtol=0.01)
+
+
+def test_approximate_memory_is_bounded():
+    # 200 chunks along time, each released once it is counted into a histogram
+    source = da.random.default_rng(0).random((8, 200_000), chunks=(8, 1000))
+    data = xr.DataArray(source, dims=("agent", "time"))
+    result = analysis_functions.chunked_quantile(data, [0.5], method="approximate")
+    with PeakMemory() as memory, dask.config.set(scheduler="threads"):
+        result = result.compute()
+    chunk_bytes = source.blocks[0, 0].nbytes
+    assert memory.peak < 32 * chunk_bytes
+    np.testing.assert_allclose(result, data.compute().quantile([0.5], dim="time"), rtol=0.01)
+
+
+def test_exact_memory_is_bounded_by_one_block_of_the_dimension():
+    source = da.random.default_rng(0).random((8, 40_000), chunks=(2, 1000))
+    data = xr.DataArray(source, dims=("agent", "time"))
+    # blocks of two agents with the whole time dimension
+    with dask.config.set({"array.chunk-size": "700KiB"}):
+        result = analysis_functions.chunked_quantile(data, [0.5])
+    with PeakMemory() as memory, dask.config.set(scheduler="threads"):
+        result = result.compute()
+    column_bytes = source.nbytes // source.numblocks[0]
+    assert memory.peak <= 2 * column_bytes
+    xr.testing.assert_identical(result, data.compute().quantile([0.5], dim="time"))
+
+
+def test_unknown_method(data):
+    with pytest.raises(ValueError):
+        analysis_functions.chunked_quantile(data, 0.5, method="radix")
@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from postproc_acclimate import ensemble_data_combination as edc
+
+LABELS = [("MPI-ESM1-2-HR", "ssp370"), ("MPI-ESM1-2-HR", "ssp585"), ("GFDL-ESM4", "ssp370")]
+
+
+def member(start, seed):
+    rng = np.random.default_rng(seed)
+    return xr.Dataset({"production_value": (("time", "agent"), rng.random((4, 2)))},
+                      coords={"time": pd.date_range(start, periods=4, freq="D"), "agent": ["AGRI:DEU", "AGRI:ZAF"]})
+
+
+def expected_combination(datasets):
+    return xr.merge([data.expand_dims(model=[model], scenario=[scenario])
+                     for data, (model, scenario) in zip(datasets, LABELS)], join="outer", compat="no_conflicts")
+
+
+def test_stacked_members_equal_merge():
+    datasets = [member("2024-01-01", seed) for seed in range(3)]
+    result = edc.combine_ensemble_members(datasets, LABELS, ["model", "scenario"])
+    xr.testing.assert_identical(result, expected_combination(datasets).transpose("model", "scenario", ...))
+
+
+def test_merged_members_leave_the_inputs_unchanged():
+    # different time coordinates take the merge fallback
+    datasets = [member(start, seed) for seed, start in enumerate(["2024-01-01", "2024-01-03", "2024-01-01"])]
+    copies = [data.copy(deep=True) for data in datasets]
+    result = edc.combine_ensemble_members(datasets, LABELS, ["model", "scenario"], padding="ignore")
+    for data, copy in zip(datasets, copies):
+        xr.testing.assert_identical(data, copy)
+    xr.testing.assert_identical(result, expected_combination(copies))
@@ -0,0 +1,75 @@
+import itertools
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from postproc_acclimate import ensemble_data_combination as edc
+
+MODEL = "MPI-ESM1-2-HR"
+SCENARIOS = ["ssp370", "ssp585"]
+TIMEPERIODS = {"2024-2034": "2024-01-01", "2034-2044": "2034-01-01"}
+
+
+def write_output(directory, scenario, timeperiod, start, variables=("production_value", "consumption_value"),
+                 suffix="", seed=0):
+    """Write an output file without groups to directory/model/scenario/."""
+    rng = np.random.default_rng(seed)
+    path = os.path.join(directory, MODEL, scenario, "acclimate_{}-{}_{}{}.nc".format(MODEL, timeperiod, scenario,
+                                                                                   suffix))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    coords = {"time": pd.date_range(start, periods=6, freq="D"), "agent": ["AGRI:DEU", "AGRI:ZAF", "MANU:DEU"]}
+    data = xr.Dataset({name: (("time", "agent"), rng.random((6, 3))) for name in variables}, coords=coords)
+    data.to_netcdf(path)
+    return path
+
+
+@pytest.fixture
+def ensemble_tree(tmp_path):
+    files = {}
+    for seed, (scenario, (timeperiod, start)) in enumerate(itertools.product(SCENARIOS, TIMEPERIODS.items())):
+        files[(scenario, timeperiod)] = [write_output(str(tmp_path), scenario, timeperiod, start, seed=seed)]
+    return str(tmp_path), files
+
+
+def expected_ensemble(files):
+    datasets = []
+    for (scenario, timeperiod), paths in files.items():
+        data = xr.merge([xr.load_dataset(path) for path in paths])
+        datasets.append(data.expand_dims(model=[MODEL], scenario=[scenario], timeperiod=[timeperiod]))
+    return xr.combine_by_coords(datasets, join="outer")
+
+
+def test_create_ensemble_dataset(ensemble_tree):
+    basedir, files = ensemble_tree
+    result = edc.create_ensemble_dataset(basedir, modellist=[MODEL])
+    xr.testing.assert_allclose(result.load(), expected_ensemble(files))
+
+
+def test_create_ensemble_dataset_planned_chunks(ensemble_tree):
+    basedir, files = ensemble_tree
+    result = edc.create_ensemble_dataset(basedir, modellist=[MODEL], variable_selection=["production_value"],
+                                         chunks="plan")
+    assert result["production_value"].chunks is not None
+    xr.testing.assert_allclose(result.load(), expected_ensemble(files)[["production_value"]])
+
+
+def test_create_ensemble_dataset_stitched(ensemble_tree):
+    basedir, files = ensemble_tree
+    result = edc.create_ensemble_dataset(basedir, modellist=[MODEL], concat_timeperiods=True)
+    expected = expected_ensemble(files)
+    expected = xr.concat([expected.sel(timeperiod=timeperiod, drop=True).dropna("time", how="all")
+                          for timeperiod in TIMEPERIODS], dim="time")
+    xr.testing.assert_allclose(result.load(), expected.transpose(*result["production_value"].dims))
+
+
+def test_time_period_split_into_several_files(ensemble_tree):
+    basedir, files = ensemble_tree
+    key = ("ssp585", "2034-2044")
+    os.remove(files[key][0])
+    files[key] = [write_output(basedir, *key, TIMEPERIODS[key[1]], [name], suffix="_" + name, seed=seed)
+                  for seed, name in enumerate(("production_value", "consumption_value"), 10)]
+    result = edc.create_ensemble_dataset(basedir, modellist=[MODEL])
+    xr.testing.assert_allclose(result.load(), expected_ensemble(files))
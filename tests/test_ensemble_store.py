@@ -0,0 +1,81 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from postproc_acclimate import ensemble_data_combination as edc
+
+from conftest import PATTERN, member_path, write_member
+
+pytest.importorskip("zarr")
+
+
+def load_ensemble(directory):
+    members = edc.load_ensemble_files(directory, PATTERN, "firms", ["production_value"], executor=None)
+    return xr.combine_by_coords(members)
+
+
+def stored_ensemble(store):
+    stored = edc.open_ensemble_store(store)
+    return stored.sortby(["storage_capacity", "forcing_amplitude"]).compute()
+
+
+def test_append_members_with_new_values_along_two_dimensions(ensemble_dir, tmp_path):
+    store = str(tmp_path / "ensemble.zarr")
+    expected = load_ensemble(ensemble_dir)
+    first = expected.sel(storage_capacity=[0], forcing_amplitude=[0.0])
+    edc.append_ensemble_members(first, store)
+    # new values of both parameters at once, previously only possible by rewriting the store
+    edc.append_ensemble_members(expected.sel(storage_capacity=[1], forcing_amplitude=[0.1]), store)
+    partial = stored_ensemble(store)
+    assert partial.sizes["storage_capacity"] == 2 and partial.sizes["forcing_amplitude"] == 2
+    xr.testing.assert_allclose(partial.sel(storage_capacity=[1], forcing_amplitude=[0.1]),
+                               expected.sel(storage_capacity=[1], forcing_amplitude=[0.1]).compute())
+    assert partial["production_value"].sel(storage_capacity=0, forcing_amplitude=0.1).isnull().all()
+
+    edc.append_ensemble_members(expected.sel(storage_capacity=[1], forcing_amplitude=[0.0]), store)
+    edc.append_ensemble_members(expected.sel(storage_capacity=[0], forcing_amplitude=[0.1]), store)
+    xr.testing.assert_allclose(stored_ensemble(store), expected.compute())
+
+
+def test_append_members_into_a_given_grid(ensemble_dir, tmp_path):
+    store = str(tmp_path / "ensemble.zarr")
+    expected = load_ensemble(ensemble_dir)
+    grid = {"storage_capacity": [0, 1, 2], "forcing_amplitude": [0.0, 0.1]}
+    edc.append_ensemble_members(expected.sel(storage_capacity=[1]), store, grid=grid)
+    stored = stored_ensemble(store)
+    assert list(stored["storage_capacity"].values) == [0, 1, 2]
+    assert stored["production_value"].sel(storage_capacity=[0, 2]).isnull().all()
+    edc.append_ensemble_members(expected.sel(storage_capacity=[0]), store, grid=grid)
+    xr.testing.assert_allclose(stored_ensemble(store).sel(storage_capacity=[0, 1]), expected.compute())
+
+
+def test_update_store_while_the_ensemble_runs(ensemble_dir, tmp_path):
+    store = str(tmp_path / "ensemble.zarr")
+    expected = load_ensemble(ensemble_dir)
+    running = tmp_path / "running"
+    running.mkdir()
+    files = sorted(os.listdir(ensemble_dir))
+    # the first and last member differ in both parameters, the last one is still running
+    shutil.copy(os.path.join(ensemble_dir, files[0]), running)
+    unfinished = write_member(member_path(running, 1, "0.1"), seed=3)
+    with xr.open_datatree(unfinished) as tree:
+        tree = tree.load()
+    tree["firms"]["production_value"][-2:] = np.nan
+    tree.to_netcdf(unfinished)
+
+    report = edc.update_ensemble_store(str(running), PATTERN, store, "firms", ["production_value"], executor=None)
+    assert report["new"] == [os.path.join(running, files[0])] and list(report["incomplete"]) == [unfinished]
+    stored = stored_ensemble(store)
+    assert stored["member_loaded"].sum() == 1
+    assert stored.sizes["forcing_amplitude"] == 2
+
+    for name in files[1:]:
+        shutil.copy(os.path.join(ensemble_dir, name), running)
+    report = edc.update_ensemble_store(str(running), PATTERN, store, "firms", ["production_value"], executor=None)
+    assert len(report["new"]) == 3 and report["existing"] == 1
+    stored = stored_ensemble(store)
+    assert stored["member_loaded"].all()
+    xr.testing.assert_allclose(stored.drop_vars("member_loaded"), expected.compute())
@@ -0,0 +1,40 @@
+import concurrent.futures
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from postproc_acclimate import ensemble_data_combination as edc
+
+from conftest import PATTERN, member_path, write_member
+
+
+class CountingExecutor(concurrent.futures.ThreadPoolExecutor):
+    """A thread pool counting the submitted calls by function name."""
+
+    def __init__(self):
+        super().__init__(max_workers=4)
+        self.calls = {}
+
+    def submit(self, function, *args, **kwargs):
+        name = getattr(function, "func", function).__name__
+        self.calls[name] = self.calls.get(name, 0) + 1
+        return super().submit(function, *args, **kwargs)
+
+
+def test_given_executor_checks_completeness(ensemble_dir):
+    unfinished = write_member(member_path(ensemble_dir, 2, "0.0"), seed=5)
+    with xr.open_datatree(unfinished) as tree:
+        tree = tree.load()
+    tree["firms"]["production_value"][-1] = np.nan
+    tree.to_netcdf(unfinished)
+
+    with CountingExecutor() as executor, pytest.warns(UserWarning, match="incomplete"):
+        members, failures = edc.load_ensemble_files(ensemble_dir, PATTERN, "firms", ["production_value"],
+                                                    executor=executor, tail_steps=1, return_failures=True)
+    assert list(failures) == [unfinished]
+    assert executor.calls["_check_ensemble_member"] == 5
+    assert executor.calls["_prepare_ensemble_member"] == 4
+    combined = xr.combine_by_coords(members)
+    assert list(combined["storage_capacity"].values) == [0, 1]
+    assert combined["production_value"].notnull().all()
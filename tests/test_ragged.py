@@ -0,0 +1,70 @@
+import dask.array as da
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+from postproc_acclimate import analysis_functions, ensemble_data_combination as edc
+
+LENGTHS = [10, 3, 25, 1, 17, 8]
+STATISTICS = ["sum", "mean", "min", "max", "std", "var", "count"]
+QUANTILES = [0, 0.25, 0.5, 0.9, 1]
+
+
+def member(capacity, length, seed):
+    rng = np.random.default_rng(seed)
+    values = rng.random((1, length, 3))
+    values[rng.random(values.shape) < 0.2] = np.nan
+    return xr.Dataset({"production_value": (("storage_capacity", "time", "agent"), values)},
+                      coords={"storage_capacity": ("storage_capacity", [capacity], {"standard_name": "storage_capacity"}),
+                              "time": pd.date_range("2024-01-01", periods=length, freq="D"),
+                              "agent": ["AGRI:DEU", "AGRI:ZAF", "MANU:DEU"]})
+
+
+@pytest.fixture
+def members():
+    return [member(capacity, length, seed) for seed, (capacity, length) in enumerate(zip(range(10, 70, 10), LENGTHS))]
+
+
+def per_member(members, reduce):
+    """The plain xarray results of each member, along the member dimension of the ragged ensemble."""
+    results = [reduce(data.isel(storage_capacity=0)["production_value"]) for data in members]
+    return xr.concat(results, dim="member").transpose(..., "member")
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+@pytest.mark.parametrize("statistic", STATISTICS)
+def test_ragged_reduce_equals_per_member(members, statistic, chunked):
+    ragged = edc.build_ragged_ensemble(members)
+    if chunked:
+        # chunks that split members
+        ragged = ragged.chunk({"obs": 7})
+    result = analysis_functions.ragged_reduce(ragged, statistic)
+    if chunked:
+        assert isinstance(result["production_value"].data, da.Array)
+    expected = per_member(members, lambda data: getattr(data, statistic)("time"))
+    np.testing.assert_allclose(result["production_value"].transpose(*expected.dims), expected, rtol=1e-12)
+    np.testing.assert_array_equal(result["storage_capacity"], [data["storage_capacity"].item() for data in members])
+
+
+@pytest.mark.parametrize("chunked", [False, True])
+def test_ragged_quantile_equals_per_member(members, chunked):
+    ragged = edc.build_ragged_ensemble(members)
+    if chunked:
+        ragged = ragged.chunk({"obs": 7})
+    result = analysis_functions.ragged_quantile(ragged["production_value"], QUANTILES)
+    expected = per_member(members, lambda data: data.quantile(QUANTILES, dim="time"))
+    assert result.dims[0] == "quantile"
+    np.testing.assert_allclose(result.transpose(*expected.dims), expected, rtol=1e-12)
+
+
+def test_ragged_graph_does_not_grow_with_the_members():
+    def tasks(n_members):
+        members = [member(capacity, 5 + capacity % 4, capacity) for capacity in range(n_members)]
+        ragged = edc.build_ragged_ensemble(members).chunk({"obs": 60})
+        result = analysis_functions.ragged_reduce(ragged["production_value"], "mean").data
+        return len(result.dask.layers[result.name]), len(ragged.chunks["obs"])
+
+    # one task per chunk of whole members, which hold up to the 60 samples of a chunk of the input
+    n_tasks, n_chunks = tasks(80)
+    assert n_tasks <= n_chunks + 1 < 80